@@ -0,0 +1,247 @@
+import re
+import math
+import numpy as np
+
+# events converted at a time when a whole file is read, bounds the memory used by the conversion
+READ_CHUNK_ROWS = 1 << 20
+
+
+class UnsupportedFCSError(ValueError):
+    """
+    The FCS file uses a layout the native reader does not handle (ASCII data, integer
+    channels of different or non byte-aligned widths); callers fall back to flowkit.
+    """
+
+
+def _parse_text(text):
+    """
+    Parses the TEXT segment: the first character is the delimiter, a doubled delimiter is a
+    literal delimiter inside a key or a value. Keys are returned upper case.
+    """
+    delimiter = text[0]
+    # split on single delimiters only
+    fields = re.split(r"(?<!{0}){0}(?!{0})".format(re.escape(delimiter)), text[1:])
+    fields = [field.replace(delimiter * 2, delimiter) for field in fields]
+    if fields and fields[-1] == "":
+        fields = fields[:-1]
+    return {fields[i].strip().upper(): fields[i + 1].strip() for i in range(0, len(fields) - 1, 2)}
+
+
+def read_fcs_metadata(fcs_file_path):
+    """
+    Reads the HEADER and TEXT segments of an FCS file.
+
+    Returns:
+        dict: keywords (upper case keys), version, data_start, data_end, n_events, n_channels,
+            pnn, pns, dtype (numpy dtype of the DATA segment with its byte order) and the
+            per-channel bits, ranges, log amplification, gain and the timestep.
+    """
+    with open(fcs_file_path, "rb") as f:
+        header = f.read(58)
+        version = header[:6].decode("ascii", errors="replace")
+        if not version.startswith("FCS"):
+            raise ValueError(f"{fcs_file_path} is not an FCS file")
+        offsets = [int(header[i:i + 8].strip() or 0) for i in range(10, 58, 8)]
+        text_start, text_end = offsets[0], offsets[1]
+        f.seek(text_start)
+        text = f.read(text_end - text_start + 1).decode("latin-1")
+    keywords = _parse_text(text)
+
+    # the header offsets are 0 for files bigger than 99,999,999 bytes, the TEXT keywords hold them
+    data_start = int(keywords.get("$BEGINDATA", 0) or 0) or offsets[2]
+    data_end = int(keywords.get("$ENDDATA", 0) or 0) or offsets[3]
+    n_channels = int(keywords["$PAR"])
+    n_events = int(keywords.get("$TOT", 0) or 0)
+    channels = range(1, n_channels + 1)
+    pnn = [keywords.get(f"$P{i}N", f"P{i}") for i in channels]
+    pns = [keywords.get(f"$P{i}S", "") for i in channels]
+    bits = [keywords.get(f"$P{i}B", "*") for i in channels]
+    ranges = [float(keywords.get(f"$P{i}R", 0) or 0) for i in channels]
+    log_amplification = []
+    for i in channels:
+        decades, offset = (keywords.get(f"$P{i}E", "0,0").split(",") + ["0"])[:2]
+        log_amplification.append((float(decades or 0), float(offset or 0)))
+    gains = [float(keywords.get(f"$P{i}G", 1) or 1) for i in channels]
+
+    byte_order = keywords.get("$BYTEORD", "1,2,3,4").replace(" ", "")
+    endian = ">" if byte_order.startswith(("4,3,2,1", "2,1")) else "<"
+    datatype = keywords.get("$DATATYPE", "F").upper()
+    if datatype == "F":
+        dtype = np.dtype(endian + "f4")
+    elif datatype == "D":
+        dtype = np.dtype(endian + "f8")
+    elif datatype == "I":
+        widths = {b for b in bits}
+        if len(widths) != 1 or not str(next(iter(widths))).isdigit() or int(next(iter(widths))) not in (8, 16, 32, 64):
+            raise UnsupportedFCSError(f"Integer channels of widths {sorted(widths)} in {fcs_file_path}")
+        dtype = np.dtype(f"{endian}u{int(next(iter(widths))) // 8}")
+    else:
+        raise UnsupportedFCSError(f"$DATATYPE {datatype} of {fcs_file_path} is not supported")
+
+    row_bytes = dtype.itemsize * n_channels
+    if not n_events:
+        n_events = (data_end - data_start + 1) // row_bytes
+    return {
+        "keywords": keywords,
+        "version": version,
+        "data_start": data_start,
+        "data_end": data_end,
+        "n_events": n_events,
+        "n_channels": n_channels,
+        "pnn": pnn,
+        "pns": pns,
+        "dtype": dtype,
+        "bits": bits,
+        "ranges": ranges,
+        "log_amplification": log_amplification,
+        "gains": gains,
+        "timestep": float(keywords.get("$TIMESTEP", 0) or 0),
+    }
+
+
+def open_fcs_data(fcs_file_path, metadata=None):
+    """
+    Memory-maps the DATA segment as an (events, channels) array in the file's own dtype and
+    byte order. Nothing is read until the array is indexed.
+    """
+    metadata = metadata or read_fcs_metadata(fcs_file_path)
+    return np.memmap(
+        fcs_file_path, dtype=metadata["dtype"], mode="r", offset=metadata["data_start"],
+        shape=(metadata["n_events"], metadata["n_channels"]),
+    )
+
+
+def channel_indices(metadata, channels=None):
+    """
+    Column indices of channels given by PnN, PnS or index, all the channels by default.
+    """
+    if channels is None:
+        return np.arange(metadata["n_channels"])
+    indices = []
+    for channel in channels:
+        if isinstance(channel, (int, np.integer)):
+            indices.append(int(channel))
+        elif channel in metadata["pnn"]:
+            indices.append(metadata["pnn"].index(channel))
+        elif channel in metadata["pns"]:
+            indices.append(metadata["pns"].index(channel))
+        else:
+            raise KeyError(f"Channel {channel} not found")
+    return np.asarray(indices, dtype=np.int64)
+
+
+def scale_events(block, metadata, columns):
+    """
+    Converts a block of DATA values to the "raw" events of flowkit: integer values are masked to
+    their range, log amplified channels ($PnE) are converted to linear values, the others are
+    divided by their gain ($PnG) and the time channel is multiplied by $TIMESTEP.
+
+    Args:
+        block (np.ndarray): DATA values of the selected columns.
+        columns (np.ndarray): Channel index of every column of the block.
+
+    Returns:
+        np.ndarray: float32 events.
+    """
+    is_integer = metadata["dtype"].kind == "u"
+    events = np.empty(block.shape, dtype=np.float32)
+    for j, channel in enumerate(columns):
+        values = block[:, j]
+        channel_range = metadata["ranges"][channel]
+        if is_integer and channel_range > 0:
+            # bits above the range are not part of the value
+            mask = (1 << max(int(math.ceil(math.log2(channel_range))), 1)) - 1
+            if mask < np.iinfo(values.dtype).max:
+                values = values & values.dtype.type(mask)
+        values = values.astype(np.float64)
+        decades, offset = metadata["log_amplification"][channel]
+        gain = metadata["gains"][channel]
+        if decades > 0 and channel_range > 0:
+            values = (offset or 1.0) * np.power(10.0, decades * values / channel_range)
+        elif gain not in (0, 1):
+            values = values / gain
+        if metadata["timestep"] and metadata["pnn"][channel].lower() == "time":
+            values = values * metadata["timestep"]
+        events[:, j] = values
+    return events
+
+
+def select_rows(n_events, subsample=None, stride=None, seed=0):
+    """
+    Sorted indices of the events kept by a strided (every stride-th event) or random
+    (subsample events) selection, None for all the events.
+    """
+    if stride and stride > 1:
+        return np.arange(0, n_events, stride)
+    if subsample and subsample < n_events:
+        return np.sort(np.random.default_rng(seed).choice(n_events, subsample, replace=False))
+    return None
+
+
+def read_fcs_events(fcs_file_path, channels=None, subsample=None, stride=None, seed=0, scale=True,
+                    chunk_rows=READ_CHUNK_ROWS):
+    """
+    Reads events of an FCS file through the memory-mapped DATA segment. With a subsample or a
+    stride only the selected events are read, with channels only the selected columns are
+    converted, so the full matrix is never materialized.
+
+    Args:
+        fcs_file_path (str): Path to the FCS file.
+        channels (list): Channels (PnN, PnS or index) to return, all by default.
+        subsample (int): Number of random events to return.
+        stride (int): Return every stride-th event instead.
+        seed (int): Seed of the random subsample.
+        scale (bool): Convert to flowkit "raw" events (see scale_events), otherwise the stored values.
+
+    Returns:
+        tuple: (float32 array of shape (events, channels), metadata dict)
+    """
+    metadata = read_fcs_metadata(fcs_file_path)
+    data = open_fcs_data(fcs_file_path, metadata)
+    columns = channel_indices(metadata, channels)
+    rows = select_rows(metadata["n_events"], subsample, stride, seed)
+    n_rows = metadata["n_events"] if rows is None else len(rows)
+    events = np.empty((n_rows, len(columns)), dtype=np.float32)
+    for start in range(0, n_rows, chunk_rows):
+        end = min(start + chunk_rows, n_rows)
+        block_rows = slice(start, end) if rows is None else rows[start:end]
+        block = data[block_rows][:, columns] if rows is None else data[block_rows[:, None], columns]
+        events[start:end] = scale_events(block, metadata, columns) if scale else block
+    return events, metadata
+
+
+def iter_fcs_chunks(fcs_file_path, chunk_rows=READ_CHUNK_ROWS, metadata=None):
+    """
+    Yields (start, float32 raw events) blocks of all the events of a file, so that whole files
+    can be converted without holding them in memory.
+    """
+    metadata = metadata or read_fcs_metadata(fcs_file_path)
+    data = open_fcs_data(fcs_file_path, metadata)
+    columns = channel_indices(metadata)
+    for start in range(0, metadata["n_events"], chunk_rows):
+        yield start, scale_events(data[start:start + chunk_rows], metadata, columns)
+
+
+def spillover_matrix(spill, pnn):
+    """
+    Parses a $SPILLOVER value ("n,channel_1,...,channel_n,v11,v12,...").
+
+    Returns:
+        tuple: (indices of the spillover channels among pnn, n x n matrix)
+    """
+    fields = [field.strip() for field in spill.split(",")]
+    n = int(fields[0])
+    names = fields[1:n + 1]
+    values = np.asarray(fields[n + 1:n + 1 + n * n], dtype=np.float64).reshape(n, n)
+    indices = np.asarray([pnn.index(name) for name in names], dtype=np.int64)
+    return indices, values
+
+
+def compensate(events, spill_indices, spill_values):
+    """
+    Compensates the spillover channels of a block of events in place (events x inverse of the
+    spillover matrix), the other channels are left as they are.
+    """
+    inverse = np.linalg.inv(spill_values)
+    events[:, spill_indices] = (events[:, spill_indices].astype(np.float64) @ inverse).astype(events.dtype)
+    return events
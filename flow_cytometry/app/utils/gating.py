@@ -5,6 +5,7 @@ import os
 import json
 import pandas as pd
 from app.helpers import flow_cytometry_helpers as fch
+from app.utils import fcs_cache
 import numpy as np
 import xml.etree.ElementTree as ET
 from xml.dom import minidom
@@ -20,8 +21,8 @@ def read_fcs_data(fcs_file_path):
     """
     Read FCS data from a file and return a downsampled DataFrame
     """
-    # read the fcs file
-    downsampled_data = fk.Sample(fcs_file_path).as_dataframe(source="raw")
+    # read the fcs file through the events cache
+    downsampled_data = fcs_cache.events_dataframe(fcs_file_path, source="raw")
     
     # subsample the data
     return downsampled_data
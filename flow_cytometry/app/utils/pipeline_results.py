@@ -0,0 +1,110 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import polars as pl
+
+# layout of the event stores and column sets written by the pipeline microservice
+MANIFEST_FILE = "manifest.json"
+COLUMN_SET_MANIFEST_FILE = "columns.json"
+SAMPLE_COLUMN = "source_file"
+
+
+def _read_json(path, file_name):
+    with open(os.path.join(path, file_name)) as f:
+        return json.load(f)
+
+
+def is_event_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST_FILE))
+
+
+def is_column_set(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, COLUMN_SET_MANIFEST_FILE))
+
+
+def is_result_table(path):
+    """
+    Whether a path stored on a pipeline run is a table read_results can read: a column set, an
+    event store or a CSV file (the other paths are plots and reports).
+    """
+    if not isinstance(path, str):
+        return False
+    return is_column_set(path) or is_event_store(path) or (path.lower().endswith(".csv") and os.path.isfile(path))
+
+
+def count_events(path):
+    if is_column_set(path):
+        return _read_json(path, COLUMN_SET_MANIFEST_FILE)["n_events"]
+    if is_event_store(path):
+        return _read_json(path, MANIFEST_FILE)["n_events"]
+    return None
+
+
+def _read_store_rows(path, rows):
+    """
+    Events of a store at some rows (sorted), read one sample file at a time.
+    """
+    manifest = _read_json(path, MANIFEST_FILE)
+    columns = manifest["columns"]
+    frames = []
+    for part in manifest["samples"]:
+        local = rows[(rows >= part["offset"]) & (rows < part["offset"] + part["n_events"])] - part["offset"]
+        if len(local) == 0:
+            continue
+        frame = (
+            pl.scan_parquet(os.path.join(path, part["file"]))
+            .select(columns)
+            .with_row_index("row")
+            .filter(pl.col("row").is_in(local.tolist()))
+            .drop("row")
+            .collect()
+        )
+        # column by column through numpy, to_pandas() would need pyarrow
+        df = pd.DataFrame({c: frame[c].to_numpy() for c in columns})
+        df[SAMPLE_COLUMN] = part["sample_id"]
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=columns + [SAMPLE_COLUMN])
+    return pd.concat(frames, ignore_index=True)
+
+
+def _read_rows(path, rows):
+    if is_column_set(path):
+        manifest = _read_json(path, COLUMN_SET_MANIFEST_FILE)
+        df = _read_rows(manifest["base_path"], rows)
+        for entry in manifest["columns"]:
+            values = np.load(os.path.join(path, entry["file"]), mmap_mode="r")
+            df[entry["name"]] = values if rows is None else values[rows]
+        return df
+    if is_event_store(path):
+        if rows is None:
+            rows = np.arange(count_events(path))
+        return _read_store_rows(path, rows)
+    df = pd.read_csv(path)
+    return df if rows is None else df.iloc[rows].reset_index(drop=True)
+
+
+def read_results(path, max_rows=None, seed=4242):
+    """
+    Reads a pipeline result as a DataFrame: a CSV file, an event store or a column set joined to
+    the events it labels (see the event_store module of the pipeline). Only the sampled rows of
+    the events are read.
+
+    Args:
+        path (str): Result path stored on the pipeline run.
+        max_rows (int): Random sample of at most max_rows events, all the events by default.
+
+    Returns:
+        pd.DataFrame: The events with the result columns.
+    """
+    n_events = count_events(path)
+    if n_events is None:
+        df = pd.read_csv(path)
+        if max_rows is not None and len(df) > max_rows:
+            df = df.sample(n=max_rows, random_state=seed)
+        return df
+    rows = None
+    if max_rows is not None and n_events > max_rows:
+        rows = np.sort(np.random.default_rng(seed).choice(n_events, max_rows, replace=False))
+    return _read_rows(path, rows)
@@ -8,8 +8,7 @@ from dotenv import load_dotenv
 from ..helpers.flow_cytometry_helpers import encrypt_flow_cytometry_data, decrypt_flow_cytometry_data
 from ..utils.security import encrypt_data
 import json
-from  app.utils import security, pipeline
-import flowkit as fk
+from  app.utils import security, pipeline, fcs_cache, pipeline_results
 # import bson mongodb
 from bson import ObjectId
 import logging 
@@ -477,8 +476,8 @@ def process_flow_cytometry_file_views(username, project_id, progressive_id):
     
     # prendi il file utilizzando flowkit con il flow cytometry path
     file_path = security.decrypt_data(file["file_path"])
-    sample = fk.Sample(file_path)
-    data = sample.as_dataframe(source = "raw", subsample = 100)
+    # flowkit's default random subsample of 10000 events, read from the events cache
+    data = fcs_cache.events_dataframe(file_path, source = "raw", subsample = 10000)
     dataset = {
         "parameters":  data.columns.tolist(),
         "data": data.to_dict(orient="records")
@@ -678,31 +677,26 @@ def get_fc_pipeline_run_results(project_id, progressive_id, username):
         logger.error(f"Pipeline run not found: {progressive_id} by user {username}")
         return jsonify({"error": "Pipeline run not found"}), 404
     
-    # get all the fields that have "path" in the name
-    paths = {key: pipeline_run[key] for key in pipeline_run if "path" in key}
+    # get all the fields that have "path" in the name and point to a table (CSV file, event
+    # store or column set), plots and reports are left out
+    paths = {key: pipeline_run[key] for key in pipeline_run
+             if "path" in key and pipeline_results.is_result_table(pipeline_run[key])}
     
-    # read all the csv files and return the data
+    # read the results and return the data
     data = {}
     for key, value in paths.items():
         try:
-            df = pd.read_csv(value)
-            # get maximum number of rows to 30000
-            df = df.sample(n=10000, random_state=4242) if len(df) > 10000 else df
+            # CSV files, or column sets read with the events they label; at most 10000 events
+            df = pipeline_results.read_results(value, max_rows=10000, seed=4242)
             # Convert DataFrame to dictionary while preserving all columns
             data[key] = df.to_dict(orient="records")
         except Exception as e:
             logger.error(f"Error processing file {key}: {str(e)}")
             data[key] = str(e)
 
-    # take only the clustering_result_path from the key
-    clustering_result_data = {}
-    for key, value in data.items():
-        if "clustering_result_path" in key:
-            clustering_result_data[key] = value
-    
     logger.info(f"Pipeline run results retrieved for project {project_id} by user {username}")    
     
-    return jsonify({"data": clustering_result_data}), 200
+    return jsonify({"data": data}), 200
 
 # views to get the fcs heatmap data
 def get_fc_pipeline_run_heatmap_results_views(project_id, progressive_id, username):
@@ -737,10 +731,15 @@ def get_fc_pipeline_run_heatmap_results_views(project_id, progressive_id, userna
         
     # transform data into a dictionary
     heatmap_data = df.to_dict(orient="records")
+    response = {"data": heatmap_data}
+    
+    # cluster x sample event counts, written by the same pass as the heatmap in newer runs
+    if pipeline_run.get("cluster_abundance_path"):
+        response["abundance"] = pd.read_csv(pipeline_run["cluster_abundance_path"]).to_dict(orient="records")
     
     logger.info(f"Heatmap data retrieved for project {project_id} by user {username}")
     
-    return jsonify({"data": heatmap_data}), 200
+    return jsonify(response), 200
 
 # get all the information about a specific flow cytometry object
 def get_fcs_object_views(progressive_id, project_id, username):
@@ -0,0 +1,53 @@
+import os
+import multiprocessing
+import numpy as np
+import flowio
+from app.utils import fcs_cache
+
+
+CHANNELS = ["FSC-A", "SSC-A", "FL1-A"]
+
+
+def write_fcs(path, seed):
+    events = np.random.default_rng(seed).uniform(0, 1000, size=(500, len(CHANNELS))).astype(np.float32)
+    with open(path, "wb") as file_handle:
+        flowio.create_fcs(file_handle, events.flatten(), CHANNELS)
+    return str(path), events
+
+
+def _cache_in_child(paths, cache_dir, queue):
+    try:
+        queue.put(fcs_cache.cache_many(paths, max_workers=2, cache_dir=cache_dir))
+    except BaseException as e:
+        queue.put(e)
+
+
+def test_cache_many_in_daemonic_process(tmp_path):
+    # Celery prefork workers are daemonic and cannot start a process pool
+    files = [write_fcs(tmp_path / f"sample_{i}.fcs", i) for i in range(2)]
+    paths = [path for path, _ in files]
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    child = context.Process(target=_cache_in_child, args=(paths, str(tmp_path / "cache"), queue), daemon=True)
+    child.start()
+    entries = queue.get(timeout=120)
+    child.join(timeout=10)
+    assert not isinstance(entries, BaseException), entries
+    assert len(entries) == 2
+    for (path, events), entry in zip(files, entries):
+        cached, _ = fcs_cache.load_events(path, cache_dir=str(tmp_path / "cache"))
+        assert np.allclose(cached, events)
+
+
+def test_prune_cache_removes_least_recently_used(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    entries = [fcs_cache.cache_fcs(write_fcs(tmp_path / f"sample_{i}.fcs", i)[0], cache_dir) for i in range(3)]
+    for i, entry in enumerate(entries):
+        os.utime(os.path.join(entry, fcs_cache.METADATA_FILE), (i, i))
+    # a cache hit marks the entry as used
+    fcs_cache.cache_fcs(str(tmp_path / "sample_0.fcs"), cache_dir)
+    entry_size = sum(f.stat().st_size for f in os.scandir(entries[1]))
+
+    assert fcs_cache.prune_cache(max_bytes=2 * entry_size, cache_dir=cache_dir) == 1
+    assert not os.path.exists(entries[1])
+    assert os.path.exists(entries[0]) and os.path.exists(entries[2])
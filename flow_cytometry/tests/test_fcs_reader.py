@@ -0,0 +1,41 @@
+import numpy as np
+import flowio
+import flowkit as fk
+from app.utils import fcs_reader
+
+
+CHANNELS = ["FSC-A", "SSC-A", "FL1-A", "FL2-A"]
+SPILL = "2,FL1-A,FL2-A,1,0.1,0.05,1"
+
+
+def write_fcs(path, num_events=1000):
+    events = np.random.default_rng(0).uniform(0, 1000, size=(num_events, len(CHANNELS))).astype(np.float32)
+    with open(path, "wb") as file_handle:
+        flowio.create_fcs(file_handle, events.flatten(), CHANNELS, ["", "", "CD3", "CD4"],
+                          metadata_dict={"SPILL": SPILL})
+    return str(path)
+
+
+def test_read_fcs_events_matches_flowkit(tmp_path):
+    path = write_fcs(tmp_path / "sample.fcs")
+    events, metadata = fcs_reader.read_fcs_events(path)
+    assert metadata["pnn"] == CHANNELS
+    assert np.allclose(events, fk.Sample(path).get_events(source="raw"))
+
+
+def test_read_fcs_events_subsample_and_channels(tmp_path):
+    path = write_fcs(tmp_path / "sample.fcs")
+    raw = fk.Sample(path).get_events(source="raw")
+    strided, _ = fcs_reader.read_fcs_events(path, channels=["CD4", "FSC-A"], stride=10)
+    assert np.allclose(strided, raw[::10][:, [3, 0]])
+    sampled, _ = fcs_reader.read_fcs_events(path, subsample=100)
+    assert sampled.shape == (100, len(CHANNELS))
+
+
+def test_compensate_matches_flowkit(tmp_path):
+    path = write_fcs(tmp_path / "sample.fcs")
+    events, metadata = fcs_reader.read_fcs_events(path)
+    sample = fk.Sample(path)
+    sample.apply_compensation(SPILL)
+    compensated = fcs_reader.compensate(events, *fcs_reader.spillover_matrix(SPILL, metadata["pnn"]))
+    assert np.allclose(compensated, sample.get_events(source="comp"), atol=1e-3)
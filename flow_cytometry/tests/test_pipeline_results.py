@@ -0,0 +1,76 @@
+import json
+import numpy as np
+import pandas as pd
+import polars as pl
+from app.utils import pipeline_results
+
+
+SAMPLES = [("s0.fcs", 30), ("s1.fcs", 20)]
+
+
+def write_store(path):
+    # layout of the event stores of the pipeline microservice
+    path.mkdir()
+    parts, offset = [], 0
+    for i, (sample_id, n_events) in enumerate(SAMPLES):
+        file_name = f"part-{i:05d}.parquet"
+        values = np.arange(offset, offset + n_events, dtype=np.float32)
+        pl.DataFrame({"CD3": values, "CD4": -values, "source_file": [sample_id] * n_events}).write_parquet(path / file_name)
+        parts.append({"sample_id": sample_id, "file": file_name, "offset": offset, "n_events": n_events})
+        offset += n_events
+    (path / "manifest.json").write_text(json.dumps({"columns": ["CD3", "CD4"], "n_events": offset, "samples": parts}))
+    return str(path)
+
+
+def write_column_set(path, base_path, columns):
+    path.mkdir()
+    entries = []
+    for name, values in columns.items():
+        np.save(path / f"{name}.npy", values)
+        entries.append({"name": name, "file": f"{name}.npy", "dtype": values.dtype.name})
+    (path / "columns.json").write_text(json.dumps({
+        "base_path": base_path, "n_events": len(next(iter(columns.values()))), "columns": entries
+    }))
+    return str(path)
+
+
+def test_read_results_joins_column_sets_to_the_store(tmp_path):
+    store = write_store(tmp_path / "store")
+    n_events = sum(n for _, n in SAMPLES)
+    embedding = write_column_set(tmp_path / "embedding", store, {
+        "UMAP_1": np.arange(n_events, dtype=np.float32) * 2
+    })
+    labels = write_column_set(tmp_path / "labels", embedding, {
+        "Leiden_Cluster": (np.arange(n_events) % 3).astype(np.int16)
+    })
+    df = pipeline_results.read_results(labels)
+    assert list(df.columns) == ["CD3", "CD4", "source_file", "UMAP_1", "Leiden_Cluster"]
+    assert np.array_equal(df["UMAP_1"], df["CD3"] * 2)
+    assert np.array_equal(df["Leiden_Cluster"], df["CD3"].astype(int) % 3)
+    assert (df["source_file"] == "s1.fcs").sum() == 20
+
+
+def test_read_results_samples_rows(tmp_path):
+    store = write_store(tmp_path / "store")
+    labels = write_column_set(tmp_path / "labels", store, {"FlowSOM_cluster": np.arange(50, dtype=np.int16)})
+    df = pipeline_results.read_results(labels, max_rows=10)
+    assert len(df) == 10
+    assert np.array_equal(df["FlowSOM_cluster"], df["CD3"].astype(int))
+
+
+def test_read_results_csv(tmp_path):
+    path = tmp_path / "clustering_result.csv"
+    pd.DataFrame({"CD3": range(50), "Leiden_Cluster": 0}).to_csv(path, index=False)
+    assert len(pipeline_results.read_results(str(path), max_rows=10)) == 10
+
+
+def test_is_result_table(tmp_path):
+    store = write_store(tmp_path / "store")
+    labels = write_column_set(tmp_path / "labels", store, {"FlowSOM_cluster": np.arange(50, dtype=np.int16)})
+    csv = tmp_path / "heatmap.csv"
+    pd.DataFrame({"CD3": [1.0]}).to_csv(csv, index=False)
+    assert pipeline_results.is_result_table(store)
+    assert pipeline_results.is_result_table(labels)
+    assert pipeline_results.is_result_table(str(csv))
+    assert not pipeline_results.is_result_table(str(tmp_path / "umap.png"))
+    assert not pipeline_results.is_result_table(None)
@@ -0,0 +1,20 @@
+import os
+import pytest
+
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINE_DIR = os.path.join(os.path.dirname(SERVICE_DIR), "pipeline_microservice", "app", "flow_cytometry_functions")
+
+# modules copied in both services: the cache format must stay identical across them
+SHARED_MODULES = ["fcs_cache.py", "fcs_reader.py"]
+
+
+@pytest.mark.parametrize("module", SHARED_MODULES)
+def test_shared_module_in_sync(module):
+    copy = os.path.join(PIPELINE_DIR, module)
+    if not os.path.exists(copy):
+        pytest.skip("the pipeline service is not checked out next to this one")
+    with open(os.path.join(SERVICE_DIR, "app", "utils", module)) as file_handle:
+        source = file_handle.read()
+    with open(copy) as file_handle:
+        assert file_handle.read() == source, f"{module} differs from the copy of the pipeline service"
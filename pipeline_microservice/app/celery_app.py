@@ -1,4 +1,5 @@
 from celery import Celery
+import redis
 
 def make_celery():
     celery = Celery(
@@ -9,4 +10,7 @@ def make_celery():
     # Optionally: celery.config_from_object('your_config_module')
     return celery
 
-celery_app = make_celery()
\ No newline at end of file
+celery_app = make_celery()
+
+# shared by the tasks and by the progress events of the pipeline runs
+redis_client = redis.StrictRedis(host='localhost', port=6379, db=0, decode_responses=True)
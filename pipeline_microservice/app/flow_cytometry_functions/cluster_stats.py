@@ -0,0 +1,232 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from app.flow_cytometry_functions import event_store
+
+# set up logging
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# bins of the per-(cluster, sample, marker) histograms of the approximate medians, and events per chunk
+CLUSTER_STATS_BINS = int(os.getenv("CLUSTER_STATS_BINS", 256))
+CLUSTER_STATS_CHUNK_ROWS = int(os.getenv("CLUSTER_STATS_CHUNK_ROWS", 262144))
+
+
+class ClusterStatistics:
+    """
+    Per-(cluster, sample, marker) statistics accumulated chunk by chunk: event counts, sums,
+    sums of squares, exact marker minimum and maximum, and histograms for approximate medians.
+    The histograms are over arcsinh(value), like the usual cytometry scale: the median commutes
+    with it and the bins keep a similar relative precision from dim to bright events. The
+    histograms of a marker share one range that doubles (merging pairs of bins) whenever a chunk
+    falls outside of it, so the events are read once and the memory does not depend on their
+    number.
+
+    Usage:
+        stats = ClusterStatistics(clusters, samples, markers)
+        for block, labels, sample_codes in chunks:
+            stats.add(block, labels, sample_codes)
+        stats.heatmap(), stats.abundance()
+    """
+
+    def __init__(self, clusters, samples, markers, bins=None):
+        self.clusters = list(clusters)
+        self.samples = list(samples)
+        self.markers = list(markers)
+        self.bins = int(bins or CLUSTER_STATS_BINS)
+        if self.bins < 2 or self.bins % 2:
+            raise ValueError("The number of histogram bins must be even")
+        n_cells = len(self.clusters) * len(self.samples)
+        n_markers = len(self.markers)
+        self.counts = np.zeros(n_cells, dtype=np.int64)
+        self.sums = np.zeros((n_cells, n_markers), dtype=np.float64)
+        self.sums_sq = np.zeros((n_cells, n_markers), dtype=np.float64)
+        self.histograms = np.zeros((n_cells, n_markers, self.bins), dtype=np.int32)
+        self.minimum = np.full(n_markers, np.inf)
+        self.maximum = np.full(n_markers, -np.inf)
+        # histogram range per marker: [low, low + bins * width)
+        self.low = None
+        self.width = None
+
+    def _cover(self, block_min, block_max):
+        """
+        Widens the histogram ranges until they hold [block_min, block_max].
+        """
+        if self.low is None:
+            span = np.where(block_max > block_min, block_max - block_min, 1.0)
+            self.width = span * 1.0001 / self.bins
+            self.low = block_min.astype(np.float64)
+            return
+        half = self.bins // 2
+        for m in range(len(self.markers)):
+            while block_min[m] < self.low[m] or block_max[m] >= self.low[m] + self.bins * self.width[m]:
+                # pairs of bins are merged into the half of the doubled range the old range covers
+                merged = self.histograms[:, m, 0::2] + self.histograms[:, m, 1::2]
+                self.histograms[:, m] = 0
+                if block_min[m] < self.low[m]:
+                    self.low[m] -= self.bins * self.width[m]
+                    self.histograms[:, m, half:] = merged
+                else:
+                    self.histograms[:, m, :half] = merged
+                self.width[m] *= 2
+
+    def add(self, block, labels, sample_codes):
+        """
+        Adds a chunk of events.
+
+        Args:
+            block (np.ndarray): (events, markers) values.
+            labels (np.ndarray): Index of the cluster of every event in clusters.
+            sample_codes (np.ndarray | int): Index of the sample of every event in samples, or one
+                index for the whole chunk.
+        """
+        if len(block) == 0:
+            return self
+        block = np.asarray(block, dtype=np.float64)
+        n_cells, n_markers = self.sums.shape
+        cells = np.asarray(labels, dtype=np.int64) * len(self.samples) + np.asarray(sample_codes, dtype=np.int64)
+        cells = np.broadcast_to(cells, (len(block),))
+
+        np.minimum(self.minimum, block.min(axis=0), out=self.minimum)
+        np.maximum(self.maximum, block.max(axis=0), out=self.maximum)
+        scaled = np.arcsinh(block)
+        self._cover(scaled.min(axis=0), scaled.max(axis=0))
+
+        self.counts += np.bincount(cells, minlength=n_cells)
+        for m in range(n_markers):
+            self.sums[:, m] += np.bincount(cells, weights=block[:, m], minlength=n_cells)
+            self.sums_sq[:, m] += np.bincount(cells, weights=block[:, m] ** 2, minlength=n_cells)
+        bin_index = ((scaled - self.low) / self.width).astype(np.int64)
+        np.clip(bin_index, 0, self.bins - 1, out=bin_index)
+        # histograms of the cells present in the chunk only, one marker at a time
+        present, local = np.unique(cells, return_inverse=True)
+        local = local * self.bins
+        for m in range(n_markers):
+            counts = np.bincount(local + bin_index[:, m], minlength=len(present) * self.bins)
+            self.histograms[present, m] += counts.reshape(len(present), self.bins).astype(np.int32)
+        return self
+
+    def _cell_counts(self):
+        return self.counts.reshape(len(self.clusters), len(self.samples))
+
+    @staticmethod
+    def _medians(histograms, low, width):
+        """
+        Medians of (..., markers, bins) arcsinh histograms, interpolated linearly inside the
+        median bin.
+        """
+        cumulative = np.cumsum(histograms, axis=-1)
+        half = cumulative[..., -1:] / 2.0
+        index = np.minimum((cumulative < half).sum(axis=-1), histograms.shape[-1] - 1)
+        below = np.take_along_axis(cumulative, index[..., None], axis=-1)[..., 0] - \
+            np.take_along_axis(histograms, index[..., None], axis=-1)[..., 0]
+        inside = np.take_along_axis(histograms, index[..., None], axis=-1)[..., 0]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.where(inside > 0, (half[..., 0] - below) / inside, 0.5)
+            return np.where(cumulative[..., -1] > 0, np.sinh(low + (index + fraction) * width), np.nan)
+
+    def heatmap(self, cluster_column="cluster"):
+        """
+        Cluster x marker table of the mean of every marker, scaled to [0, 1] with the minimum and
+        maximum of the marker over all the events.
+        """
+        n_clusters, n_samples = len(self.clusters), len(self.samples)
+        counts = self._cell_counts().sum(axis=1)
+        sums = self.sums.reshape(n_clusters, n_samples, -1).sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / counts[:, None]
+            spread = self.maximum - self.minimum
+            scaled = (means - self.minimum) / np.where(spread > 0, spread, np.nan)
+        return pd.DataFrame(scaled, index=pd.Index(self.clusters, name=cluster_column), columns=self.markers)
+
+    def abundance(self, cluster_column="cluster"):
+        """
+        Cluster x sample table of event counts.
+        """
+        return pd.DataFrame(self._cell_counts(), index=pd.Index(self.clusters, name=cluster_column),
+                            columns=self.samples)
+
+    def table(self, cluster_column="cluster"):
+        """
+        Long table with one row per (cluster, sample, marker): count, mean, standard deviation and
+        approximate median; cluster/sample pairs without events are left out.
+        """
+        n_clusters, n_samples, n_markers = len(self.clusters), len(self.samples), len(self.markers)
+        counts = np.repeat(self.counts, n_markers).astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = self.sums.ravel() / counts
+            variance = np.maximum(self.sums_sq.ravel() / counts - means ** 2, 0.0)
+        medians = self._medians(self.histograms, self.low if self.low is not None else 0.0,
+                                self.width if self.width is not None else 1.0)
+        table = pd.DataFrame({
+            cluster_column: np.repeat(self.clusters, n_samples * n_markers),
+            "sample": np.tile(np.repeat(self.samples, n_markers), n_clusters),
+            "marker": np.tile(self.markers, n_clusters * n_samples),
+            "count": counts.astype(np.int64),
+            "mean": means,
+            "sd": np.sqrt(variance),
+            "median": medians.ravel(),
+        })
+        return table[table["count"] > 0].reset_index(drop=True)
+
+
+def cluster_statistics(clustering_result_path, cluster_column, markers=None, bins=None, chunk_rows=None,
+                       progress=None):
+    """
+    Streams the events of a clustering result through ClusterStatistics. For a column set the
+    labels are read once (a small integer column) and the markers chunk by chunk from the event
+    store; a legacy CSV result is read in chunks of rows.
+
+    Args:
+        clustering_result_path (str): Column set (or CSV file) with the cluster column.
+        cluster_column (str): Column of the cluster labels.
+        markers (list): Marker columns, those of the event store by default.
+        progress (callable): Called as progress(done, total) with the aggregated events.
+
+    Returns:
+        ClusterStatistics: The accumulated statistics.
+    """
+    chunk_rows = int(chunk_rows or CLUSTER_STATS_CHUNK_ROWS)
+    store = event_store.base_store(clustering_result_path)
+    if store is None:
+        return _csv_statistics(clustering_result_path, cluster_column, markers, bins, chunk_rows)
+
+    labels = np.asarray(event_store.read_events(clustering_result_path, columns=[cluster_column])[cluster_column])
+    clusters, codes = np.unique(labels, return_inverse=True)
+    del labels
+    manifest = event_store.read_manifest(store)
+    markers = list(markers or manifest['columns'])
+    stats = ClusterStatistics(clusters.tolist(), [s['sample_id'] for s in manifest['samples']], markers, bins)
+    done = 0
+    for i, s in enumerate(manifest['samples']):
+        for start in range(0, s['n_events'], chunk_rows):
+            block = event_store.read_event_block(store, s['sample_id'], markers, start, chunk_rows)
+            offset = s['offset'] + start
+            stats.add(block, codes[offset:offset + len(block)], i)
+            done += len(block)
+            if progress is not None:
+                progress(done, manifest['n_events'])
+    return stats
+
+
+def _csv_statistics(path, cluster_column, markers, bins, chunk_rows):
+    # the clusters and samples are needed before the first chunk, their columns are read first
+    header = event_store.read_events(path, columns=[cluster_column])
+    clusters = np.unique(header[cluster_column])
+    has_samples = event_store.SAMPLE_COLUMN in header.columns
+    samples = pd.unique(header[event_store.SAMPLE_COLUMN].astype(str)).tolist() if has_samples else ['all']
+    del header
+    markers = list(markers or [c for c in event_store.event_columns(path)
+                               if c not in (cluster_column, 'UMAP_1', 'UMAP_2')])
+    stats = ClusterStatistics(clusters.tolist(), samples, markers, bins)
+    usecols = markers + [cluster_column] + ([event_store.SAMPLE_COLUMN] if has_samples else [])
+    for chunk in pd.read_csv(path, usecols=usecols, chunksize=chunk_rows):
+        sample_codes = pd.Categorical(chunk[event_store.SAMPLE_COLUMN].astype(str), categories=samples).codes \
+            if has_samples else 0
+        stats.add(np.nan_to_num(chunk[markers].to_numpy(dtype=np.float64)),
+                  np.searchsorted(clusters, chunk[cluster_column].to_numpy()), sample_codes)
+    return stats
@@ -0,0 +1,162 @@
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm, ListedColormap
+
+# pixels per side of the rasters, rendering cost depends on it and not on the number of events
+DEFAULT_BINS = 512
+
+
+class DensityRaster:
+    """
+    2D histogram of points accumulated chunk by chunk, with per-bin label counts (for the mode
+    of a label) and per-bin sums (for the mean of a marker).
+
+    Usage:
+        raster = DensityRaster(extent, n_labels=10)
+        for x, y, labels in chunks:
+            raster.add(x, y, labels=labels)
+        raster.mode()
+    """
+
+    def __init__(self, extent, bins=DEFAULT_BINS, n_labels=None):
+        self.extent = tuple(float(v) for v in extent)
+        self.bins = int(bins)
+        self.counts = np.zeros(self.bins * self.bins, dtype=np.int64)
+        self.label_counts = None if n_labels is None else np.zeros((self.bins * self.bins, n_labels), dtype=np.int32)
+        self.sums = None
+
+    def _bin_index(self, x, y):
+        x_min, x_max, y_min, y_max = self.extent
+        ix = ((np.asarray(x, dtype=np.float64) - x_min) / ((x_max - x_min) or 1.0) * self.bins).astype(np.int64)
+        iy = ((np.asarray(y, dtype=np.float64) - y_min) / ((y_max - y_min) or 1.0) * self.bins).astype(np.int64)
+        np.clip(ix, 0, self.bins - 1, out=ix)
+        np.clip(iy, 0, self.bins - 1, out=iy)
+        # rows are y from the bottom, as drawn with origin="lower"
+        return iy * self.bins + ix
+
+    def add(self, x, y, labels=None, values=None):
+        """
+        Adds a chunk of points, with an integer label (0..n_labels-1) or a value per point.
+        """
+        index = self._bin_index(x, y)
+        size = self.bins * self.bins
+        self.counts += np.bincount(index, minlength=size)
+        if labels is not None:
+            n_labels = self.label_counts.shape[1]
+            self.label_counts += np.bincount(
+                index * n_labels + np.asarray(labels, dtype=np.int64), minlength=size * n_labels
+            ).reshape(size, n_labels)
+        if values is not None:
+            if self.sums is None:
+                self.sums = np.zeros(size, dtype=np.float64)
+            self.sums += np.bincount(index, weights=np.asarray(values, dtype=np.float64), minlength=size)
+        return self
+
+    def grid(self, flat):
+        return flat.reshape(self.bins, self.bins)
+
+    def density(self):
+        """
+        Counts per bin, NaN for empty bins so that they are not painted.
+        """
+        return self.grid(np.where(self.counts > 0, self.counts, np.nan).astype(np.float64))
+
+    def mode(self):
+        """
+        Most frequent label per bin, -1 for empty bins.
+        """
+        return self.grid(np.where(self.counts > 0, self.label_counts.argmax(axis=1), -1))
+
+    def mean(self):
+        """
+        Mean value per bin, NaN for empty bins.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.grid(np.where(self.counts > 0, self.sums / self.counts, np.nan))
+
+
+def data_extent(x, y, margin=0.02):
+    """
+    (x_min, x_max, y_min, y_max) of points with a small margin.
+    """
+    x_min, x_max = float(np.nanmin(x)), float(np.nanmax(x))
+    y_min, y_max = float(np.nanmin(y)), float(np.nanmax(y))
+    dx, dy = (x_max - x_min) * margin or 1.0, (y_max - y_min) * margin or 1.0
+    return x_min - dx, x_max + dx, y_min - dy, y_max + dy
+
+
+def label_colormap(n_labels):
+    """
+    Qualitative colormap with one color per label.
+    """
+    base = matplotlib.colormaps["tab20"].colors if n_labels > 10 else matplotlib.colormaps["tab10"].colors
+    return ListedColormap([base[i % len(base)] for i in range(max(n_labels, 1))])
+
+
+def draw_raster(ax, raster, kind="density", title=None, label_names=None, colorbar_label=None):
+    """
+    Draws a raster on an axis as a single image.
+
+    Args:
+        kind (str): density (log counts), mode (color of the most frequent label, shaded by the
+            density) or mean (mean value).
+        label_names (list): Names of the labels for the legend of a mode raster.
+    """
+    extent = raster.extent
+    if kind == "density":
+        density = raster.density()
+        image = ax.imshow(density, origin="lower", extent=extent, aspect="auto", cmap="viridis",
+                          norm=LogNorm(vmin=1, vmax=max(np.nanmax(density), 1)) if np.any(raster.counts) else None,
+                          interpolation="nearest")
+        plt.colorbar(image, ax=ax, label=colorbar_label or "events")
+    elif kind == "mode":
+        mode = raster.mode()
+        n_labels = raster.label_counts.shape[1]
+        colors = label_colormap(n_labels)(np.clip(mode, 0, None))
+        # alpha follows the log density, empty bins are transparent
+        log_counts = np.log1p(raster.grid(raster.counts).astype(np.float64))
+        colors[..., 3] = np.where(mode >= 0, 0.35 + 0.65 * log_counts / max(log_counts.max(), 1e-9), 0.0)
+        ax.imshow(colors, origin="lower", extent=extent, aspect="auto", interpolation="nearest")
+        if label_names is not None and len(label_names) <= 40:
+            cmap = label_colormap(n_labels)
+            handles = [plt.Line2D([], [], marker="s", linestyle="", color=cmap(i), label=str(name))
+                       for i, name in enumerate(label_names)]
+            ax.legend(handles=handles, loc="center left", bbox_to_anchor=(1.0, 0.5), fontsize="small", frameon=False)
+    elif kind == "mean":
+        image = ax.imshow(raster.mean(), origin="lower", extent=extent, aspect="auto", cmap="viridis",
+                          interpolation="nearest")
+        plt.colorbar(image, ax=ax, label=colorbar_label or "mean")
+    else:
+        raise ValueError(f"Unknown raster kind: {kind}")
+    if title:
+        ax.set_title(title)
+    return ax
+
+
+def save_small_multiples(panels, output_path, ncols=None, panel_size=5, dpi=150, xlabel=None, ylabel=None):
+    """
+    Draws rasters side by side in one figure and saves it.
+
+    Args:
+        panels (list): dicts with the arguments of draw_raster (raster, kind, title, label_names, ...).
+        ncols (int): Panels per row, all in one row by default.
+
+    Returns:
+        str: output_path
+    """
+    ncols = ncols or len(panels)
+    nrows = int(np.ceil(len(panels) / ncols))
+    fig, axes = plt.subplots(nrows, ncols, figsize=(panel_size * ncols * 1.3, panel_size * nrows), squeeze=False)
+    for ax, panel in zip(axes.flat, panels):
+        draw_raster(ax, **panel)
+        if xlabel:
+            ax.set_xlabel(xlabel)
+        if ylabel:
+            ax.set_ylabel(ylabel)
+    for ax in list(axes.flat)[len(panels):]:
+        ax.axis("off")
+    fig.tight_layout()
+    fig.savefig(output_path, dpi=dpi)
+    plt.close(fig)
+    return output_path
@@ -0,0 +1,358 @@
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+import polars as pl
+from dotenv import load_dotenv
+
+# set up logging
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# events per Parquet row group, the unit read when a column subset is requested
+EVENT_STORE_CHUNK_ROWS = int(os.getenv("EVENT_STORE_CHUNK_ROWS", 262144))
+EVENT_STORE_COMPRESSION_LEVEL = int(os.getenv("EVENT_STORE_COMPRESSION_LEVEL", 3))
+
+MANIFEST_FILE = "manifest.json"
+COLUMN_SET_MANIFEST_FILE = "columns.json"
+SAMPLE_COLUMN = "source_file"
+STORE_VERSION = 1
+
+
+class EventStoreWriter:
+    """
+    Writes the events of many samples to a columnar store: a folder with one zstd Parquet file
+    per sample (float32 marker columns, categorical sample column, row groups of chunk_rows
+    events) and a manifest with the columns, the samples and their row offsets. Samples are
+    written one at a time, so only one sample is held in memory.
+
+    Usage:
+        writer = EventStoreWriter(path)
+        writer.write_sample("sample_1.fcs", df)
+        store_path = writer.close()
+    """
+
+    def __init__(self, path, chunk_rows=None):
+        self.path = path
+        self.chunk_rows = chunk_rows or EVENT_STORE_CHUNK_ROWS
+        self.columns = None
+        self.samples = []
+        self.n_events = 0
+        os.makedirs(path, exist_ok=True)
+
+    def write_sample(self, sample_id, df):
+        """
+        Appends the events of a sample.
+
+        Args:
+            sample_id (str): Name of the sample, stored in the sample column.
+            df (pd.DataFrame | pl.DataFrame): Events, one numeric column per marker.
+        """
+        if isinstance(df, pd.DataFrame):
+            # column by column from numpy, to_pandas()/from_pandas() would need pyarrow
+            df = pl.DataFrame({str(c): df[c].to_numpy() for c in df.columns if c != SAMPLE_COLUMN})
+        else:
+            df = df.drop(SAMPLE_COLUMN, strict=False)
+        columns = df.columns
+        if self.columns is None:
+            self.columns = columns
+        elif columns != self.columns:
+            raise ValueError(f"Sample {sample_id} has different columns than the first sample of the store")
+
+        file_name = f"part-{len(self.samples):05d}.parquet"
+        df.select(
+            pl.all().cast(pl.Float32),
+            pl.lit(str(sample_id)).cast(pl.Categorical).alias(SAMPLE_COLUMN),
+        ).write_parquet(
+            os.path.join(self.path, file_name),
+            compression="zstd",
+            compression_level=EVENT_STORE_COMPRESSION_LEVEL,
+            row_group_size=self.chunk_rows,
+            statistics=True,
+        )
+        self.samples.append({
+            "sample_id": str(sample_id),
+            "file": file_name,
+            "offset": self.n_events,
+            "n_events": df.height,
+        })
+        self.n_events += df.height
+
+    def close(self):
+        """
+        Writes the manifest, the store is readable from then on.
+
+        Returns:
+            str: Path of the store.
+        """
+        manifest = {
+            "version": STORE_VERSION,
+            "columns": self.columns or [],
+            "sample_column": SAMPLE_COLUMN,
+            "n_events": self.n_events,
+            "chunk_rows": self.chunk_rows,
+            "samples": self.samples,
+        }
+        tmp_path = os.path.join(self.path, MANIFEST_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST_FILE))
+        logger.info(f"Event store {self.path}: {self.n_events} events of {len(self.samples)} samples")
+        return self.path
+
+
+def write_event_store(df, path, chunk_rows=None):
+    """
+    Writes a DataFrame of events to a store, one part per value of the sample column (a single
+    "all" sample when the column is missing), in the order of first appearance.
+
+    Returns:
+        str: Path of the store.
+    """
+    writer = EventStoreWriter(path, chunk_rows)
+    if SAMPLE_COLUMN in df.columns:
+        sample_ids = df[SAMPLE_COLUMN].astype(str)
+        # groups keep their rows in order, the store keeps the row order of contiguous samples
+        for sample_id, rows in sample_ids.groupby(sample_ids, sort=False).indices.items():
+            writer.write_sample(sample_id, df.iloc[rows])
+    else:
+        writer.write_sample("all", df)
+    return writer.close()
+
+
+def is_event_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST_FILE))
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        return json.load(f)
+
+
+def scan_events(path, columns=None, samples=None):
+    """
+    Lazy polars frame of the events of a store, limited to some columns and samples. Only the
+    Parquet files of the requested samples and the requested column chunks are read.
+
+    Args:
+        path (str): Path of the store.
+        columns (list): Marker columns to read, all by default; the sample column is always included.
+        samples (list): Sample ids to read, all by default.
+
+    Returns:
+        pl.LazyFrame: The events, sample column as an Enum of the samples of the store.
+    """
+    manifest = read_manifest(path)
+    parts = manifest["samples"]
+    if samples is not None:
+        wanted = {str(s) for s in samples}
+        parts = [p for p in parts if p["sample_id"] in wanted]
+    if columns is None:
+        columns = manifest["columns"]
+    columns = [c for c in columns if c != SAMPLE_COLUMN]
+    sample_type = pl.Enum([p["sample_id"] for p in manifest["samples"]])
+    if not parts:
+        schema = {c: pl.Float32 for c in columns}
+        schema[SAMPLE_COLUMN] = sample_type
+        return pl.LazyFrame(schema=schema)
+    return pl.scan_parquet([os.path.join(path, p["file"]) for p in parts]).select(
+        *columns, pl.col(SAMPLE_COLUMN).cast(pl.Utf8).cast(sample_type)
+    )
+
+
+def read_event_block(path, sample_id, columns=None, offset=0, length=None):
+    """
+    Events of one sample of a store as a float32 matrix, limited to a row range of the sample,
+    so that workers read only the block they process.
+
+    Returns:
+        np.ndarray: float32 array of shape (rows, columns), NaN replaced by 0.
+    """
+    frame = scan_events(path, columns, [sample_id]).drop(SAMPLE_COLUMN).slice(offset, length).collect()
+    return np.nan_to_num(frame.to_numpy().astype(np.float32, copy=False), copy=False)
+
+
+def _to_pandas(df):
+    """
+    pandas DataFrame of an events frame without pyarrow: numeric columns through numpy and the
+    sample column as a pandas Categorical built from the Enum codes.
+    """
+    data = {}
+    for name, dtype in df.schema.items():
+        series = df[name]
+        if isinstance(dtype, pl.Enum):
+            data[name] = pd.Categorical.from_codes(
+                series.to_physical().to_numpy().astype(np.int64), categories=dtype.categories.to_list()
+            )
+        else:
+            data[name] = series.to_numpy()
+    return pd.DataFrame(data)
+
+
+def label_dtype(labels):
+    """
+    Smallest integer type of a labeling: int16 up to 32767 labels, int32 above.
+    """
+    labels = np.asarray(labels)
+    if labels.size == 0 or (labels.min() >= np.iinfo(np.int16).min and labels.max() <= np.iinfo(np.int16).max):
+        return np.int16
+    return np.int32
+
+
+def write_column_set(path, base_path, columns, **metadata):
+    """
+    Writes results derived from the events (an embedding, cluster labels) as a column set: a
+    folder with one .npy file per column, in the row order of a base store, and a manifest with
+    the base path. Nothing of the base is copied, the columns join to it by row index; the base
+    may itself be a column set, so that a labeling of an embedding reads as events, embedding
+    and labels.
+
+    Args:
+        path (str): Folder of the column set.
+        base_path (str): Event store, column set (or legacy CSV file) the rows belong to.
+        columns (dict): Column name -> array of one value per event of the base, stored with its
+            dtype (float32 for an embedding, see label_dtype for labels).
+        metadata: Other entries of the manifest.
+
+    Returns:
+        str: Path of the column set.
+    """
+    os.makedirs(path, exist_ok=True)
+    entries = []
+    n_events = None
+    for name, values in columns.items():
+        values = np.asarray(values)
+        if n_events is None:
+            n_events = len(values)
+        elif len(values) != n_events:
+            raise ValueError(f"Column {name} has {len(values)} rows, {n_events} expected")
+        file_name = f"{name}.npy"
+        np.save(os.path.join(path, file_name), values)
+        entries.append({"name": str(name), "file": file_name, "dtype": values.dtype.name})
+    manifest = {
+        "version": STORE_VERSION,
+        "base_path": base_path,
+        "n_events": n_events or 0,
+        "columns": entries,
+        **metadata,
+    }
+    tmp_path = os.path.join(path, COLUMN_SET_MANIFEST_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(path, COLUMN_SET_MANIFEST_FILE))
+    logger.info(f"Column set {path}: {[e['name'] for e in entries]} of {manifest['n_events']} events of {base_path}")
+    return path
+
+
+def is_column_set(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, COLUMN_SET_MANIFEST_FILE))
+
+
+def read_column_manifest(path):
+    with open(os.path.join(path, COLUMN_SET_MANIFEST_FILE)) as f:
+        return json.load(f)
+
+
+def read_columns(path, names=None):
+    """
+    Columns of a column set, memory-mapped.
+
+    Returns:
+        dict: Column name -> read-only array in the row order of the base.
+    """
+    entries = read_column_manifest(path)["columns"]
+    if names is not None:
+        entries = [e for e in entries if e["name"] in set(names)]
+    return {e["name"]: np.load(os.path.join(path, e["file"]), mmap_mode="r") for e in entries}
+
+
+def sample_rows(path, samples):
+    """
+    Rows, in store order, of some samples of a store.
+    """
+    wanted = {str(s) for s in samples}
+    parts = [p for p in read_manifest(path)["samples"] if p["sample_id"] in wanted]
+    if not parts:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate([np.arange(p["offset"], p["offset"] + p["n_events"]) for p in parts])
+
+
+def base_store(path):
+    """
+    Event store at the root of a chain of column sets, None for a CSV base.
+    """
+    while is_column_set(path):
+        path = read_column_manifest(path)["base_path"]
+    return path if is_event_store(path) else None
+
+
+def read_events(path, columns=None, samples=None):
+    """
+    Reads events as a pandas DataFrame from a store, from a column set joined to its base or
+    from a legacy CSV file, so that the steps accept the outputs of older pipeline runs.
+
+    Args:
+        path (str): Event store folder, column set folder or CSV file.
+        columns (list): Columns to read, all by default. For a store the sample column is always
+            returned; for a CSV only the listed columns are parsed.
+        samples (list): Sample ids to read, all by default.
+
+    Returns:
+        pd.DataFrame: The events.
+    """
+    if is_column_set(path):
+        manifest = read_column_manifest(path)
+        names = [e["name"] for e in manifest["columns"]]
+        if columns is not None:
+            names = [n for n in names if n in set(columns)]
+        base_columns = None if columns is None else [c for c in columns if c not in set(names)]
+        df = read_events(manifest["base_path"], base_columns, samples)
+        rows = None
+        if samples is not None:
+            store = base_store(path)
+            if store is not None:
+                rows = sample_rows(store, samples)
+            else:
+                sample_ids = read_events(manifest["base_path"], [SAMPLE_COLUMN])[SAMPLE_COLUMN].astype(str)
+                rows = np.flatnonzero(sample_ids.isin({str(s) for s in samples}).to_numpy())
+        for name, values in read_columns(path, names).items():
+            df[name] = np.asarray(values) if rows is None else values[rows]
+        return df
+    if is_event_store(path):
+        return _to_pandas(scan_events(path, columns, samples).collect())
+    usecols = None
+    if columns is not None:
+        header = pd.read_csv(path, nrows=0).columns
+        usecols = [c for c in header if c in set(columns) or c == SAMPLE_COLUMN]
+    df = pd.read_csv(path, usecols=usecols)
+    if samples is not None and SAMPLE_COLUMN in df.columns:
+        df = df[df[SAMPLE_COLUMN].astype(str).isin({str(s) for s in samples})].reset_index(drop=True)
+    return df
+
+
+def scan_table(path):
+    """
+    Lazy polars frame of a store, of a column set joined to its base (the base columns, then
+    its own) or of a CSV file, for the readers that page through a result instead of loading it.
+    """
+    if is_column_set(path):
+        columns = pl.LazyFrame({name: np.asarray(values) for name, values in read_columns(path).items()})
+        return pl.concat([scan_table(read_column_manifest(path)["base_path"]), columns], how="horizontal")
+    if is_event_store(path):
+        return scan_events(path)
+    return pl.scan_csv(path, infer_schema_length=10000)
+
+
+def event_columns(path):
+    """
+    Columns of a store, of a column set with its base or of a CSV file, without the sample column.
+    """
+    if is_column_set(path):
+        manifest = read_column_manifest(path)
+        return event_columns(manifest["base_path"]) + [e["name"] for e in manifest["columns"]]
+    if is_event_store(path):
+        return list(read_manifest(path)["columns"])
+    return [c for c in pd.read_csv(path, nrows=0).columns if c != SAMPLE_COLUMN]
@@ -0,0 +1,301 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+import multiprocessing
+import numpy as np
+import pandas as pd
+import flowkit as fk
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dotenv import load_dotenv
+# relative, so that the copies of the two services are identical (see tests/test_shared_modules.py)
+from . import fcs_reader
+
+# set up logging
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# one folder per FCS content hash with the decoded events, shared by the pipeline and the flow cytometry service
+FCS_CACHE_PATH = os.getenv("FCS_CACHE_PATH") or os.path.join(
+    os.getenv("FLOW_CYTOMETRY_SAVE_PATH") or "generated_files", "fcs_cache"
+)
+FCS_PARSE_WORKERS = int(os.getenv("FCS_PARSE_WORKERS", 0)) or None
+# size above which the least recently used entries are removed, 0 keeps every entry
+FCS_CACHE_MAX_BYTES = int(float(os.getenv("FCS_CACHE_MAX_GB", 100)) * 1024 ** 3)
+
+METADATA_FILE = "channels.json"
+
+_file_digests = {}
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    SHA-256 of a file, kept per (path, size, mtime) for the lifetime of the process.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in _file_digests:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+        _file_digests[key] = digest.hexdigest()
+    return _file_digests[key]
+
+
+def entry_path(digest, cache_dir=None):
+    return os.path.join(cache_dir or FCS_CACHE_PATH, digest)
+
+
+def _spill(metadata):
+    # the spillover keyword has different names (and cases) across FCS versions and vendors
+    metadata = {key.lower(): value for key, value in metadata.items()}
+    for key in ("spill", "spillover", "$spillover"):
+        if metadata.get(key):
+            return metadata[key]
+    return None
+
+
+def parse_fcs(fcs_file_path):
+    """
+    Decodes an FCS file with flowkit.
+
+    Returns:
+        tuple: (raw events float32 array, compensated events float32 array or None when the
+            file has no spillover matrix, metadata dict with pnn, pns and spill)
+    """
+    sample = fk.Sample(fcs_file_path)
+    raw = np.ascontiguousarray(sample.get_events(source="raw"), dtype=np.float32)
+    spill = _spill(sample.metadata)
+    comp = None
+    if spill:
+        try:
+            sample.apply_compensation(spill)
+            comp = np.ascontiguousarray(sample.get_events(source="comp"), dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"Could not compensate {fcs_file_path}: {e}")
+    metadata = {
+        "pnn": list(sample.pnn_labels),
+        "pns": [label or "" for label in sample.pns_labels],
+        "spill": spill,
+        "n_events": int(raw.shape[0]),
+        "sample_id": os.path.basename(fcs_file_path),
+    }
+    return raw, comp, metadata
+
+
+def write_native(fcs_file_path, folder):
+    """
+    Decodes an FCS file with the memory-mapped reader straight into raw.npy (and comp.npy),
+    a block of events at a time, so the memory used does not grow with the file.
+
+    Returns:
+        dict: Metadata of the file, like parse_fcs.
+    """
+    fcs_metadata = fcs_reader.read_fcs_metadata(fcs_file_path)
+    shape = (fcs_metadata["n_events"], fcs_metadata["n_channels"])
+    spill = _spill(fcs_metadata["keywords"])
+    spill_matrix = None
+    if spill:
+        try:
+            spill_matrix = fcs_reader.spillover_matrix(spill, fcs_metadata["pnn"])
+            np.linalg.inv(spill_matrix[1])
+        except Exception as e:
+            logger.warning(f"Could not compensate {fcs_file_path}: {e}")
+            spill_matrix = None
+    raw = np.lib.format.open_memmap(os.path.join(folder, "raw.npy"), mode="w+", dtype=np.float32, shape=shape)
+    comp = None
+    if spill_matrix is not None:
+        comp = np.lib.format.open_memmap(os.path.join(folder, "comp.npy"), mode="w+", dtype=np.float32, shape=shape)
+    for start, events in fcs_reader.iter_fcs_chunks(fcs_file_path, metadata=fcs_metadata):
+        end = start + events.shape[0]
+        raw[start:end] = events
+        if comp is not None:
+            comp[start:end] = fcs_reader.compensate(events, *spill_matrix)
+    raw.flush()
+    if comp is not None:
+        comp.flush()
+    return {
+        "pnn": fcs_metadata["pnn"],
+        "pns": fcs_metadata["pns"],
+        "spill": spill,
+        "n_events": shape[0],
+        "sample_id": os.path.basename(fcs_file_path),
+    }
+
+
+def cache_fcs(fcs_file_path, cache_dir=None):
+    """
+    Makes sure the events of an FCS file are in the cache, decoding it when they are not with
+    the memory-mapped reader, or with flowkit for the layouts it does not handle. Entries are
+    written in a temporary folder and renamed, so concurrent workers never see a
+    partial entry.
+
+    Returns:
+        str: Folder of the cache entry.
+    """
+    digest = file_digest(fcs_file_path)
+    path = entry_path(digest, cache_dir)
+    metadata_file = os.path.join(path, METADATA_FILE)
+    if os.path.exists(metadata_file):
+        try:
+            # the modification time of the metadata is the last use of the entry, see prune_cache
+            os.utime(metadata_file)
+        except OSError:
+            pass
+        return path
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    try:
+        metadata = write_native(fcs_file_path, tmp_path)
+    except (ValueError, KeyError) as e:
+        logger.info(f"Decoding {fcs_file_path} with flowkit: {e}")
+        for file_name in ("raw.npy", "comp.npy"):
+            if os.path.exists(os.path.join(tmp_path, file_name)):
+                os.remove(os.path.join(tmp_path, file_name))
+        raw, comp, metadata = parse_fcs(fcs_file_path)
+        np.save(os.path.join(tmp_path, "raw.npy"), raw)
+        if comp is not None:
+            np.save(os.path.join(tmp_path, "comp.npy"), comp)
+    metadata["digest"] = digest
+    with open(os.path.join(tmp_path, METADATA_FILE), "w") as f:
+        json.dump(metadata, f)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # another process cached the same file first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    prune_cache(cache_dir=cache_dir, keep=(path,))
+    return path
+
+
+def prune_cache(max_bytes=None, cache_dir=None, keep=()):
+    """
+    Removes the least recently used entries until the cache holds at most max_bytes. The
+    metadata file of an entry goes first, so that readers decode the file again instead of
+    finding a partial entry; the arrays already memory-mapped stay readable.
+
+    Args:
+        max_bytes (int): Size of the cache, FCS_CACHE_MAX_BYTES by default; 0 keeps every entry.
+        keep (tuple): Entry folders never removed, e.g. the one just written.
+
+    Returns:
+        int: Number of removed entries.
+    """
+    max_bytes = FCS_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    cache_dir = cache_dir or FCS_CACHE_PATH
+    if not max_bytes or not os.path.isdir(cache_dir):
+        return 0
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            last_used = os.stat(os.path.join(path, METADATA_FILE)).st_mtime
+            size = sum(f.stat().st_size for f in os.scandir(path))
+        except OSError:
+            # entries being written or removed by another worker
+            continue
+        entries.append((last_used, size, path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(os.path.join(path, METADATA_FILE))
+        except OSError:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed += 1
+    if removed:
+        logger.info(f"Removed {removed} FCS cache entries, {total} bytes left in {cache_dir}")
+    return removed
+
+
+def _cache_worker(args):
+    fcs_file_path, cache_dir = args
+    return cache_fcs(fcs_file_path, cache_dir)
+
+
+def cache_many(fcs_file_paths, max_workers=None, cache_dir=None):
+    """
+    Caches many FCS files, decoding (and hashing) them in a process pool, or in a thread pool
+    in a daemonic process (a child of Celery's prefork pool), which cannot start processes.
+
+    Returns:
+        list: Cache entry folder of every file, in input order.
+    """
+    paths = list(fcs_file_paths)
+    workers = min(max_workers or FCS_PARSE_WORKERS or os.cpu_count() or 1, len(paths))
+    if workers <= 1:
+        return [cache_fcs(path, cache_dir) for path in paths]
+    executor_type = ThreadPoolExecutor if multiprocessing.current_process().daemon else ProcessPoolExecutor
+    with executor_type(max_workers=workers) as executor:
+        return list(executor.map(_cache_worker, [(path, cache_dir) for path in paths]))
+
+
+def read_metadata(entry):
+    with open(os.path.join(entry, METADATA_FILE)) as f:
+        return json.load(f)
+
+
+def load_events(fcs_file_path, source="raw", cache_dir=None):
+    """
+    Events of an FCS file from the cache, memory-mapped read only.
+
+    Args:
+        fcs_file_path (str): Path to the FCS file.
+        source (str): raw or comp; comp falls back to raw for files without spillover matrix.
+
+    Returns:
+        tuple: (np.memmap of shape (events, channels), metadata dict)
+    """
+    for attempt in range(2):
+        entry = cache_fcs(fcs_file_path, cache_dir)
+        try:
+            metadata = read_metadata(entry)
+            file_name = "comp.npy" if source == "comp" and os.path.exists(os.path.join(entry, "comp.npy")) else "raw.npy"
+            return np.load(os.path.join(entry, file_name), mmap_mode="r"), metadata
+        except FileNotFoundError:
+            # the entry was pruned by another worker in between, it is decoded again
+            if attempt:
+                raise
+
+
+def events_dataframe(fcs_file_path, source="raw", subsample=None, seed=0, col_multi_index=True, cache_dir=None,
+                     channels=None):
+    """
+    DataFrame of the events of an FCS file, with the columns of flowkit's Sample.as_dataframe.
+
+    Args:
+        subsample (int): Number of random events to return, all by default; only the selected
+            rows are read from the memory-mapped matrix.
+        col_multi_index (bool): (pnn, pns) MultiIndex columns, or PnN labels only.
+        channels (list): Channels (PnN or PnS labels) to return, all by default; only their
+            columns are copied out of the matrix.
+
+    Returns:
+        pd.DataFrame: The events.
+    """
+    events, metadata = load_events(fcs_file_path, source, cache_dir)
+    if subsample and subsample < events.shape[0]:
+        rows = np.sort(np.random.default_rng(seed).choice(events.shape[0], subsample, replace=False))
+        events = events[rows]
+    pnn, pns = metadata["pnn"], metadata["pns"]
+    if channels is not None:
+        indices = fcs_reader.channel_indices(metadata, channels)
+        events = events[:, indices]
+        pnn, pns = [pnn[i] for i in indices], [pns[i] for i in indices]
+    if col_multi_index:
+        columns = pd.MultiIndex.from_arrays([pnn, pns], names=["pnn", "pns"])
+    else:
+        columns = pnn
+    return pd.DataFrame(np.asarray(events), columns=columns)
+
@@ -1,18 +1,24 @@
-import flowkit as fk
 import pandas as pd
 import umap
 from typing import List, Dict
 import flowsom as fs 
 import anndata as ad
 import phenograph
-from sklearn.preprocessing import StandardScaler
 import numpy as np
 import scanpy as sc
 import matplotlib.pyplot as plt
+import json
+from sklearn.metrics import adjusted_rand_score
 import uuid
 from dotenv import load_dotenv
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from app.models import flow_cytometry
+from app.flow_cytometry_functions import event_store, fcs_cache, knn_graph, density_plot, cluster_stats
+from scipy.cluster import hierarchy
+from app.utils.instrumentation import count_items
+from app.utils.pools import in_daemon_process, worker_pool
 import logging
 
 
@@ -25,6 +31,17 @@ load_dotenv()
 # Define the path to the FCS files  
 FLOW_CYTOMETRY_SAVE_PATH = os.getenv("FLOW_CYTOMETRY_SAVE_PATH")
 
+# UMAP is fitted on at most UMAP_FIT_EVENTS events, the others are embedded with transform()
+UMAP_FIT_EVENTS = int(os.getenv("UMAP_FIT_EVENTS", 200000))
+UMAP_TRANSFORM_CHUNK_ROWS = int(os.getenv("UMAP_TRANSFORM_CHUNK_ROWS", 100000))
+UMAP_TRANSFORM_WORKERS = int(os.getenv("UMAP_TRANSFORM_WORKERS", 0)) or None
+
+LEIDEN_SWEEP_RESOLUTIONS = [0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0]
+
+# FlowSOM is trained on at most FLOWSOM_TRAIN_EVENTS events, all the events are then mapped in chunks
+FLOWSOM_TRAIN_EVENTS = int(os.getenv("FLOWSOM_TRAIN_EVENTS", 200000))
+FLOWSOM_CHUNK_ROWS = int(os.getenv("FLOWSOM_CHUNK_ROWS", 100000))
+
 
 def serialize_fcs_data(df: pd.DataFrame) -> str:
     """
@@ -79,46 +96,35 @@ def deserialize_fcs_data(json_str: str) -> pd.DataFrame:
 
 def read_batch_fcs_files(file_paths: List[str]) -> str:
     """
-    Reads multiple FCS files, concatenates their DataFrames, and returns a serialized JSON string.
+    Reads multiple FCS files into a columnar event store (see event_store.EventStoreWriter),
+    one sample at a time, and returns the path of the store. The files are decoded in parallel
+    into the FCS cache, files already cached are not parsed again.
     
     Args:
         file_paths (list): List of paths to FCS files
         
     Returns:
-        str: Serialized JSON string of the concatenated DataFrame
+        str: Path of the event store with the events of all the files
     """
     try:
-        # Load all samples using FlowKit
-        samples = fk.load_samples(file_paths)
-        
-        # Process each sample and concatenate the raw data into a single DataFrame
-        dataframes = []
-        for sample in samples:
-            # Convert to DataFrame without multi-index
-            df = sample.as_dataframe(source='raw', col_multi_index=False)
+        unique_id = str(uuid.uuid4())
+        json_str = os.path.join(FLOW_CYTOMETRY_SAVE_PATH, f"events_{unique_id}")
+        writer = event_store.EventStoreWriter(json_str)
+        fcs_cache.cache_many(file_paths)
+        
+        # only one sample is loaded at a time, its events are written to the store right away
+        for file_path in file_paths:
+            # DataFrame without multi-index from the memory-mapped events of the cache
+            df = fcs_cache.events_dataframe(file_path, source='raw', col_multi_index=False)
             print("DataFrame shape:", df.shape, "\n", "DataFrame columns:", df.columns)
             
-            # add the source file
-            df['source_file'] = sample
-            
             # remove NaN values
             df = df.dropna()
-            dataframes.append(df)
+            writer.write_sample(os.path.basename(file_path), df)
             del df
         
-        # Concatenate all DataFrames into a single DataFrame
-        print("\n\n creating the concatenated df\n\n")
-        concatenated_df = pd.concat(dataframes, ignore_index=True)
-        del dataframes
-        del samples
-        
-        # Serialize the concatenated DataFrame to JSON
-        print("\n\n\n concatenating the df into a json object \n\n")
-        unique_id = str(uuid.uuid4())
-        json_str = os.path.join(FLOW_CYTOMETRY_SAVE_PATH, f"concatenated_df_{unique_id}.csv")
-        concatenated_df.to_csv(json_str, index=False)
-        
-        del concatenated_df
+        writer.close()
+        count_items("events", writer.n_events)
         
         logger.info("Read batch FCS files") # insert the Chain ID
         
@@ -130,67 +136,167 @@ def read_batch_fcs_files(file_paths: List[str]) -> str:
         print(f"Error processing FCS files: {str(e)}")
         raise
 
-def umap_dimensionality_reduction(json_str: str, data2="") -> dict:
-    try:
-        n_components = 2
-        print("\n starting dimensionality reduction analysis\n\n")
-        df = pd.read_csv(json_str)
-        
-        df.fillna(0, inplace=True)
+def stratified_sample(sample_sizes, n_events, seed=0):
+    """
+    Draws n_events rows spread over the samples in proportion to their size (largest remainder
+    rounding), so that every sample is represented like in the whole dataset.
 
-        # Store the source_file column separately
-        source_files = None
-        if 'source_file' in df.columns:
-            source_files = df['source_file']
-            df = df.drop('source_file', axis=1)
-
-        # Perform UMAP dimensionality reduction
-        reducer = umap.UMAP(n_components=n_components)
-        reduced_data = reducer.fit_transform(df)
-
-        # Create DataFrames
-        reduced_df = pd.DataFrame(
-            reduced_data,
-            columns=[f'UMAP_{i+1}' for i in range(n_components)]
-        )
-        
-        del reduced_data
+    Args:
+        sample_sizes (list): Number of events of every sample.
+        n_events (int): Number of rows to draw.
 
-        # Add source_file back to the DataFrames if it existed
-        if source_files is not None:
-            reduced_df['source_file'] = source_files
-            df['source_file'] = source_files
+    Returns:
+        list: Sorted row indices within every sample, one array per sample.
+    """
+    sizes = np.asarray(sample_sizes, dtype=np.int64)
+    total = int(sizes.sum())
+    if n_events >= total:
+        return [np.arange(size) for size in sizes]
+    quotas = sizes * n_events / total
+    counts = np.floor(quotas).astype(np.int64)
+    remainder = n_events - int(counts.sum())
+    counts[np.argsort(counts - quotas, kind="stable")[:remainder]] += 1
+    rng = np.random.default_rng(seed)
+    return [np.sort(rng.choice(size, count, replace=False)) for size, count in zip(sizes, counts)]
 
-        full_df = pd.concat([df.reset_index(drop=True), reduced_df], axis=1)
 
-        # Generate unique filenames
+_umap_reducer = None
+
+
+def _init_umap_worker(reducer):
+    global _umap_reducer
+    _umap_reducer = reducer
+
+
+def _umap_transform_block(block):
+    """
+    Embeds a block of events with the fitted reducer of the worker.
+    """
+    return _umap_reducer.transform(block).astype(np.float32)
+
+
+def _bounded_map(executor, function, items, max_pending):
+    """
+    Like executor.map, but items are consumed lazily and at most max_pending are submitted at a
+    time, so that only a few blocks are in memory. Results are yielded in order.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def umap_dimensionality_reduction(json_str: str, data2="", progress=None) -> dict:
+    """
+    UMAP embedding of the events of a store. Up to fit_events events, UMAP is fitted on all of
+    them; above that it is fitted on a per-sample stratified subsample and the other events are
+    embedded with transform() in blocks, in parallel worker processes (threads in a Celery
+    worker). Only one block per worker and one sample at a time are held in memory besides the
+    embedding, which is saved as a column set of the store (see event_store.write_column_set).
+
+    Args:
+        json_str (str): Event store (or legacy CSV file) of the events.
+        data2 (dict): Step parameters: fit_events, seed (of the subsample), chunk_rows, n_workers and
+            n_neighbors. When UMAP is fitted on all the events it uses the kNN graph of the store
+            (see knn_graph.ensure_knn_graph) instead of searching the neighbors again.
+        progress (callable): Called as progress(done, total) with the embedded events.
+
+    Returns:
+        dict: embedding_path (UMAP_1 and UMAP_2 columns), original_data_path (the store) and
+            full_data_path (the embedding too, read with event_store.read_events it joins the store).
+    """
+    try:
+        n_components = 2
+        umap_columns = [f'UMAP_{i+1}' for i in range(n_components)]
+        parameters = data2 if isinstance(data2, dict) else {}
+        fit_events = int(parameters.get('fit_events') or UMAP_FIT_EVENTS)
+        seed = int(parameters.get('seed', 0))
+        chunk_rows = int(parameters.get('chunk_rows') or UMAP_TRANSFORM_CHUNK_ROWS)
+        n_workers = int(parameters.get('n_workers') or UMAP_TRANSFORM_WORKERS or os.cpu_count() or 1)
+        n_neighbors = int(parameters.get('n_neighbors') or knn_graph.KNN_GRAPH_NEIGHBORS)
+        print("\n starting dimensionality reduction analysis\n\n")
+
         unique_id = str(uuid.uuid4())
-        reduced_data_path = os.path.join(
-            FLOW_CYTOMETRY_SAVE_PATH, f"reduced_data_{unique_id}.csv"
-        )
-        original_data_path = os.path.join(
-            FLOW_CYTOMETRY_SAVE_PATH, f"original_data_{unique_id}.csv"
-        )
-        full_data_path = os.path.join(
-            FLOW_CYTOMETRY_SAVE_PATH, f"full_data_{unique_id}.csv"
+        # the events are already in a store, it is the original data; older runs pass a CSV
+        if event_store.is_event_store(json_str):
+            original_data_path = json_str
+        else:
+            original_data_path = os.path.join(FLOW_CYTOMETRY_SAVE_PATH, f"original_data_{unique_id}")
+            event_store.write_event_store(event_store.read_events(json_str), original_data_path)
+
+        manifest = event_store.read_manifest(original_data_path)
+        columns = manifest['columns']
+        samples = manifest['samples']
+        n_events = manifest['n_events']
+        embedding = np.empty((n_events, n_components), dtype=np.float32)
+
+        # fit on the stratified subsample, read one sample at a time
+        fit_rows = stratified_sample([s['n_events'] for s in samples], fit_events, seed)
+        fit_data = np.concatenate([
+            event_store.read_event_block(original_data_path, s['sample_id'], columns)[rows]
+            for s, rows in zip(samples, fit_rows)
+        ]) if samples else np.empty((0, len(columns)), dtype=np.float32)
+        print(f"Fitting UMAP on {len(fit_data)} of {n_events} events")
+        # the graph indexes all the events of the store, a subsample searches its own neighbors
+        precomputed_knn = (None, None, None)
+        if len(fit_data) == n_events and n_events > n_neighbors:
+            precomputed_knn = knn_graph.ensure_knn_graph(original_data_path, n_neighbors,
+                                                         build_neighbors=parameters.get('graph_neighbors'))
+        reducer = umap.UMAP(n_components=n_components, n_neighbors=n_neighbors, precomputed_knn=precomputed_knn)
+        fit_embedding = reducer.fit_transform(fit_data).astype(np.float32)
+        if len(fit_embedding) < n_events:
+            # compiles the numba code of transform() once, the forked workers inherit it
+            reducer.transform(fit_data[:100])
+        del fit_data
+
+        if len(fit_embedding) < n_events:
+            blocks = [(s, start) for s in samples for start in range(0, s['n_events'], chunk_rows)]
+            # the blocks are read here and sent to the workers, which only run the numba code
+            block_data = (
+                event_store.read_event_block(original_data_path, s['sample_id'], columns, start, chunk_rows)
+                for s, start in blocks
+            )
+            n_workers = min(n_workers, len(blocks))
+            done = 0
+            # threads inside a daemonic Celery worker process, which cannot start processes
+            with worker_pool(n_workers, initializer=_init_umap_worker, initargs=(reducer,)) as executor:
+                results = _bounded_map(executor, _umap_transform_block, block_data, 2 * n_workers)
+                for (s, start), block_embedding in zip(blocks, results):
+                    offset = s['offset'] + start
+                    embedding[offset:offset + len(block_embedding)] = block_embedding
+                    done += len(block_embedding)
+                    print(f"UMAP transform: {done}/{n_events} events")
+                    if progress is not None:
+                        progress(done, n_events)
+
+        # the fitted events keep their training embedding
+        fitted = 0
+        for s, rows in zip(samples, fit_rows):
+            embedding[s['offset'] + rows] = fit_embedding[fitted:fitted + len(rows)]
+            fitted += len(rows)
+        del fit_embedding
+        count_items("events", n_events)
+        if progress is not None:
+            progress(n_events, n_events)
+
+        # the embedding is the only new data: a float32 column set joined to the store by row,
+        # it reads as the events with their UMAP coordinates
+        embedding_path = event_store.write_column_set(
+            os.path.join(FLOW_CYTOMETRY_SAVE_PATH, f"umap_embedding_{unique_id}"),
+            original_data_path,
+            {column: embedding[:, j] for j, column in enumerate(umap_columns)},
         )
-
-        # Save DataFrames to CSV files
-        reduced_df.to_csv(reduced_data_path, index=False)
-        df.to_csv(original_data_path, index=False)
-        full_df.to_csv(full_data_path, index=False)
+        del embedding
 
         logger.info("Performed UMAP dimensionality reduction")
 
-        # Free up memory by deleting DataFrames
-        del df
-        del reduced_df
-        del full_df
-
         return {
-            "reduced_data_path": reduced_data_path,
+            "embedding_path": embedding_path,
             "original_data_path": original_data_path,
-            "full_data_path": full_data_path
+            "full_data_path": embedding_path
         }
     except Exception as e:
         logger.info(f"Error performing UMAP dimensionality reduction: {str(e)}")
@@ -198,55 +304,55 @@ def umap_dimensionality_reduction(json_str: str, data2="") -> dict:
         raise
 
 
-def louvain_clustering(json_str: str, k_neighbors: int = 2, resolution: float = 0.1) -> str:
+def louvain_clustering(data_paths: dict, k_neighbors: int = 30, resolution: float = 0.2) -> dict:
+    """
+    PhenoGraph (Jaccard graph + Louvain) clustering on the shared kNN graph of the events.
+
+    Args:
+        data_paths (dict): Output of the UMAP step (or event store path).
+        k_neighbors (int): Neighbors of the kNN graph.
+        resolution (float): Kept for the step parameters, Louvain in PhenoGraph has no resolution.
+
+    Returns:
+        dict: clustering_result_path (column set of the Louvain_Cluster labels), cluster_column,
+            full_data_path and original_data_path.
+    """
     try:
-        # default values
-        k_neighbors = 1000
-        resolution = 0.2
-        
-        # Deserialize the JSON string to a DataFrame
-        df = deserialize_fcs_data(json_str)
-        
-        # Store the source_file column separately
-        source_files = None
-        if 'source_file' in df.columns:
-            source_files = df['source_file']
-            df = df.drop('source_file', axis=1)
-        
-        # Scale the data
-        scaler = StandardScaler()
-        data_scaled = scaler.fit_transform(df)
-        
-        # Perform Louvain clustering
+        parameters = k_neighbors if isinstance(k_neighbors, dict) else {}
+        if isinstance(k_neighbors, dict):
+            k_neighbors = k_neighbors.get('k_neighbors', 30)
+        if not isinstance(data_paths, dict):
+            data_paths = {"original_data_path": data_paths, "full_data_path": data_paths}
+        store_path = data_paths['original_data_path']
+
+        # the graph of the store is built once and shared with UMAP and Leiden
+        indices, _ = knn_graph.ensure_knn_graph(store_path, int(k_neighbors) + 1,
+                                                build_neighbors=parameters.get('graph_neighbors'))
         communities, graph, Q = phenograph.cluster(
-            data_scaled,
+            knn_graph.knn_matrix(indices),
             clustering_algo='louvain',
-            k=k_neighbors,
-            resolution_parameter=resolution,
             seed=42,  # for reproducibility
         )
-        
-        # Create a DataFrame with the clustering results
-        result_df = pd.DataFrame({
-            'cluster': communities,
-            'modularity': Q
-        })
-        
-        # Add the original coordinates
-        for col in df.columns:
-            result_df[col] = df[col]
-            
-        # Add source_file back if it existed
-        if source_files is not None:
-            result_df['source_file'] = source_files
-        
-        # Serialize the results
-        json_result = result_df.to_json(orient='split', date_format='iso')
-        
-        logger.info("Performed Louvain clustering")
-        
-        return json_result
-    
+        del graph
+
+        # only the labels are written, joined to the events and their embedding by row
+        communities = np.asarray(communities)
+        clustering_result_path = event_store.write_column_set(
+            os.path.join(FLOW_CYTOMETRY_SAVE_PATH, f"clustering_result_{uuid.uuid4()}"),
+            data_paths['full_data_path'],
+            {'Louvain_Cluster': communities.astype(event_store.label_dtype(communities))},
+        )
+        count_items("events", len(communities))
+
+        logger.info(f"Performed Louvain clustering, modularity {Q}")
+
+        return {
+            "clustering_result_path": clustering_result_path,
+            "cluster_column": "Louvain_Cluster",
+            "full_data_path": data_paths['full_data_path'],
+            "original_data_path": store_path
+        }
+
     except Exception as e:
         logger.info(f"Error performing Louvain clustering: {str(e)}")
         print(f"Error performing Louvain clustering: {str(e)}")
@@ -258,43 +364,28 @@ def leiden_clustering(self, data_paths: dict, resolution: float = 1.0) -> dict:
     chain_id = self.request.id
     print(f"Chain ID: {chain_id}")
     try:
-        resolution = 0.3
+        parameters = resolution if isinstance(resolution, dict) else {}
+        resolution = float(parameters.get('resolution', 0.3))
+        n_neighbors = int(parameters.get('n_neighbors') or knn_graph.KNN_GRAPH_NEIGHBORS)
         
         print("Starting Leiden clustering with resolution:", resolution)
 
-        # Load reduced data from file path
-        reduced_df = pd.read_csv(data_paths['reduced_data_path'])
-        full_df = pd.read_csv(data_paths['full_data_path'])
-
-        # Store source_file information
-        source_files = None
-        if 'source_file' in reduced_df.columns:
-            source_files = reduced_df['source_file']
-            reduced_df = reduced_df.drop('source_file', axis=1)
-
-        
-        
-        # Convert to AnnData for clustering
-        adata = sc.AnnData(reduced_df.values)
-        del reduced_df
-        sc.pp.neighbors(adata, use_rep='X')
-        sc.tl.leiden(adata, resolution=resolution)
-        
-        # Add clustering results to full_df
-        full_df['Leiden_Cluster'] = adata.obs['leiden'].values
-
-        # Add source_file back if it existed
-        if source_files is not None:
-            full_df['source_file'] = source_files
-
-        # Save clustering results
-        clustering_result_path = os.path.join(
-            FLOW_CYTOMETRY_SAVE_PATH, f"clustering_result_{uuid.uuid4()}.csv"
+        # Leiden runs on the connectivities of the shared kNN graph of the events, the one UMAP used
+        indices, distances = knn_graph.ensure_knn_graph(data_paths['original_data_path'], n_neighbors,
+                                                        build_neighbors=parameters.get('graph_neighbors'))
+        connectivities = knn_graph.connectivities(indices, distances)
+        del indices, distances
+        labels, modularity = knn_graph.leiden_partition(connectivities, resolution)
+        del connectivities
+        print(f"Leiden clustering: {labels.max() + 1 if len(labels) else 0} clusters, modularity {modularity:.3f}")
+
+        # Save the labels alone, they join to the events and their embedding by row
+        clustering_result_path = event_store.write_column_set(
+            os.path.join(FLOW_CYTOMETRY_SAVE_PATH, f"clustering_result_{uuid.uuid4()}"),
+            data_paths['full_data_path'],
+            {'Leiden_Cluster': labels.astype(event_store.label_dtype(labels))},
         )
-        full_df.to_csv(clustering_result_path, index=False)
-        
-        del adata
-        del full_df
+        count_items("events", len(labels))
         
         # update the pipeline run with the clustering results
         flow_cytometry.FlowCytoPipelineRun.update_by_chain_id(chain_id, {"clustering_result_path": clustering_result_path})
@@ -313,51 +404,150 @@ def leiden_clustering(self, data_paths: dict, resolution: float = 1.0) -> dict:
         raise
 
 
+_sweep_graph = None
+
+
+def _init_sweep_worker(graph):
+    global _sweep_graph
+    _sweep_graph = graph
+
+
+def _sweep_partition(args):
+    resolution, seed = args
+    return knn_graph.leiden_partition(_sweep_graph, resolution, seed)
+
+
+def leiden_resolution_sweep(self, data_paths: dict, parameters=None) -> dict:
+    """
+    Runs Leiden at many resolutions on the kNN graph of the events, loaded once: the graph is
+    shared with worker processes, one resolution each (run in turn inside a daemonic Celery
+    worker process, which cannot start them). The labelings are saved as a column set
+    (one int16/int32 leiden_<resolution> column each, in store row order), with a report of the number of clusters, the modularity and the
+    adjusted Rand index between consecutive resolutions (1 means the labeling did not change).
+
+    Args:
+        data_paths (dict): Paths returned by the UMAP step (or event store path).
+        parameters (dict): resolutions (list), n_neighbors, seed and n_workers.
+
+    Returns:
+        dict: leiden_sweep_path (column set of the labelings), leiden_sweep_report_path and the input paths.
+    """
+    chain_id = self.request.id
+    try:
+        parameters = parameters if isinstance(parameters, dict) else {}
+        if not isinstance(data_paths, dict):
+            data_paths = {"original_data_path": data_paths}
+        resolutions = sorted(float(r) for r in parameters.get('resolutions') or LEIDEN_SWEEP_RESOLUTIONS)
+        n_neighbors = int(parameters.get('n_neighbors') or knn_graph.KNN_GRAPH_NEIGHBORS)
+        seed = int(parameters.get('seed', 0))
+        n_workers = min(int(parameters.get('n_workers') or os.cpu_count() or 1), len(resolutions))
+
+        indices, distances = knn_graph.ensure_knn_graph(data_paths['original_data_path'], n_neighbors,
+                                                        build_neighbors=parameters.get('graph_neighbors'))
+        graph = knn_graph.to_igraph(knn_graph.connectivities(indices, distances))
+        del indices, distances
+
+        if in_daemon_process():
+            # a Celery prefork child cannot start processes: the resolutions run one after the other
+            print(f"Leiden sweep over {len(resolutions)} resolutions in the worker process")
+            partitions = [knn_graph.leiden_partition(graph, resolution, seed) for resolution in resolutions]
+        else:
+            print(f"Leiden sweep over {len(resolutions)} resolutions with {n_workers} workers")
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_sweep_worker,
+                                     initargs=(graph,)) as executor:
+                partitions = list(executor.map(_sweep_partition, [(resolution, seed) for resolution in resolutions]))
+        del graph
+
+        report = []
+        labelings = {}
+        previous = None
+        for resolution, (labels, modularity) in zip(resolutions, partitions):
+            column = f"leiden_{resolution:g}"
+            labelings[column] = labels.astype(event_store.label_dtype(labels))
+            sizes = np.bincount(labels) if len(labels) else np.zeros(0, dtype=np.int64)
+            report.append({
+                "resolution": resolution,
+                "column": column,
+                "labels_file": f"{column}.npy",
+                "n_clusters": int(len(sizes)),
+                "largest_cluster": int(sizes.max()) if len(sizes) else 0,
+                "smallest_cluster": int(sizes.min()) if len(sizes) else 0,
+                "modularity": round(float(modularity), 4),
+                # agreement with the previous (lower) resolution
+                "ari_previous": round(float(adjusted_rand_score(previous, labels)), 4) if previous is not None else None,
+            })
+            previous = labels
+            print(f"Leiden resolution {resolution:g}: {report[-1]['n_clusters']} clusters, "
+                  f"modularity {report[-1]['modularity']}, ARI with previous {report[-1]['ari_previous']}")
+        count_items("events", len(previous) if previous is not None else 0)
+
+        # one column per resolution, joined to the events by row
+        sweep_path = event_store.write_column_set(
+            os.path.join(FLOW_CYTOMETRY_SAVE_PATH, f"leiden_sweep_{uuid.uuid4()}"),
+            data_paths.get('full_data_path') or data_paths['original_data_path'],
+            labelings,
+        )
+        del labelings
+
+        report_path = os.path.join(sweep_path, "sweep_report.json")
+        with open(report_path, "w") as f:
+            json.dump({"n_neighbors": n_neighbors, "seed": seed, "resolutions": report}, f, indent=2)
+
+        result = dict(data_paths)
+        result.update({"leiden_sweep_path": sweep_path, "leiden_sweep_report_path": report_path})
+        flow_cytometry.FlowCytoPipelineRun.update_by_chain_id(chain_id, {
+            "leiden_sweep_path": sweep_path, "leiden_sweep_report_path": report_path
+        })
+        logger.info("Performed Leiden resolution sweep")
+        return result
+    except Exception as e:
+        logger.error(f"Error performing Leiden resolution sweep: {str(e)}")
+        print(f"Error performing Leiden resolution sweep: {str(e)}")
+        raise
+
+
 # out of this leiden clustering generate a dataframe for heatmap based on Columns, and Leiden_Cluster
-def generate_heatmap_data(self, data_paths: dict) -> dict:
+def generate_heatmap_data(self, data_paths: dict, parameters=None, progress=None) -> dict:
+    """
+    Streams the clustered events once through cluster_stats.ClusterStatistics and writes the
+    cluster x marker heatmap (means scaled to [0, 1] per marker), the cluster x sample abundance
+    table and the per-(cluster, sample, marker) statistics (count, mean, sd, approximate median).
+
+    Args:
+        data_paths (dict): Paths returned by a clustering step.
+        parameters (dict): bins (of the median histograms) and chunk_rows.
+        progress (callable): Called as progress(done, total) with the aggregated events.
+
+    Returns:
+        dict: heatmap_data_path, cluster_abundance_path, cluster_statistics_path and the input paths.
+    """
     chain_id = self.request.id
     
     try:
-        # Load clustering results
-        clustering_df = pd.read_csv(data_paths['clustering_result_path'])
-        
-        # drop source file 
-        clustering_df = clustering_df.drop(columns = "source_file")
-        
-        # Drop the UMAP columns
-        clustering_df = clustering_df.drop(columns=['UMAP_1', 'UMAP_2'])
-        
-        # Store Leiden_Cluster separately as it's needed for grouping
-        leiden_clusters = clustering_df['Leiden_Cluster']
-        clustering_df = clustering_df.drop(columns=['Leiden_Cluster'])
-        
-        # Keep only numeric columns
-        numeric_columns = clustering_df.select_dtypes(include=['int64', 'float64']).columns
-        clustering_df = clustering_df[numeric_columns]
-        
-        # Normalize the data to range [0, 1]
-        normalized_df = (clustering_df - clustering_df.min()) / (clustering_df.max() - clustering_df.min())
-        del clustering_df
-        
-        # Add Leiden_Cluster back for grouping
-        normalized_df['Leiden_Cluster'] = leiden_clusters
-        
-        # Generate heatmap data
-        heatmap_data = normalized_df.groupby('Leiden_Cluster').mean()
-        del normalized_df
-        
-        # Save heatmap data
-        heatmap_data_path = os.path.join(
-            FLOW_CYTOMETRY_SAVE_PATH, f"heatmap_data_{uuid.uuid4()}.csv"
+        parameters = parameters if isinstance(parameters, dict) else {}
+        cluster_column = data_paths.get('cluster_column', 'Leiden_Cluster')
+        markers = event_store.event_columns(data_paths['original_data_path'])
+        stats = cluster_stats.cluster_statistics(
+            data_paths['clustering_result_path'], cluster_column, markers,
+            bins=parameters.get('bins'), chunk_rows=parameters.get('chunk_rows'), progress=progress,
         )
+        count_items("events", int(stats.counts.sum()))
         
-        heatmap_data.to_csv(heatmap_data_path)
-        
-        del heatmap_data
+        # Save heatmap data, abundance and statistics
+        unique_id = str(uuid.uuid4())
+        heatmap_data_path = os.path.join(FLOW_CYTOMETRY_SAVE_PATH, f"heatmap_data_{unique_id}.csv")
+        abundance_path = os.path.join(FLOW_CYTOMETRY_SAVE_PATH, f"cluster_abundance_{unique_id}.csv")
+        statistics_path = os.path.join(FLOW_CYTOMETRY_SAVE_PATH, f"cluster_statistics_{unique_id}.csv")
+        stats.heatmap(cluster_column).to_csv(heatmap_data_path)
+        stats.abundance(cluster_column).to_csv(abundance_path)
+        stats.table(cluster_column).to_csv(statistics_path, index=False)
+        del stats
         
         # Update the pipeline run with the heatmap data in the mongo db using the chain id
         flow_cytometry.FlowCytoPipelineRun.update_by_chain_id(chain_id, {
             "heatmap_data_path": heatmap_data_path, 
+            "cluster_abundance_path": abundance_path,
+            "cluster_statistics_path": statistics_path,
             "clustering_result_path": data_paths['clustering_result_path'], 
             "full_data_path": data_paths['full_data_path'], 
             "original_data_path": data_paths['original_data_path'],
@@ -368,6 +558,8 @@ def generate_heatmap_data(self, data_paths: dict) -> dict:
         
         return {
             "heatmap_data_path": heatmap_data_path,
+            "cluster_abundance_path": abundance_path,
+            "cluster_statistics_path": statistics_path,
             "clustering_result_path": data_paths['clustering_result_path'], 
             "full_data_path": data_paths['full_data_path'],
             "original_data_path": data_paths['original_data_path']
@@ -396,7 +588,7 @@ def fcs_anndata_batch_from_json(json_str: str) -> ad.AnnData:
         print(f"Loading concatenated DataFrame from: {concatenated_df_path}")
 
         # Read the concatenated DataFrame from the file
-        concatenated_df = pd.read_csv(concatenated_df_path)
+        concatenated_df = event_store.read_events(concatenated_df_path)
 
         # Store source_file information
         source_files = None
@@ -452,67 +644,88 @@ def fcs_anndata_batch_from_json(json_str: str) -> ad.AnnData:
 
 
 
+def flowsom_markers(columns):
+    """
+    Marker columns used by FlowSOM: the width (-W) and " -A" channels are left out.
+    """
+    return [c for c in columns if '-W' not in c and ' -A' not in c]
+
+
+def nearest_codes(block, codes, codes_sq=None):
+    """
+    Index of the nearest SOM node (euclidean) of every event of a block, computed with one matrix
+    product: argmin(|c|^2 - 2 x.c), the |x|^2 term does not change the argmin.
+    """
+    if codes_sq is None:
+        codes_sq = (codes * codes).sum(axis=1)
+    return np.argmin(codes_sq[None, :] - 2.0 * (block @ codes.T), axis=1).astype(np.int32)
+
+
 ## run flowsom clustering on batch anndata and plot clusters with batch references 
-def run_flowsom_clustering_batch_files(adata: ad.AnnData, n_clusters: int, xdim: int, ydim: int, cols_to_use: list):
+def run_flowsom_clustering_batch_files(store_path: str, n_clusters: int, xdim: int, ydim: int, cols_to_use: list,
+                                       train_events: int = None, seed: int = 42, chunk_rows: int = None,
+                                       on_chunk=None):
     """
-    Perform flowsom clustering on batch anndata object and plot clusters referencing original batch informations 
-    
+    Trains FlowSOM once, on a per-sample stratified subsample of the events of a store, then maps
+    every event to its nearest SOM node and metacluster chunk by chunk. The per-sample node counts
+    are accumulated in the same pass, so memory does not depend on the number of events.
+
     Parameters:
-        adata (ad.AnnData): Batch anndata object
-        n_clusters (int): Number of clusters to use for flowsom clustering
-        xdim (int): Number of x-dimension for flowsom clustering
-        ydim (int): Number of y-dimension for flowsom clustering
-        cols_to_use (list): List of columns to use for flowsom clustering
-        
+        store_path (str): Event store of the events
+        n_clusters (int): Number of metaclusters
+        xdim (int): Number of x-dimension of the SOM grid
+        ydim (int): Number of y-dimension of the SOM grid
+        cols_to_use (list): Markers used by FlowSOM
+        train_events (int): Events of the training subsample
+        on_chunk (callable): Called as on_chunk(sample_id, offset, block, nodes, metaclusters) for
+            every chunk, offset being the store row of the first event of the block.
+
     Returns:
-        Tuple[fs.FlowSOM, pd.DataFrame]: FlowSOM object and clustering results.
+        Tuple[fs.FlowSOM, ad.AnnData, np.ndarray, np.ndarray]: FlowSOM object, training AnnData
+            (with FlowSOM_cluster and batch), per-sample node counts (samples x nodes) and the
+            metacluster of every node.
     """
-    # Initialize FlowSOM
+    manifest = event_store.read_manifest(store_path)
+    samples = manifest['samples']
+    train_rows = stratified_sample([s['n_events'] for s in samples], train_events or FLOWSOM_TRAIN_EVENTS, seed)
+    train = np.concatenate([
+        event_store.read_event_block(store_path, s['sample_id'], cols_to_use)[rows]
+        for s, rows in zip(samples, train_rows)
+    ]).astype(np.float64)
+    adata = ad.AnnData(X=train, var=pd.DataFrame(index=cols_to_use))
+    adata.obs['batch'] = np.repeat([s['sample_id'] for s in samples], [len(rows) for rows in train_rows])
+    print(f"Training FlowSOM on {adata.n_obs} of {manifest['n_events']} events")
+
+    # single training, the SOM codes and their metaclusters are all the mapping needs
     fsom = fs.FlowSOM(
         inp=adata,
         n_clusters=n_clusters,
         xdim=xdim,
         ydim=ydim,
         cols_to_use=cols_to_use,
-        seed=42
-    )
-    
-    # Perform clustering
-    ff_clustering = fs.flowsom_clustering(
-        inp=adata,
-        cols_to_use=cols_to_use,
-        xdim=xdim,
-        ydim=ydim,
-        n_clusters=n_clusters,
-        seed=42
+        seed=seed
     )
+    cluster_data = fsom.get_cluster_data()
+    codes = np.asarray(cluster_data.obsm['codes'], dtype=np.float32)
+    node_metaclusters = np.asarray(cluster_data.obs['metaclustering'], dtype=np.int32)
+    codes_sq = (codes * codes).sum(axis=1)
+    adata.obs['FlowSOM_cluster'] = np.asarray(fsom.get_cell_data().obs['metaclustering']).astype(str)
+
+    node_counts = np.zeros((len(samples), len(codes)), dtype=np.int64)
+    for i, s in enumerate(samples):
+        for start in range(0, s['n_events'], chunk_rows or FLOWSOM_CHUNK_ROWS):
+            block = event_store.read_event_block(store_path, s['sample_id'], cols_to_use, start,
+                                                 chunk_rows or FLOWSOM_CHUNK_ROWS)
+            nodes = nearest_codes(block, codes, codes_sq)
+            node_counts[i] += np.bincount(nodes, minlength=len(codes))
+            if on_chunk is not None:
+                on_chunk(s['sample_id'], s['offset'] + start, block, nodes, node_metaclusters[nodes])
     
-    # Check if ff_clustering is an AnnData object
-    if isinstance(ff_clustering, ad.AnnData):
-        # Print available keys to debug
-        print("Available keys in ff_clustering.obs:", ff_clustering.obs.columns)
-        # Try to get clustering from the first column
-        cluster_column = ff_clustering.obs.columns[0]
-        adata.obs['FlowSOM_cluster'] = ff_clustering.obs[cluster_column].astype(str)
-    else:
-        raise ValueError("Unexpected type for ff_clustering: {}".format(type(ff_clustering)))
-    
-    # Create UMAP embedding for visualization
+    # Create UMAP embedding of the training events for visualization
     sc.pp.neighbors(adata, use_rep='X')
     sc.tl.umap(adata)
     
-    # Plotting
-    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(50, 10))
-    
-    sc.pl.umap(adata, color='FlowSOM_cluster', ax=ax1, show=False, title='FlowSOM Clusters')
-    sc.pl.umap(adata, color='batch', ax=ax2, show=False, title='Batch Reference')
-    
-    plt.tight_layout()
-    plt.savefig('flowsom_clusters_batches.png', dpi=300)
-    plt.close()
-    
-    return fsom, ff_clustering
-
+    return fsom, adata, node_counts, node_metaclusters
 
 
 ## FLOWSOM PIPELINE
@@ -536,7 +749,7 @@ def flowsom_pipeline(fcs_file_path, n_clusters: int, xdim: int, ydim: int, cols_
     """
     
     
-    fcs_sample = fk.Sample(fcs_file_path).as_dataframe(source="raw")
+    fcs_sample = fcs_cache.events_dataframe(fcs_file_path, source="raw")
     
     # handle multi index columns 
     if isinstance(fcs_sample.columns, pd.MultiIndex):
@@ -592,62 +805,85 @@ def flowsom_pipeline(fcs_file_path, n_clusters: int, xdim: int, ydim: int, cols_
 
 def flowsom_batch_pipeline(fcs_files_list, n_clusters: int, xdim: int, ydim: int):
     """
-    Function to run the flowsom batch pipeline and save results to CSV.
+    Function to run the flowsom batch pipeline and save its results.
 
     Args:
-        fcs_files_list (_type_): List of fcs file paths
+        fcs_files_list (str): Event store (or legacy CSV file) of the events
         n_clusters (int): Number of clusters you want to obtain out of flowsom
         xdim (int): dimension of x axis
         ydim (int): dimension of y axis
 
     Returns:
-        dict: Dictionary containing paths to the saved CSV files and status message
+        dict: Paths of the column set of the FlowSOM node and metacluster of the events, of the
+            per-sample metacluster and node abundance tables and of the plot
     """
     try:
-        # Create AnnData object
-        adata = fcs_anndata_batch_from_json(fcs_files_list)
-        markers = adata.var_names.to_list()
-        
+        unique_id = str(uuid.uuid4())
+        store_path = fcs_files_list
+        if not event_store.is_event_store(store_path):
+            store_path = os.path.join(FLOW_CYTOMETRY_SAVE_PATH, f"events_{unique_id}")
+            event_store.write_event_store(event_store.read_events(fcs_files_list), store_path)
+        manifest = event_store.read_manifest(store_path)
+        markers = flowsom_markers(manifest['columns'])
+
+        # Generate unique filenames
+        clustering_result_path = os.path.join(FLOW_CYTOMETRY_SAVE_PATH, f"flowsom_clustering_{unique_id}")
+        abundance_path = os.path.join(FLOW_CYTOMETRY_SAVE_PATH, f"flowsom_abundance_{unique_id}.csv")
+        node_abundance_path = os.path.join(FLOW_CYTOMETRY_SAVE_PATH, f"flowsom_node_abundance_{unique_id}.csv")
+        plot_path = os.path.join(FLOW_CYTOMETRY_SAVE_PATH, f"flowsom_clusters_batches_{unique_id}.png")
+
+        # the node and metacluster of every event are filled chunk by chunk while they are mapped
+        n_events = manifest['n_events']
+        label_type = event_store.label_dtype([xdim * ydim, n_clusters])
+        event_nodes = np.zeros(n_events, dtype=label_type)
+        event_metaclusters = np.zeros(n_events, dtype=label_type)
+
+        def store_chunk(sample_id, offset, block, nodes, metaclusters):
+            event_nodes[offset:offset + len(block)] = nodes
+            event_metaclusters[offset:offset + len(block)] = metaclusters
+
         # Run FlowSOM
-        fsom, ff_clustering = run_flowsom_clustering_batch_files(
-            adata, 
+        fsom, adata, node_counts, node_metaclusters = run_flowsom_clustering_batch_files(
+            store_path,
             n_clusters=n_clusters, 
             xdim=xdim, 
             ydim=ydim, 
-            cols_to_use=markers
+            cols_to_use=markers,
+            on_chunk=store_chunk
         )
-        
-        # Generate unique filenames
-        unique_id = str(uuid.uuid4())
-        clustering_result_path = os.path.join(
-            FLOW_CYTOMETRY_SAVE_PATH, 
-            f"flowsom_clustering_{unique_id}.csv"
-        )
-        umap_result_path = os.path.join(
-            FLOW_CYTOMETRY_SAVE_PATH, 
-            f"flowsom_umap_{unique_id}.csv"
-        )
-        
-        # Create DataFrame with clustering results
-        clustering_df = pd.DataFrame(
-            adata.X,
-            columns=adata.var_names,
-            index=adata.obs_names
-        )
-        clustering_df['FlowSOM_cluster'] = adata.obs['FlowSOM_cluster']
-        if 'batch' in adata.obs:
-            clustering_df['batch'] = adata.obs['batch']
-            
-        # Add UMAP coordinates if they exist
-        if 'X_umap' in adata.obsm:
-            clustering_df['UMAP_1'] = adata.obsm['X_umap'][:, 0]
-            clustering_df['UMAP_2'] = adata.obsm['X_umap'][:, 1]
-        
-        # Save results to CSV
-        clustering_df.to_csv(clustering_result_path, index=True)
+        # the labels alone, joined to the events of the store by row
+        event_store.write_column_set(clustering_result_path, store_path, {
+            'FlowSOM_cluster': event_metaclusters, 'FlowSOM_node': event_nodes
+        })
+        del event_nodes, event_metaclusters
+        count_items("events", n_events)
+
+        # per-sample abundance of the metaclusters and of the SOM nodes
+        sample_ids = [s['sample_id'] for s in manifest['samples']]
+        metacluster_counts = np.zeros((len(sample_ids), n_clusters), dtype=np.int64)
+        for metacluster in range(n_clusters):
+            metacluster_counts[:, metacluster] = node_counts[:, node_metaclusters == metacluster].sum(axis=1)
+        pd.DataFrame(metacluster_counts, index=pd.Index(sample_ids, name='batch'),
+                     columns=[str(m) for m in range(n_clusters)]).to_csv(abundance_path)
+        pd.DataFrame(node_counts, index=pd.Index(sample_ids, name='batch'),
+                     columns=[str(n) for n in range(node_counts.shape[1])]).to_csv(node_abundance_path)
+
+        # Plotting: density rasters colored by the most frequent cluster / batch of every pixel
+        embedding = adata.obsm['X_umap']
+        extent = density_plot.data_extent(embedding[:, 0], embedding[:, 1])
+        panels = []
+        for column, title in (('FlowSOM_cluster', 'FlowSOM Clusters'), ('batch', 'Batch Reference')):
+            codes, names = pd.factorize(adata.obs[column].astype(str), sort=True)
+            raster = density_plot.DensityRaster(extent, n_labels=len(names))
+            raster.add(embedding[:, 0], embedding[:, 1], labels=codes)
+            panels.append({"raster": raster, "kind": "mode", "title": title, "label_names": list(names)})
+        density_plot.save_small_multiples(panels, plot_path, xlabel='UMAP1', ylabel='UMAP2')
         
         return {
             "clustering_result_path": clustering_result_path,
+            "flowsom_abundance_path": abundance_path,
+            "flowsom_node_abundance_path": node_abundance_path,
+            "flowsom_plot_path": plot_path,
         }
         
     except Exception as e:
@@ -657,28 +893,27 @@ def flowsom_batch_pipeline(fcs_files_list, n_clusters: int, xdim: int, ydim: int
 
 def plot_scatter(data_paths: dict, data2 = 0) -> str:
     try:
-        # Load clustering results
-        full_df = pd.read_csv(data_paths['full_data_path'])
-        clustering_df = pd.read_csv(data_paths['clustering_result_path'])
-
-        # Generate scatterplot
-        plt.figure(figsize=(8, 8))
-        scatter = plt.scatter(
-            full_df['UMAP_1'],
-            full_df['UMAP_2'],
-            c=pd.to_numeric(clustering_df['Leiden_Cluster']),
-            cmap='viridis',
-            s=10
+        # Load clustering results, the labels join the embedding by row
+        cluster_column = data_paths.get('cluster_column', 'Leiden_Cluster')
+        clustering_df = event_store.read_events(
+            data_paths['clustering_result_path'], columns=['UMAP_1', 'UMAP_2', cluster_column]
         )
-        plt.colorbar(scatter, label='Leiden Cluster')
-        plt.title("Scatterplot of Leiden Clusters")
-        plt.xlabel('UMAP_1')
-        plt.ylabel('UMAP_2')
+
+        # Density raster of the embedding, every pixel colored by its most frequent cluster
+        x, y = clustering_df['UMAP_1'].to_numpy(), clustering_df['UMAP_2'].to_numpy()
+        codes, names = pd.factorize(pd.to_numeric(clustering_df[cluster_column]), sort=True)
+        raster = density_plot.DensityRaster(density_plot.data_extent(x, y), n_labels=len(names))
+        raster.add(x, y, labels=codes)
+        del clustering_df
+
         scatterplot_path = os.path.join(
             FLOW_CYTOMETRY_SAVE_PATH, f"leiden_scatter_plot_{uuid.uuid4()}.png"
         )
-        plt.savefig(scatterplot_path)
-        plt.close()
+        density_plot.save_small_multiples(
+            [{"raster": raster, "kind": "mode", "title": f"Scatterplot of {cluster_column.replace('_', ' ')}s",
+              "label_names": list(names)}],
+            scatterplot_path, panel_size=8, xlabel='UMAP_1', ylabel='UMAP_2'
+        )
 
         return scatterplot_path
     except Exception as e:
@@ -687,55 +922,38 @@ def plot_scatter(data_paths: dict, data2 = 0) -> str:
     
 def plot_matrix(data_paths: dict, data2=0) -> str:
     try:
-        # Load original data and clustering results
-        original_df = pd.read_csv(data_paths['original_data_path'])
-        clustering_df = pd.read_csv(data_paths['clustering_result_path'])
-
-        # Ensure indices are aligned
-        original_df.reset_index(drop=True, inplace=True)
-        clustering_df.reset_index(drop=True, inplace=True)
-
-        # Debugging: Print shapes and columns
+        # Load the markers of the original data with the clustering results, joined by row
+        cluster_column = data_paths.get('cluster_column', 'Leiden_Cluster')
+        markers = event_store.event_columns(data_paths['original_data_path'])
+        original_df = event_store.read_events(data_paths['clustering_result_path'], columns=markers + [cluster_column])
         print(f"Original DataFrame shape: {original_df.shape}")
-        print(f"Clustering DataFrame shape: {clustering_df.shape}")
-        print(f"Original DataFrame columns: {list(original_df.columns)}")
-
-        # Prepare data for plotting
-        adata_full = sc.AnnData(original_df)
 
-        # Set variable names
-        adata_full.var_names = original_df.columns.astype(str)
-        adata_full.var_names_make_unique()
-
-        # Set observation names
-        adata_full.obs_names = original_df.index.astype(str)
-
-        # Assign clustering results to obs
-        adata_full.obs['Leiden_Cluster'] = clustering_df['Leiden_Cluster'].astype('category').values
-
-        # Debugging: Print AnnData structure
-        print(f"AnnData shape: {adata_full.shape}")
-        print(f"AnnData var_names: {adata_full.var_names}")
-        print(f"AnnData obs_names: {adata_full.obs_names}")
-        print(f"AnnData obs (first 5 rows):\n{adata_full.obs.head()}")
-
-        # Generate matrix plot
-        sc.pl.matrixplot(
-            adata_full,
-            groupby='Leiden_Cluster',
-            var_names=list(adata_full.var_names),
-            cmap="viridis",
-            standard_scale="var",
-            dendrogram=True,
-            show=False
-        )
+        # mean of every marker per cluster, scaled to [0, 1] per marker (standard_scale="var")
+        original_df = original_df[markers + [cluster_column]]
+        means = original_df.groupby(cluster_column).mean()
+        del original_df
+        spread = (means.max() - means.min()).replace(0, 1)
+        scaled = (means - means.min()) / spread
+
+        # clusters ordered by the dendrogram of their mean profiles
+        order = np.arange(len(scaled))
+        if len(scaled) > 2:
+            order = hierarchy.leaves_list(hierarchy.linkage(scaled.to_numpy(), method='average'))
+        scaled = scaled.iloc[order]
+
+        fig, ax = plt.subplots(figsize=(max(6, 0.4 * len(markers) + 2), max(4, 0.3 * len(scaled) + 1.5)))
+        image = ax.imshow(scaled.to_numpy(), aspect='auto', cmap='viridis', interpolation='nearest')
+        ax.set_xticks(range(len(markers)), markers, rotation=90)
+        ax.set_yticks(range(len(scaled)), [str(c) for c in scaled.index])
+        ax.set_ylabel(cluster_column)
+        fig.colorbar(image, ax=ax, label='Mean expression in group')
 
         # Save the plot
         matrixplot_path = os.path.join(
             FLOW_CYTOMETRY_SAVE_PATH, f"leiden_matrix_plot_{uuid.uuid4()}.png"
         )
-        plt.savefig(matrixplot_path, bbox_inches='tight')
-        plt.close()
+        fig.savefig(matrixplot_path, bbox_inches='tight')
+        plt.close(fig)
 
         return matrixplot_path
 
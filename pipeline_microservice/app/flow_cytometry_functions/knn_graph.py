@@ -0,0 +1,234 @@
+import os
+import json
+import logging
+import numpy as np
+import scipy.sparse as sp
+import igraph as ig
+import leidenalg
+from pynndescent import NNDescent
+from umap.umap_ import fuzzy_simplicial_set
+from dotenv import load_dotenv
+from app.flow_cytometry_functions import event_store
+
+# set up logging
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# neighbors per event (the event itself included, like UMAP) and threads of the graph construction
+KNN_GRAPH_NEIGHBORS = int(os.getenv("KNN_GRAPH_NEIGHBORS", 15))
+KNN_GRAPH_JOBS = int(os.getenv("KNN_GRAPH_JOBS", -1))
+
+GRAPH_FILE = "knn_graph.npz"
+GRAPH_METADATA_FILE = "knn_graph.json"
+
+
+def graph_paths(store_path):
+    return os.path.join(store_path, GRAPH_FILE), os.path.join(store_path, GRAPH_METADATA_FILE)
+
+
+def read_store_matrix(store_path, columns=None):
+    """
+    float32 matrix of the events of a store in store order, read one sample at a time.
+    """
+    manifest = event_store.read_manifest(store_path)
+    columns = columns or manifest["columns"]
+    blocks = [event_store.read_event_block(store_path, s["sample_id"], columns) for s in manifest["samples"]]
+    return np.concatenate(blocks) if blocks else np.empty((0, len(columns)), dtype=np.float32)
+
+
+def build_knn_graph(store_path, n_neighbors=None, columns=None, scale=False, metric="euclidean", n_jobs=None,
+                    seed=None):
+    """
+    Builds the approximate kNN graph of the events of a store with pynndescent (multi-threaded
+    NN-descent) and saves it in the store, next to the events it indexes.
+
+    Args:
+        store_path (str): Event store.
+        n_neighbors (int): Neighbors per event, the event itself included.
+        columns (list): Marker columns of the graph space, all by default.
+        scale (bool): Standardize the markers before searching the neighbors.
+        metric (str): Distance of pynndescent.
+        n_jobs (int): Threads of the construction, -1 for all the cores.
+        seed (int): Seed of NN-descent, None for a parallel non-reproducible construction.
+
+    Returns:
+        dict: Metadata of the graph.
+    """
+    n_neighbors = int(n_neighbors or KNN_GRAPH_NEIGHBORS)
+    manifest = event_store.read_manifest(store_path)
+    columns = list(columns or manifest["columns"])
+    data = read_store_matrix(store_path, columns)
+    if scale:
+        data = (data - data.mean(axis=0)) / np.where(data.std(axis=0) > 0, data.std(axis=0), 1.0)
+    n_neighbors = min(n_neighbors, len(data))
+    print(f"Building the {n_neighbors}-NN graph of {len(data)} events")
+    index = NNDescent(
+        data, n_neighbors=n_neighbors, metric=metric, random_state=seed,
+        n_jobs=n_jobs if n_jobs is not None else KNN_GRAPH_JOBS, low_memory=True,
+    )
+    indices, distances = index.neighbor_graph
+    del index, data
+
+    # one row per event with its neighbors sorted by distance, the CSR order is kept on disk
+    graph = sp.csr_matrix(
+        (distances.astype(np.float32).ravel(), indices.astype(np.int32).ravel(),
+         np.arange(0, indices.size + 1, n_neighbors, dtype=np.int64)),
+        shape=(len(indices), len(indices)),
+    )
+    graph_file, metadata_file = graph_paths(store_path)
+    sp.save_npz(graph_file + ".tmp.npz", graph, compressed=False)
+    os.replace(graph_file + ".tmp.npz", graph_file)
+    metadata = {
+        "n_neighbors": n_neighbors,
+        "n_events": manifest["n_events"],
+        "columns": columns,
+        "scale": bool(scale),
+        "metric": metric,
+    }
+    with open(metadata_file, "w") as f:
+        json.dump(metadata, f, indent=2)
+    logger.info(f"kNN graph of {store_path}: {metadata}")
+    return metadata
+
+
+def read_graph_metadata(store_path):
+    metadata_file = graph_paths(store_path)[1]
+    if not os.path.exists(metadata_file):
+        return None
+    with open(metadata_file) as f:
+        return json.load(f)
+
+
+def load_knn_graph(store_path, n_neighbors=None):
+    """
+    Loads the kNN graph of a store.
+
+    Args:
+        n_neighbors (int): Neighbors to keep per event (the nearest ones), all by default.
+
+    Returns:
+        tuple: (indices int32 array, distances float32 array), both (events, neighbors).
+    """
+    graph = sp.load_npz(graph_paths(store_path)[0])
+    k = graph.indptr[1] - graph.indptr[0] if graph.shape[0] else 0
+    indices = graph.indices.reshape(-1, k)
+    distances = graph.data.reshape(-1, k)
+    if n_neighbors is not None and n_neighbors < k:
+        indices, distances = indices[:, :n_neighbors], distances[:, :n_neighbors]
+    return np.ascontiguousarray(indices), np.ascontiguousarray(distances)
+
+
+def ensure_knn_graph(store_path, n_neighbors=None, build_neighbors=None, **options):
+    """
+    kNN graph of a store, built only when the store has none or one with fewer neighbors, over
+    other columns or with another scaling or metric, so that the steps of a run share a single
+    construction. The columns, scaling and metric a caller does not set are those of the stored
+    graph, so that consumers reuse the graph of the knn_graph step whatever its space.
+
+    Args:
+        n_neighbors (int): Neighbors needed by the caller, the nearest ones are kept.
+        build_neighbors (int): Neighbors of a graph built here, when the later steps of the run
+            need more than the caller (see graph_neighbors); n_neighbors at least.
+        options: columns, scale, metric, n_jobs and seed, see build_knn_graph.
+
+    Returns:
+        tuple: (indices, distances), see load_knn_graph.
+    """
+    n_neighbors = int(n_neighbors or KNN_GRAPH_NEIGHBORS)
+    manifest = event_store.read_manifest(store_path)
+    metadata = read_graph_metadata(store_path)
+    if metadata is not None:
+        options.setdefault("columns", metadata["columns"])
+        options.setdefault("scale", metadata.get("scale", False))
+        options.setdefault("metric", metadata.get("metric", "euclidean"))
+    columns = list(options.get("columns") or manifest["columns"])
+    stale = (
+        metadata is None
+        or metadata["n_events"] != manifest["n_events"]
+        or metadata["columns"] != columns
+        or metadata.get("scale", False) != bool(options.get("scale", False))
+        or metadata.get("metric", "euclidean") != options.get("metric", "euclidean")
+        or metadata["n_neighbors"] < min(n_neighbors, manifest["n_events"])
+    )
+    if stale:
+        build_knn_graph(store_path, max(n_neighbors, int(build_neighbors or 0)), **options)
+    else:
+        print(f"Reusing the {metadata['n_neighbors']}-NN graph of {store_path}")
+    return load_knn_graph(store_path, n_neighbors)
+
+
+def graph_neighbors(steps):
+    """
+    Largest number of neighbors (the event itself included) the graph steps of a flow
+    cytometry pipeline ask for: the graph built with it once serves all of them, each keeping
+    its nearest neighbors.
+
+    Args:
+        steps (list): Steps of the pipeline, dicts with name and parameters.
+    """
+    needed = []
+    for step in steps:
+        parameters = step.get('parameters') or {}
+        name = step.get('name')
+        if name in ('knn_graph', 'umap', 'leiden_clustering', 'leiden_sweep'):
+            needed.append(int(parameters.get('n_neighbors') or KNN_GRAPH_NEIGHBORS))
+        elif name == 'louvain_clustering':
+            # Louvain counts its neighbors without the event itself
+            needed.append(int(parameters.get('k_neighbors') or 30) + 1)
+    return max(needed, default=KNN_GRAPH_NEIGHBORS)
+
+
+def knn_matrix(indices, distances=None, include_self=False):
+    """
+    Sparse (events x events) kNN matrix, with the distances or 1 for every edge.
+    """
+    if not include_self:
+        indices = indices[:, 1:]
+        distances = distances[:, 1:] if distances is not None else None
+    n, k = indices.shape
+    data = np.ones(indices.size, dtype=np.float32) if distances is None else distances.ravel()
+    return sp.csr_matrix((data, indices.ravel(), np.arange(0, n * k + 1, k)), shape=(n, n))
+
+
+def connectivities(indices, distances):
+    """
+    Symmetric weighted graph of the fuzzy simplicial set of UMAP, the same connectivities that
+    scanpy computes in sc.pp.neighbors.
+    """
+    graph, _, _ = fuzzy_simplicial_set(
+        np.empty((indices.shape[0], 1), dtype=np.float32), indices.shape[1], None, "euclidean",
+        knn_indices=indices, knn_dists=distances,
+    )
+    return graph.tocsr()
+
+
+def to_igraph(graph):
+    """
+    Undirected weighted igraph Graph of a symmetric sparse graph.
+    """
+    upper = sp.triu(graph, k=1).tocoo()
+    g = ig.Graph(n=graph.shape[0], edges=np.column_stack([upper.row, upper.col]).tolist(), directed=False)
+    g.es["weight"] = upper.data.tolist()
+    return g
+
+
+def leiden_partition(graph, resolution=1.0, seed=0, n_iterations=-1):
+    """
+    Leiden communities of a weighted graph (RBConfiguration quality, like sc.tl.leiden).
+
+    Args:
+        graph (sp.spmatrix | ig.Graph): Symmetric weighted graph, or its igraph Graph (see
+            to_igraph) to cluster the same graph many times.
+
+    Returns:
+        tuple: (int32 labels numbered by decreasing community size, modularity)
+    """
+    g = graph if isinstance(graph, ig.Graph) else to_igraph(graph)
+    partition = leidenalg.find_partition(
+        g, leidenalg.RBConfigurationVertexPartition, weights="weight",
+        resolution_parameter=resolution, seed=seed, n_iterations=n_iterations,
+    )
+    labels = np.asarray(partition.membership, dtype=np.int32)
+    return labels, g.modularity(partition.membership, weights="weight")
@@ -1,7 +1,62 @@
 import pyopenms as oms
+import pandas as pd
 
 # leggi il file mzML
 def read_mzML_file(file_path):
     exp = oms.MSExperiment()
     oms.MzMLFile().load(file_path, exp)
     return exp
+
+
+def serialize_ms_experiment(exp):
+    """
+    Serializza un oggetto MSExperiment in formato JSON, includendo tutti i metadati disponibili
+    e aggiungendo un campo per la polarità basato su getPolarity().
+    
+    Args:
+        exp (oms.MSExperiment): Oggetto MSExperiment da serializzare.
+    
+    Returns:
+        str: JSON con dati e metadati degli spettri.
+    """
+    spectra = exp.getSpectra()
+
+    # Inizializza una lista per i dati degli spettri
+    serialized_data = []
+
+    for spectrum in spectra:
+        spectrum_data = {
+            'RT': spectrum.getRT(),
+            'mzarray': list(spectrum.get_peaks()[0]),
+            'intarray': list(spectrum.get_peaks()[1]),
+            'scan_number': spectrum.getNativeID(),
+            'ms_level': spectrum.getMSLevel()
+        }
+
+        # Aggiungi tutti i metadati disponibili
+        meta_keys = []  # Lista vuota per raccogliere le chiavi
+        spectrum.getKeys(meta_keys)  # Popola meta_keys con le chiavi disponibili
+
+        for key in meta_keys:
+            try:
+                spectrum_data[key] = spectrum.getMetaValue(key)
+            except KeyError:
+                print(f"Metadata key '{key}' not found in spectrum with RT: {spectrum.getRT()}")
+
+        # Determina la polarità
+        polarity_value = spectrum.getInstrumentSettings().getPolarity()
+        polarity_map = {0: 'unknown', 1: 'positive', 2: 'negative'}
+        spectrum_data['polarity'] = polarity_map.get(polarity_value, 'unknown')
+
+        serialized_data.append(spectrum_data)
+
+    # Crea un DataFrame
+    df = pd.DataFrame(serialized_data)
+
+    # Rinominare le colonne con b'' in stringhe normali
+    df.rename(columns=lambda x: x.decode('utf-8') if isinstance(x, bytes) else x, inplace=True)
+
+    # Log per verifica
+    print(df[['scan_number', 'polarity']].head())
+
+    return df.to_json()
@@ -1,6 +1,7 @@
 import pyopenms as oms
 import os
 from dotenv import load_dotenv
+from app.utils.instrumentation import count_items
 
 # Load environment variables from .env file
 load_dotenv()
@@ -36,6 +37,7 @@ def run_feature_mapping(filename, mass_traces_split, polarity='negative'):
     ffm.setParameters(ffm_params)
     ffm.run(mass_traces_split, feature_map, feature_chromatograms)
     print(f"Number of features after feature mapping: {feature_map.size()}")
+    count_items("features", feature_map.size())
 
     # Set the spectra_data meta value for downstream compatibility
     mzml_basename = os.path.basename(filename) + ".mzML"
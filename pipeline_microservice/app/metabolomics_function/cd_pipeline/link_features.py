@@ -1,4 +1,5 @@
 import pyopenms as oms
+from app.utils.instrumentation import count_items
 
 def link_features(feature_files, output_consensus_file):
     # Load feature maps
@@ -17,6 +18,7 @@ def link_features(feature_files, output_consensus_file):
     linker = oms.FeatureGroupingAlgorithmKD()
     linker.group(feature_maps, consensus_map)
     # Store consensus map
+    count_items("consensus_features", consensus_map.size())
     oms.ConsensusXMLFile().store(output_consensus_file, consensus_map)
     print(f"Consensus map saved to {output_consensus_file}")
 
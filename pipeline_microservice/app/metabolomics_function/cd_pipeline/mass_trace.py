@@ -1,4 +1,5 @@
 import pyopenms as oms
+from app.utils.instrumentation import count_items
 
 
 def run_mass_trace_detection(input_file, polarity="negative"):
@@ -13,6 +14,7 @@ def run_mass_trace_detection(input_file, polarity="negative"):
     exp = oms.MSExperiment()
     # load the mzML file
     oms.MzMLFile().load(input_file, exp)
+    count_items("spectra", exp.size())
     
     # Filter spectra by polarity if specified
     if polarity != "both":
@@ -41,6 +43,7 @@ def run_mass_trace_detection(input_file, polarity="negative"):
     mtd.run(exp, mass_traces, 0)  # 0 is the MS1
     # print the number of mass traces
     print(f"Number of mass traces: {len(mass_traces)}")
+    count_items("mass_traces", len(mass_traces))
     return mass_traces
     
     
@@ -2,8 +2,17 @@ import pyopenms as oms
 import pandas as pd
 import os
 import subprocess
+from app.utils.tool_runner import run_tool
+from app.utils.instrumentation import count_items
+from app.metabolomics_function.cd_pipeline.spectral_library import (
+    DEFAULT_BIN_WIDTH,
+    load_or_build_library_index,
+    read_query_spectra,
+    match_spectra,
+    hits_to_dataframe,
+)
 
-def run_ms2_identification(mzml_file, library_file, output_csv, mztab_output="ms2_identifications.mztab"):
+def run_ms2_identification(mzml_file, library_file, output_csv, mztab_output="ms2_identifications.mztab", timeout=None):
     """
     Perform MS2 identification using OpenMS command-line tool MetaboliteSpectralMatcher.
     Parses MzTab output manually with debugging.
@@ -20,15 +29,13 @@ def run_ms2_identification(mzml_file, library_file, output_csv, mztab_output="ms
         "-out", mztab_output,
     ]
     
-    # Run the command
+    # Run the command, the output is streamed to the task log by the tool runner
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        run_tool(cmd, label=os.path.basename(mzml_file), timeout=timeout)
         print("MetaboliteSpectralMatcher completed successfully.")
-        print(result.stdout)
-    except subprocess.CalledProcessError as e:
+    except subprocess.SubprocessError as e:
         print(f"Error running MetaboliteSpectralMatcher: {e}")
-        print(f"Stdout: {e.stdout}")
-        print(f"Stderr: {e.stderr}")
+        print(f"Stderr: {getattr(e, 'stderr', '')}")
         return pd.DataFrame()  # Return empty DataFrame on error
     
     # Debug: Print the first 20 lines of the MzTab file
@@ -72,6 +79,45 @@ def run_ms2_identification(mzml_file, library_file, output_csv, mztab_output="ms
     print(f"MS2 identifications saved to {output_csv}")
     return df
 
+def run_ms2_identification_native(mzml_files, library_file, output_dir, precursor_tolerance_ppm=10.0,
+                                  precursor_tolerance_da=None, bin_width=DEFAULT_BIN_WIDTH, min_score=0.7,
+                                  min_matched_peaks=3, top_k=1, score="modified_cosine", n_workers=None,
+                                  index_dir=None):
+    """
+    Perform MS2 identification in-process against a prebuilt spectral library index.
+    The library is compiled once (and cached next to the library file), then every mzML
+    is matched by precursor window with sparse cosine / modified cosine scoring.
+
+    Returns:
+    dict: Path of the identification CSV for each mzML file.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    index, index_file = load_or_build_library_index(library_file, bin_width=bin_width, index_dir=index_dir)
+    print(f"Spectral library index ready: {len(index)} entries")
+
+    output_files = {}
+    for mzml_file in mzml_files:
+        queries = read_query_spectra(mzml_file, bin_width=bin_width)
+        hits = match_spectra(
+            index, index_file, queries, n_workers=n_workers,
+            precursor_tolerance_ppm=precursor_tolerance_ppm,
+            precursor_tolerance_da=precursor_tolerance_da,
+            min_score=min_score,
+            min_matched_peaks=min_matched_peaks,
+            top_k=top_k,
+            score=score,
+        )
+        df = hits_to_dataframe(hits, mzml_file)
+        base_name = os.path.splitext(os.path.basename(mzml_file))[0]
+        output_csv = os.path.join(output_dir, f"{base_name}_ms2_identifications.csv")
+        df.to_csv(output_csv, index=False)
+        print(f"{len(queries)} MS2 spectra searched, {df['native_id'].nunique()} identified in {mzml_file}")
+        count_items("spectra", len(queries))
+        count_items("identifications", len(df))
+        output_files[mzml_file] = output_csv
+    return output_files
+
+
 if __name__ == "__main__":
     mzml_file = "/media/datastorage/it_cast/metabolomica/test/CC1.mzML"
     library_file = "/media/datastorage/it_cast/omnis_microservice_db/tools/GNPS-LIBRARY.mzML"
@@ -0,0 +1,515 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import pyopenms as oms
+from app.utils.pools import in_daemon_process, worker_pool
+
+# mass of the precursor shift is expressed in bins, so keep the bin width small
+DEFAULT_BIN_WIDTH = 0.01
+INDEX_VERSION = 1
+
+# metadata fields exported with every library entry
+LIBRARY_FIELDS = ["name", "formula", "adduct", "inchikey", "smiles"]
+
+# meta values written by OpenMS/GNPS in the mzML spectral libraries
+MZML_META_KEYS = {
+    "name": ["Metabolite_Name", "Name", "name"],
+    "formula": ["Chemical_Formula", "Formula", "formula"],
+    "adduct": ["Adduct", "Precursor_Adduct", "adduct"],
+    "inchikey": ["InChIKey", "INCHIKEY", "inchikey"],
+    "smiles": ["SMILES", "smiles"],
+}
+
+# keys used in the MSP headers
+MSP_KEYS = {
+    "name": "name",
+    "formula": "formula",
+    "precursor_type": "adduct",
+    "adduct": "adduct",
+    "inchikey": "inchikey",
+    "smiles": "smiles",
+    "precursormz": "precursor_mz",
+    "precursor_mz": "precursor_mz",
+    "pepmass": "precursor_mz",
+}
+
+
+def read_msp_library(msp_file):
+    """
+    Reads an MSP spectral library.
+
+    Parameters:
+    msp_file (str): Path to the MSP file.
+
+    Returns:
+    list: One dict per library entry with metadata, precursor m/z and the peak arrays.
+    """
+    entries = []
+    entry = {}
+    peaks = []
+
+    def _flush():
+        if entry.get("precursor_mz") is not None and peaks:
+            peaks_array = np.asarray(peaks, dtype=np.float64)
+            entry["mz"] = peaks_array[:, 0]
+            entry["intensity"] = peaks_array[:, 1]
+            entries.append(dict(entry))
+
+    with open(msp_file, "r", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                _flush()
+                entry, peaks = {}, []
+                continue
+            if ":" in line and not line[0].isdigit():
+                key, value = line.split(":", 1)
+                field = MSP_KEYS.get(key.strip().lower())
+                if field == "precursor_mz":
+                    try:
+                        entry[field] = float(value.split()[0])
+                    except (ValueError, IndexError):
+                        entry[field] = None
+                elif field is not None:
+                    entry[field] = value.strip()
+                continue
+            # peak lines: "mz intensity" optionally followed by an annotation
+            parts = line.replace("\t", " ").split()
+            if len(parts) >= 2:
+                try:
+                    peaks.append((float(parts[0]), float(parts[1])))
+                except ValueError:
+                    continue
+    _flush()
+
+    print(f"Read {len(entries)} spectra from the MSP library {msp_file}")
+    return entries
+
+
+def read_mzml_library(mzml_file):
+    """
+    Reads an mzML spectral library (e.g. the GNPS library used by MetaboliteSpectralMatcher).
+
+    Parameters:
+    mzml_file (str): Path to the mzML library.
+
+    Returns:
+    list: One dict per library entry with metadata, precursor m/z and the peak arrays.
+    """
+    exp = oms.MSExperiment()
+    oms.MzMLFile().load(mzml_file, exp)
+
+    entries = []
+    for spectrum in exp:
+        precursors = spectrum.getPrecursors()
+        if not precursors:
+            continue
+        mz, intensity = spectrum.get_peaks()
+        if len(mz) == 0:
+            continue
+        entry = {"precursor_mz": precursors[0].getMZ(), "mz": mz, "intensity": intensity}
+        for field, keys in MZML_META_KEYS.items():
+            for key in keys:
+                if spectrum.metaValueExists(key):
+                    value = spectrum.getMetaValue(key)
+                    entry[field] = value.decode() if isinstance(value, bytes) else str(value)
+                    break
+        entry.setdefault("name", spectrum.getNativeID())
+        entries.append(entry)
+
+    print(f"Read {len(entries)} spectra from the mzML library {mzml_file}")
+    return entries
+
+
+def bin_spectrum(mz, intensity, bin_width=DEFAULT_BIN_WIDTH, min_mz=0.0, max_mz=None, sqrt_intensity=True):
+    """
+    Bins a spectrum into a sparse, L2-normalized vector.
+
+    Parameters:
+    mz (array): m/z values of the peaks.
+    intensity (array): Intensities of the peaks.
+    bin_width (float): Width of the m/z bins in Da.
+    min_mz (float): Peaks below this m/z are ignored.
+    max_mz (float): Peaks above this m/z are ignored (e.g. the precursor region).
+    sqrt_intensity (bool): Apply a square root to the intensities before normalizing.
+
+    Returns:
+    tuple: Sorted unique bin indices (int32) and the matching normalized values (float32).
+    """
+    mz = np.asarray(mz, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+    keep = (intensity > 0) & (mz >= min_mz)
+    if max_mz is not None:
+        keep &= mz <= max_mz
+    mz, intensity = mz[keep], intensity[keep]
+    if mz.size == 0:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+
+    if sqrt_intensity:
+        intensity = np.sqrt(intensity)
+
+    bins = np.floor(mz / bin_width).astype(np.int64)
+    unique_bins, inverse = np.unique(bins, return_inverse=True)
+    values = np.bincount(inverse, weights=intensity)
+    norm = np.linalg.norm(values)
+    if norm == 0:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+    return unique_bins.astype(np.int32), (values / norm).astype(np.float32)
+
+
+class SpectralLibraryIndex:
+    """
+    Precompiled spectral library: entries sorted by precursor m/z, each one stored as a
+    binned, normalized sparse vector in flat CSR-like arrays (offsets, bins, values).
+    """
+
+    def __init__(self, precursor_mz, offsets, bins, values, metadata, bin_width):
+        self.precursor_mz = precursor_mz
+        self.offsets = offsets
+        self.bins = bins
+        self.values = values
+        self.metadata = metadata
+        self.bin_width = bin_width
+
+    def __len__(self):
+        return len(self.precursor_mz)
+
+    @classmethod
+    def from_entries(cls, entries, bin_width=DEFAULT_BIN_WIDTH, min_mz=0.0, sqrt_intensity=True):
+        entries = sorted(entries, key=lambda e: e["precursor_mz"])
+        precursor_mz = np.empty(len(entries), dtype=np.float64)
+        lengths = np.empty(len(entries), dtype=np.int64)
+        all_bins, all_values = [], []
+        metadata = {field: [] for field in LIBRARY_FIELDS}
+
+        for i, entry in enumerate(entries):
+            bins, values = bin_spectrum(
+                entry["mz"], entry["intensity"], bin_width=bin_width,
+                min_mz=min_mz, sqrt_intensity=sqrt_intensity
+            )
+            precursor_mz[i] = entry["precursor_mz"]
+            lengths[i] = bins.size
+            all_bins.append(bins)
+            all_values.append(values)
+            for field in LIBRARY_FIELDS:
+                metadata[field].append(str(entry.get(field, "") or ""))
+
+        offsets = np.zeros(len(entries) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        bins = np.concatenate(all_bins) if all_bins else np.empty(0, dtype=np.int32)
+        values = np.concatenate(all_values) if all_values else np.empty(0, dtype=np.float32)
+        metadata = {field: np.asarray(column, dtype=str) for field, column in metadata.items()}
+        return cls(precursor_mz, offsets, bins, values, metadata, bin_width)
+
+    @classmethod
+    def build(cls, library_file, bin_width=DEFAULT_BIN_WIDTH, min_mz=0.0, sqrt_intensity=True):
+        """
+        Builds the index from an MSP or mzML library file.
+        """
+        if not os.path.exists(library_file):
+            raise FileNotFoundError(f"Spectral library not found: {library_file}")
+        if library_file.lower().endswith(".msp"):
+            entries = read_msp_library(library_file)
+        else:
+            entries = read_mzml_library(library_file)
+        return cls.from_entries(entries, bin_width=bin_width, min_mz=min_mz, sqrt_intensity=sqrt_intensity)
+
+    def save(self, index_file):
+        arrays = {f"meta_{field}": column for field, column in self.metadata.items()}
+        # write to a temporary file first so concurrent readers never see a partial index
+        tmp_file = f"{index_file}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_file,
+            version=np.array(INDEX_VERSION),
+            bin_width=np.array(self.bin_width),
+            precursor_mz=self.precursor_mz,
+            offsets=self.offsets,
+            bins=self.bins,
+            values=self.values,
+            **arrays
+        )
+        os.replace(tmp_file, index_file)
+        print(f"Spectral library index saved to {index_file}")
+        return index_file
+
+    @classmethod
+    def load(cls, index_file):
+        with np.load(index_file) as data:
+            if int(data["version"]) != INDEX_VERSION:
+                raise ValueError(f"Unsupported spectral library index version in {index_file}")
+            metadata = {field: data[f"meta_{field}"] for field in LIBRARY_FIELDS}
+            return cls(
+                data["precursor_mz"], data["offsets"], data["bins"], data["values"],
+                metadata, float(data["bin_width"])
+            )
+
+    def candidates(self, precursor_mz, tolerance_da):
+        """
+        Returns the index range of the entries inside the precursor window.
+        """
+        start = np.searchsorted(self.precursor_mz, precursor_mz - tolerance_da, side="left")
+        stop = np.searchsorted(self.precursor_mz, precursor_mz + tolerance_da, side="right")
+        return start, stop
+
+
+def library_index_path(library_file, bin_width=DEFAULT_BIN_WIDTH, min_mz=0.0, sqrt_intensity=True, index_dir=None):
+    """
+    Path of the prebuilt index for a library, keyed by the library file and the binning parameters.
+    """
+    stat = os.stat(library_file)
+    key = f"{os.path.abspath(library_file)}|{stat.st_size}|{stat.st_mtime_ns}|{bin_width}|{min_mz}|{sqrt_intensity}|{INDEX_VERSION}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    index_dir = index_dir or os.path.dirname(os.path.abspath(library_file))
+    base_name = os.path.splitext(os.path.basename(library_file))[0]
+    return os.path.join(index_dir, f"{base_name}.{digest}.specidx.npz")
+
+
+def load_or_build_library_index(library_file, bin_width=DEFAULT_BIN_WIDTH, min_mz=0.0, sqrt_intensity=True, index_dir=None):
+    """
+    Loads the prebuilt index of a library, building and saving it on the first use.
+
+    Returns:
+    tuple: (SpectralLibraryIndex, path of the index file)
+    """
+    index_file = library_index_path(library_file, bin_width, min_mz, sqrt_intensity, index_dir)
+    if os.path.exists(index_file):
+        print(f"Loading spectral library index {index_file}")
+        return SpectralLibraryIndex.load(index_file), index_file
+
+    print(f"Building spectral library index for {library_file}")
+    index = SpectralLibraryIndex.build(library_file, bin_width=bin_width, min_mz=min_mz, sqrt_intensity=sqrt_intensity)
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    index.save(index_file)
+    return index, index_file
+
+
+def _assign_peaks(owner, lib_peak, query_peak, products):
+    """
+    Greedy one-to-one assignment of candidate peak pairs, by decreasing product within every
+    candidate: a library peak and a query peak are each used at most once.
+
+    Returns:
+    np.ndarray: Boolean mask of the assigned pairs.
+    """
+    order = np.lexsort((-products, owner))
+    lib_key = lib_peak[order]
+    query_key = owner[order] * (int(query_peak.max(initial=0)) + 1) + query_peak[order]
+    # pairs sharing no peak with another pair are always assigned, only the others need the greedy pass
+    _, lib_inverse, lib_counts = np.unique(lib_key, return_inverse=True, return_counts=True)
+    _, query_inverse, query_counts = np.unique(query_key, return_inverse=True, return_counts=True)
+    conflict = (lib_counts[lib_inverse] > 1) | (query_counts[query_inverse] > 1)
+    assigned = ~conflict
+    used_lib, used_query = set(), set()
+    for i in np.flatnonzero(conflict):
+        if lib_key[i] in used_lib or query_key[i] in used_query:
+            continue
+        used_lib.add(lib_key[i])
+        used_query.add(query_key[i])
+        assigned[i] = True
+    mask = np.zeros(len(order), dtype=bool)
+    mask[order] = assigned
+    return mask
+
+
+def score_candidates(index, start, stop, query_bins, query_values, query_precursor_mz, modified=True):
+    """
+    Scores one query against the library entries start:stop with sparse dot products.
+
+    The modified cosine matches every library peak to a query peak in the same bin or in the bin
+    shifted by the precursor mass difference, assigning each peak at most once (greedily, by
+    decreasing product), so it stays within [0, 1].
+
+    Returns:
+    tuple: cosine scores, modified cosine scores and number of matched peaks per candidate.
+    """
+    n_candidates = stop - start
+    cosine = np.zeros(n_candidates, dtype=np.float64)
+    modified_cosine = np.zeros(n_candidates, dtype=np.float64)
+    matched = np.zeros(n_candidates, dtype=np.int64)
+    if n_candidates == 0 or query_bins.size == 0:
+        return cosine, modified_cosine, matched
+
+    lo, hi = index.offsets[start], index.offsets[stop]
+    lib_bins = index.bins[lo:hi].astype(np.int64)
+    lib_values = index.values[lo:hi].astype(np.float64)
+    owner = np.repeat(np.arange(n_candidates), np.diff(index.offsets[start:stop + 1]))
+    query_bins = query_bins.astype(np.int64)
+
+    def _match(bins):
+        pos = np.searchsorted(query_bins, bins)
+        pos[pos == query_bins.size] = 0
+        hit = query_bins[pos] == bins
+        products = np.where(hit, lib_values * query_values[pos], 0.0)
+        return products, hit, pos
+
+    direct, direct_hit, direct_pos = _match(lib_bins)
+    cosine = np.bincount(owner, weights=direct, minlength=n_candidates)
+
+    if modified:
+        shift = np.rint((query_precursor_mz - index.precursor_mz[start:stop]) / index.bin_width).astype(np.int64)
+        shifted, shifted_hit, shifted_pos = _match(lib_bins + shift[owner])
+        # without a mass difference the shifted pairs are the direct ones
+        shifted_hit &= shift[owner] != 0
+        lib_peak = np.arange(lib_bins.size)
+        pair_owner = np.concatenate([owner[direct_hit], owner[shifted_hit]])
+        pair_products = np.concatenate([direct[direct_hit], shifted[shifted_hit]])
+        assigned = _assign_peaks(
+            pair_owner,
+            np.concatenate([lib_peak[direct_hit], lib_peak[shifted_hit]]),
+            np.concatenate([direct_pos[direct_hit], shifted_pos[shifted_hit]]),
+            pair_products,
+        )
+        modified_cosine = np.bincount(pair_owner[assigned], weights=pair_products[assigned], minlength=n_candidates)
+        matched = np.bincount(pair_owner[assigned], minlength=n_candidates).astype(np.int64)
+    else:
+        modified_cosine = cosine.copy()
+        matched = np.bincount(owner, weights=direct_hit.astype(np.float64), minlength=n_candidates).astype(np.int64)
+
+    return np.minimum(cosine, 1.0), modified_cosine, matched
+
+
+def search_queries(index, queries, precursor_tolerance_ppm=10.0, precursor_tolerance_da=None,
+                   min_score=0.7, min_matched_peaks=3, top_k=1, score="modified_cosine"):
+    """
+    Searches a batch of binned query spectra against the library index.
+
+    Parameters:
+    index (SpectralLibraryIndex): Prebuilt library index.
+    queries (list): Dicts with 'bins', 'values', 'precursor_mz', 'rt' and 'native_id'.
+    precursor_tolerance_ppm (float): Precursor window in ppm (used when no Da tolerance is given).
+    precursor_tolerance_da (float): Precursor window in Da, overrides the ppm tolerance.
+    min_score (float): Minimum score of a reported match.
+    min_matched_peaks (int): Minimum number of shared peaks of a reported match.
+    top_k (int): Number of matches reported per query.
+    score (str): "cosine" or "modified_cosine", used to rank the candidates.
+
+    Returns:
+    list: One dict per reported match.
+    """
+    if score not in ("cosine", "modified_cosine"):
+        raise ValueError(f"Unknown score: {score}")
+
+    hits = []
+    for query in queries:
+        precursor_mz = query["precursor_mz"]
+        tolerance = precursor_tolerance_da if precursor_tolerance_da is not None else precursor_mz * precursor_tolerance_ppm * 1e-6
+        start, stop = index.candidates(precursor_mz, tolerance)
+        if stop <= start:
+            continue
+        cosine, modified_cosine, matched = score_candidates(
+            index, start, stop, query["bins"], query["values"], precursor_mz,
+            modified=(score == "modified_cosine")
+        )
+        ranking = modified_cosine if score == "modified_cosine" else cosine
+        valid = np.flatnonzero((ranking >= min_score) & (matched >= min_matched_peaks))
+        if valid.size == 0:
+            continue
+        best = valid[np.argsort(ranking[valid])[::-1][:top_k]]
+        for rank, i in enumerate(best, start=1):
+            entry = start + i
+            hit = {
+                "native_id": query["native_id"],
+                "precursor_mz": precursor_mz,
+                "precursor_rt": query["rt"],
+                "rank": rank,
+                "score": float(ranking[i]),
+                "cosine": float(cosine[i]),
+                "modified_cosine": float(modified_cosine[i]),
+                "matched_peaks": int(matched[i]),
+                "library_precursor_mz": float(index.precursor_mz[entry]),
+            }
+            for field in LIBRARY_FIELDS:
+                hit[field] = str(index.metadata[field][entry])
+            hits.append(hit)
+    return hits
+
+
+def read_query_spectra(mzml_file, bin_width=DEFAULT_BIN_WIDTH, min_mz=0.0, sqrt_intensity=True, remove_precursor=True):
+    """
+    Reads the MS2 spectra of an mzML file and bins them with the library parameters.
+    """
+    exp = oms.MSExperiment()
+    oms.MzMLFile().load(mzml_file, exp)
+
+    queries = []
+    for spectrum in exp:
+        if spectrum.getMSLevel() != 2:
+            continue
+        precursors = spectrum.getPrecursors()
+        if not precursors:
+            continue
+        precursor_mz = precursors[0].getMZ()
+        mz, intensity = spectrum.get_peaks()
+        # peaks above the precursor carry no structural information
+        max_mz = precursor_mz - 0.5 if remove_precursor else None
+        bins, values = bin_spectrum(mz, intensity, bin_width=bin_width, min_mz=min_mz,
+                                    max_mz=max_mz, sqrt_intensity=sqrt_intensity)
+        if bins.size == 0:
+            continue
+        queries.append({
+            "native_id": spectrum.getNativeID(),
+            "rt": spectrum.getRT(),
+            "precursor_mz": precursor_mz,
+            "bins": bins,
+            "values": values,
+        })
+    return queries
+
+
+# the index is loaded once per worker process and reused for every batch
+_WORKER_INDEX = None
+
+
+def _init_worker(index_file):
+    global _WORKER_INDEX
+    _WORKER_INDEX = SpectralLibraryIndex.load(index_file)
+
+
+def _share_index(index):
+    global _WORKER_INDEX
+    _WORKER_INDEX = index
+
+
+def _search_batch(queries, search_kwargs):
+    return search_queries(_WORKER_INDEX, queries, **search_kwargs)
+
+
+def match_spectra(index, index_file, queries, n_workers=None, batch_size=2000, **search_kwargs):
+    """
+    Matches the query spectra against the library, splitting them in batches across a process
+    pool, or a thread pool sharing the loaded index in a daemonic Celery worker process.
+
+    Parameters:
+    index (SpectralLibraryIndex): Library index used in-process and by the threads.
+    index_file (str): Saved index loaded by every worker process.
+    queries (list): Binned query spectra (see read_query_spectra).
+    n_workers (int): Number of workers, 1 runs in-process. Defaults to the CPU count.
+    batch_size (int): Number of query spectra per batch.
+
+    Returns:
+    list: One dict per reported match.
+    """
+    n_workers = int(n_workers or os.cpu_count() or 1)
+    if n_workers <= 1 or len(queries) <= batch_size:
+        return search_queries(index, queries, **search_kwargs)
+
+    batches = [queries[i:i + batch_size] for i in range(0, len(queries), batch_size)]
+    # threads share the index already in memory, processes load the saved one
+    initializer, initargs = (_share_index, (index,)) if in_daemon_process() else (_init_worker, (index_file,))
+    hits = []
+    with worker_pool(min(n_workers, len(batches)), initializer=initializer, initargs=initargs) as executor:
+        for batch_hits in executor.map(_search_batch, batches, [search_kwargs] * len(batches)):
+            hits.extend(batch_hits)
+    return hits
+
+
+def hits_to_dataframe(hits, mzml_file=None):
+    columns = [
+        "native_id", "precursor_mz", "precursor_rt", "rank", "score", "cosine", "modified_cosine",
+        "matched_peaks", "library_precursor_mz", *LIBRARY_FIELDS
+    ]
+    df = pd.DataFrame(hits, columns=columns)
+    if mzml_file is not None:
+        df.insert(0, "file", os.path.basename(mzml_file))
+    return df
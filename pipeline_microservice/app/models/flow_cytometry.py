@@ -15,4 +15,9 @@ class FlowCytoPipelineRun:
     # update by chain id
     @staticmethod
     def update_by_chain_id(chain_id, data):
-        return mongo_flow_cytometry_pipeline.db.flow_cyto_pipeline_run.update_one({"chain_id": chain_id}, {"$set": data})
\ No newline at end of file
+        return mongo_flow_cytometry_pipeline.db.flow_cyto_pipeline_run.update_one({"chain_id": chain_id}, {"$set": data})
+    
+    # append step metrics by chain id
+    @staticmethod
+    def push_metrics_by_chain_id(chain_id, metrics):
+        return mongo_flow_cytometry_pipeline.db.flow_cyto_pipeline_run.update_one({"chain_id": chain_id}, {"$push": {"metrics": {"$each": list(metrics)}}})
@@ -29,3 +29,13 @@ class PipelineModel:
             {"task_id": task_id},
             {"$set": {"status": status}}
         )
+
+    @staticmethod
+    def push_metrics_by_task_id(task_id, metrics):
+        """
+        Append step metrics (list of dicts) to the pipeline run
+        """
+        return mongo_metabolomics_pipeline.db.pipeline.update_one(
+            {"task_id": task_id},
+            {"$push": {"metrics": {"$each": list(metrics)}}}
+        )
@@ -8,6 +8,11 @@ class ProteomicsPipelineModel:
     
     """
     
+    @staticmethod
+    def create_run(task_id, data):
+        # one document per run, keyed on the chain id that the stage and metrics updates target
+        return mongo_proteomics_pipeline.db.pipeline.insert_one({'task_id':task_id, **data})
+    
     @staticmethod
     def find_by_task_id(task_id):
         return mongo_proteomics_pipeline.db.pipeline.find_one({'task_id':task_id})
@@ -15,3 +20,12 @@ class ProteomicsPipelineModel:
     @staticmethod
     def update_by_task_id(task_id, data):
         return mongo_proteomics_pipeline.db.pipeline.update_one({'task_id':task_id}, {'$set':data})
+    
+    @staticmethod
+    def push_metrics_by_task_id(task_id, metrics):
+        return mongo_proteomics_pipeline.db.pipeline.update_one({'task_id':task_id}, {'$push':{'metrics':{'$each':list(metrics)}}})
+    
+    @staticmethod
+    def push_stage_by_task_id(task_id, stage):
+        # stages of the per-file chains finish concurrently, $push keeps every entry
+        return mongo_proteomics_pipeline.db.pipeline.update_one({'task_id':task_id}, {'$push':{'stages':stage}})
@@ -1,6 +1,9 @@
 import redis.exceptions
 from app import celery_microservice
-from ..flow_cytometry_functions import fcs_utilities as fcs
+from ..flow_cytometry_functions import fcs_utilities as fcs, knn_graph
+from app.models.flow_cytometry import FlowCytoPipelineRun
+from app.utils.instrumentation import pop_run_metrics
+from app.utils.progress import ProgressReporter, resolve_run_id
 import redis
 
 @celery_microservice.task(name='app.pipeline_tasks.flow_cytometry.select_fcs_files')
@@ -23,10 +26,23 @@ def select_fcs_files_task(file_paths: list):
         print(f"Error in read_fcs_files_task: {str(e)}")
         raise e
     
-@celery_microservice.task(name='app.pipeline_tasks.flow_cytometry.umap_dimensionality_reduction')
-def umap_dimensionality_reduction_task(json_str: str, data2) -> dict:
+def _step_progress(task, step):
+    """
+    Callback publishing progress(done, total) of a long step on the channel of its run.
+    """
     try:
-        result = fcs.umap_dimensionality_reduction(json_str, data2)
+        run_id = resolve_run_id(task.request.id, task.request.root_id)
+    except Exception as e:
+        print(f"Could not resolve the run of task {task.request.id}: {e}")
+        run_id = None
+    reporter = ProgressReporter(run_id or task.request.id, task=task)
+    return lambda done, total: reporter.update(step, done=done, total=total)
+
+
+@celery_microservice.task(bind=True, name='app.pipeline_tasks.flow_cytometry.umap_dimensionality_reduction')
+def umap_dimensionality_reduction_task(self, json_str: str, data2) -> dict:
+    try:
+        result = fcs.umap_dimensionality_reduction(json_str, data2, progress=_step_progress(self, 'umap'))
         print("UMAP dimensionality reduction task completed successfully")
         return result
     except Exception as e:
@@ -35,21 +51,50 @@ def umap_dimensionality_reduction_task(json_str: str, data2) -> dict:
 
 
 
+@celery_microservice.task(name='app.pipeline_tasks.flow_cytometry.knn_graph')
+def knn_graph_task(json_str: str, parameters=None) -> str:
+    """
+    Builds the approximate kNN graph of the events once; UMAP, Leiden and Louvain reuse it.
+
+    Args:
+        json_str (str): Event store of the events, the graph is saved in it.
+        parameters (dict): n_neighbors, scale, metric, n_jobs and seed of the construction, and
+            graph_neighbors, the neighbors the later steps of the run need (knn_graph.graph_neighbors).
+
+    Returns:
+        str: The event store, for the next step.
+    """
+    try:
+        parameters = parameters if isinstance(parameters, dict) else {}
+        knn_graph.build_knn_graph(
+            json_str,
+            n_neighbors=parameters.get('graph_neighbors') or parameters.get('n_neighbors'),
+            scale=bool(parameters.get('scale', False)),
+            metric=parameters.get('metric', 'euclidean'),
+            n_jobs=parameters.get('n_jobs'),
+            seed=parameters.get('seed'),
+        )
+        return json_str
+    except Exception as e:
+        print(f"Error in knn_graph_task: {str(e)}")
+        raise e
+
+
 @celery_microservice.task(name='app.pipeline_tasks.flow_cytometry.louvain_clustering')
-def louvain_clustering_task(json_str: str, k_neighbors: int = 100, resolution: float = 0.5) -> str:
+def louvain_clustering_task(data_paths: dict, k_neighbors: int = 30, resolution: float = 0.2) -> dict:
     """
-    Performs Louvain clustering on UMAP results
+    Performs PhenoGraph Louvain clustering on the shared kNN graph of the events
     
     Args:
-        json_str (str): JSON string containing UMAP results
-        k_neighbors (int): Number of nearest neighbors (default=100)
-        resolution (float): Resolution parameter for clustering (default=0.5)
+        data_paths (dict): Paths returned by the UMAP step
+        k_neighbors (int | dict): Number of nearest neighbors (default=30), or the step parameters
+        resolution (float): Resolution parameter for clustering (default=0.2)
         
     Returns:
-        str: JSON string containing clustering results
+        dict: Paths of the clustering results
     """
     try:
-        return fcs.louvain_clustering(json_str, k_neighbors, resolution)
+        return fcs.louvain_clustering(data_paths, k_neighbors, resolution)
     except Exception as e:
         print(f"Error in louvain_clustering_task: {str(e)}")
         raise e
@@ -65,6 +110,17 @@ def leiden_clustering_task(self, data_paths: dict, resolution: float = 1.0) -> d
         raise e
     
     
+@celery_microservice.task(bind=True, name='app.pipeline_tasks.flow_cytometry.leiden_sweep')
+def leiden_sweep_task(self, data_paths: dict, parameters=None) -> dict:
+    try:
+        result = fcs.leiden_resolution_sweep(self, data_paths, parameters)
+        print("Leiden resolution sweep task completed successfully")
+        return result
+    except Exception as e:
+        print(f"Error in leiden_sweep_task: {str(e)}")
+        raise e
+
+
 @celery_microservice.task(bind=True, name='app.pipeline_tasks.flow_cytometry.generate_heatmap_data')
 def generate_heatmap_data_task(self, data_paths: dict, other = 1) -> dict:
     try:
@@ -72,7 +128,8 @@ def generate_heatmap_data_task(self, data_paths: dict, other = 1) -> dict:
         print("self:", self)
         print("data_paths:", data_paths)
         
-        result = fcs.generate_heatmap_data(self, data_paths)
+        result = fcs.generate_heatmap_data(self, data_paths, other,
+                                           progress=_step_progress(self, 'generate_heatmap_data'))
         print("Heatmap data generation task completed successfully")
         return result
     except Exception as e:
@@ -109,4 +166,40 @@ def plot_scatter_task(data_paths: dict,data2 = 0) -> str:
         return scatterplot_path
     except Exception as e:
         print(f"Error in plot_scatter_task: {str(e)}")
-        raise e
\ No newline at end of file
+        raise e
+
+@celery_microservice.task(bind=True, name='app.pipeline_tasks.flow_cytometry.finalize_pipeline')
+def finalize_flow_cytometry_pipeline_task(self, results, step_names: list, grouped: bool = False) -> dict:
+    """
+    Last task of the flow cytometry canvas: collects the results of the final (possibly parallel)
+    steps and stores them on the pipeline run. Its id is the chain id returned to the client.
+
+    Args:
+        results: Result of the last step, or the list of results of the parallel steps when grouped.
+        step_names (list): Names of the steps that produced the results.
+        grouped (bool): Whether the results come from a group.
+
+    Returns:
+        dict: The merged results keyed as stored on the pipeline run.
+    """
+    chain_id = self.request.id
+    try:
+        if not grouped:
+            results = [results]
+        merged = {}
+        for name, result in zip(step_names, results):
+            if isinstance(result, dict):
+                merged.update(result)
+            elif result is not None:
+                merged[f"{name}_path"] = result
+        merged['status'] = 'completed'
+        FlowCytoPipelineRun.update_by_chain_id(chain_id, merged)
+        # metrics of the previous tasks of the canvas, collected under the root id
+        task_metrics = pop_run_metrics(self.request.root_id or chain_id)
+        if task_metrics:
+            FlowCytoPipelineRun.push_metrics_by_chain_id(chain_id, task_metrics)
+        print("Flow cytometry pipeline completed successfully")
+        return merged
+    except Exception as e:
+        print(f"Error in finalize_flow_cytometry_pipeline_task: {str(e)}")
+        raise e
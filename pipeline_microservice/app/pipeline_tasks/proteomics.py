@@ -1,13 +1,64 @@
 import os 
+import time
 import pyopenms as oms
 from app import celery_microservice
-from ..proteomics_functions import processing_workflow as pw
+from ..proteomics_functions import processing_workflow as pw, msfragger, percolator, fdr, extract_info_flashlfq, flashlfq, quantification_matrix
+from app.models.proteomics import ProteomicsPipelineModel
+from app.utils.instrumentation import pop_run_metrics, count_items
+from app.utils.progress import resolve_run_id
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
 proteomics_save_path = os.getenv('PROTEOMICS_SAVE_PATH')
+tools_path = os.getenv('TOOLS_BASE_PATH')
+
+
+def _run_id(task):
+    """
+    Id of the pipeline run (the chain id returned to the client) a task belongs to.
+    """
+    try:
+        run_id = resolve_run_id(task.request.id, task.request.root_id)
+    except Exception as e:
+        print(f"Could not resolve the run of task {task.request.id}: {e}")
+        run_id = None
+    return run_id or task.request.root_id or task.request.id
+
+
+def _run_dir(task):
+    run_dir = os.path.join(proteomics_save_path or 'generated_files', _run_id(task))
+    os.makedirs(run_dir, exist_ok=True)
+    return run_dir
+
+
+def _record_stage(task, stage, started_at, artifacts, **extra):
+    """
+    Stores the timing and the artifacts of a stage on the pipeline document of the run.
+    """
+    try:
+        ProteomicsPipelineModel.push_stage_by_task_id(_run_id(task), dict(
+            stage=stage,
+            task_id=task.request.id,
+            started_at=started_at,
+            wall_time_sec=round(time.time() - started_at, 3),
+            artifacts=artifacts,
+            **extra
+        ))
+    except Exception as e:
+        print(f"Could not record the {stage} stage: {str(e)}")
+
+
+def _flatten(file_paths):
+    # fan-in steps receive one list per per-file chain
+    files = []
+    for item in file_paths:
+        if isinstance(item, (list, tuple)):
+            files.extend(item)
+        else:
+            files.append(item)
+    return files
 
 # function for the select mzml files
 @celery_microservice.task(name='app.pipeline_tasks.proteomics.select_mzml_files')
@@ -41,10 +92,11 @@ def select_mzml_files(file_paths: list):
         raise e
 
 
-@celery_microservice.task(name='app.pipeline_tasks.proteomics.select_spectra')
-def select_spectra(file_paths, lower_rt=None, upper_rt=None, first_scan=None, last_scan=None):
+@celery_microservice.task(bind=True, name='app.pipeline_tasks.proteomics.select_spectra')
+def select_spectra(self, file_paths, lower_rt=None, upper_rt=None, first_scan=None, last_scan=None, **criteria):
     """
-    Celery task to select spectra from mzML files based on retention time or scan range.
+    Celery task to select spectra from mzML files based on retention time or scan range. Every
+    file is read once and the selected spectra are written while it is streamed.
     
     Args:
         file_paths (list): List of paths to mzML files.
@@ -52,57 +104,266 @@ def select_spectra(file_paths, lower_rt=None, upper_rt=None, first_scan=None, la
         upper_rt (float): Upper bound of the RT range in seconds.
         first_scan (int): First scan number.
         last_scan (int): Last scan number.
+        criteria: Other criteria of pw.build_spectrum_predicate (excluded_scans, lower_charge,
+            upper_charge, min_precursor_mz, max_precursor_mz, ms_levels).
         
     Returns:
-        list: List of selected spectra.
+        list: List of the filtered mzML files.
     """
     try:
-        # use the output of the select_mzml_files task
-        # iterate over files
+        started_at = time.time()
+        run_dir = _run_dir(self)
         saved_files_filtered = []
         for file_path in file_paths:
-            # check the rt 
-            if lower_rt is not None and upper_rt is not None:
-                selected_spectra = pw.select_spectra_by_rt(file_path, lower_rt, upper_rt)
-            # if only one 
-            # check the scan
-            elif first_scan is not None or last_scan is not None:
-                selected_spectra = pw.select_spectra_by_scan(file_path, first_scan, last_scan)
-            # save the spectra to the file
-            # create a file name to save the spectra
-            file_name = os.path.basename(file_path) + "_filtered.mzML"
-            pw.save_selected_spectra(file_path, selected_spectra, file_name)
+            # the filtered files of a run share a folder, FlashLFQ reads them from there
+            file_name = os.path.join(run_dir, os.path.splitext(os.path.basename(file_path))[0] + "_filtered.mzML")
+            counts = pw.stream_select_spectra(
+                file_path, file_name, lower_rt=lower_rt, upper_rt=upper_rt,
+                first_scan=first_scan, last_scan=last_scan, **criteria
+            )
+            count_items('spectra', counts['spectra_written'])
             # append the file name to the list
             saved_files_filtered.append(file_name)
+        _record_stage(self, 'select_spectra', started_at, saved_files_filtered, files=file_paths)
         # return the list of filtered files
         return saved_files_filtered
     except Exception as e:
         print(f"Error in select_spectra_task: {str(e)}")
         raise e
     
-# create the msfragger step
-@celery_microservice.task(name='app.pipeline_tasks.proteomics.msfragger_step')
-def msfragger_step(file_paths, params):
+@celery_microservice.task(bind=True, name='app.pipeline_tasks.proteomics.preprocess_spectra')
+def preprocess_spectra(self, file_paths, params):
     """
-    Celery task to run MSFragger on mzML files.
+    Celery task reducing the MS2 peaks of mzML files before the database search (precursor
+    window removal, deisotoping, intensity threshold, top-N peaks, charge deconvolution). A JSON
+    report with the reduction is written next to every file.
     
     Args:
         file_paths (list): List of paths to mzML files.
-        params (dict): Parameters for MSFragger.
+        params (dict): Options of pw.preprocess_peaks, plus ms_levels and batch_size.
         
     Returns:
-        list: List of paths to the output files.
+        list: List of the pre-processed mzML files.
     """
     try:
-        # iterate over files
-        saved_files = []
+        started_at = time.time()
+        run_dir = _run_dir(self)
+        options = {k: v for k, v in params.items() if k in (
+            'top_n', 'min_intensity', 'min_relative_intensity', 'precursor_window', 'deisotope',
+            'max_charge', 'isotope_tolerance', 'single_charge', 'batch_size')}
+        output_files = []
+        reports = []
         for file_path in file_paths:
-            # run msfragger
-            output_file = pw.run_msfragger(file_path, params)
-            # append the file name to the list
-            saved_files.append(output_file)
+            stem = os.path.splitext(os.path.basename(file_path))[0]
+            output_file = os.path.join(run_dir, stem + "_preprocessed.mzML")
+            report = pw.preprocess_spectra(
+                file_path, output_file, report_file=os.path.join(run_dir, stem + "_preprocessing.json"),
+                ms_levels=tuple(params.get('ms_levels', (2,))), **options
+            )
+            output_files.append(output_file)
+            reports.append({k: report[k] for k in (
+                'input_file', 'peaks_before', 'peaks_after', 'size_reduction', 'estimated_search_time_saving')})
+        _record_stage(self, 'preprocess_spectra', started_at, output_files, reports=reports)
+        return output_files
+    except Exception as e:
+        print(f"Error in preprocess_spectra_task: {str(e)}")
+        raise e
+
+
+# create the msfragger step
+@celery_microservice.task(bind=True, name='app.pipeline_tasks.proteomics.msfragger_step')
+def msfragger_step(self, file_paths, params):
+    """
+    Celery task to run MSFragger on mzML files. Per file, it runs in the chain of its file; in
+    batch mode all the files are searched in batches sharing one JVM and one peptide index,
+    and the task receives the files of all the per-file chains as a list of lists.
+    
+    Args:
+        file_paths (list): List of paths to mzML files, or of lists of paths.
+        params (dict): Parameters for MSFragger (params_file, msfragger_path, java_path, memory,
+            threads, timeout, batch_size, cache_index), and file_params_files, the parameters file
+            of some spectra files (by path or file name) when they differ from params_file; the
+            files are searched in batches per parameter set.
+        
+    Returns:
+        list: List of paths to the output files.
+    """
+    try:
+        started_at = time.time()
+        files = _flatten(file_paths)
+        msfragger_path = params.get('msfragger_path') or os.path.join(tools_path, 'MSFragger.jar')
+        params_file = params.get('params_file') or os.path.join(tools_path, 'parameters', 'fragger.params')
+        options = {key: params[key] for key in ('java_path', 'memory', 'threads', 'timeout', 'batch_size', 'cache_index')
+                   if params.get(key) is not None}
+        file_params_files = params.get('file_params_files') or {}
+        file_params = [
+            (f, file_params_files.get(f) or file_params_files.get(os.path.basename(f)) or params_file)
+            for f in files
+        ]
+        saved_files = msfragger.run_msfragger_batches(file_params, msfragger_path,
+                                                      output_dir=_run_dir(self), **options)
+        count_items('spectra_files', len(files))
+        _record_stage(self, 'msfragger', started_at, saved_files, files=files)
         # return the list of output files
         return saved_files
     except Exception as e:
         print(f"Error in msfragger_step_task: {str(e)}")
-        raise e
\ No newline at end of file
+        raise e
+
+
+@celery_microservice.task(bind=True, name='app.pipeline_tasks.proteomics.percolator_step')
+def percolator_step(self, pin_files, params):
+    """
+    Celery task joining the per-file searches: the PIN files of all the runs are merged and
+    rescored by a single Percolator run, so that the FDR is consistent across the files. With
+    fdr_mode 'native' the q-values are computed in process on the search score instead (no
+    rescoring), together with peptide and protein group level q-values.
+    
+    Args:
+        pin_files (list): PIN files, or one list of PIN files per per-file chain.
+        params (dict): Parameters for Percolator (fdr_mode, train_fdr, test_fdr, q_value, threads,
+            timeout, score_column and decoy_prefix for the native mode).
+        
+    Returns:
+        dict: The PIN files, the merged PIN, the Percolator PSMs and the accepted PSM ids file.
+    """
+    try:
+        started_at = time.time()
+        pin_files = [f for f in _flatten(pin_files) if f and os.path.exists(f)]
+        if not pin_files:
+            raise ValueError("No PIN file produced by the search")
+        run_dir = _run_dir(self)
+        merged_pin = percolator.merge_pin_files(pin_files, os.path.join(run_dir, 'merged.pin'))
+        fdr_mode = params.get('fdr_mode', 'percolator')
+        outputs = {}
+        if fdr_mode == 'native':
+            outputs = fdr.run_native_fdr(
+                merged_pin, os.path.join(run_dir, 'native_fdr'), q_value=params.get('q_value', 0.01),
+                score_column=params.get('score_column'), decoy_prefix=params.get('decoy_prefix', fdr.DECOY_PREFIX),
+            )
+            psms_file = outputs['psms']
+        elif fdr_mode == 'percolator':
+            psms_file = percolator.run_percolator(
+                merged_pin, os.path.join(run_dir, 'percolator'),
+                threads=params.get('threads', 3), timeout=params.get('timeout'),
+                train_fdr=params.get('train_fdr', 0.01), test_fdr=params.get('test_fdr', 0.01),
+            )
+        else:
+            raise ValueError(f"Unknown fdr_mode: {fdr_mode}")
+        accepted = percolator.accepted_psm_ids(psms_file, params.get('q_value', 0.01))
+        count_items('psms', len(accepted))
+        accepted_file = os.path.join(run_dir, 'accepted_psms.txt')
+        with open(accepted_file, 'w') as f:
+            f.write('\n'.join(accepted))
+        result = {
+            'pin_files': pin_files,
+            'merged_pin': merged_pin,
+            'psms_file': psms_file,
+            'accepted_psms_file': accepted_file,
+            'peptides_file': outputs.get('peptides'),
+            'proteins_file': outputs.get('proteins'),
+        }
+        artifacts = [merged_pin, psms_file] + [outputs[k] for k in ('peptides', 'proteins') if k in outputs]
+        _record_stage(self, 'percolator', started_at, artifacts, accepted_psms=len(accepted), fdr_mode=fdr_mode)
+        return result
+    except Exception as e:
+        print(f"Error in percolator_step_task: {str(e)}")
+        raise e
+
+
+@celery_microservice.task(bind=True, name='app.pipeline_tasks.proteomics.flashlfq_step')
+def flashlfq_step(self, percolator_result, params):
+    """
+    Celery task quantifying the accepted PSMs of all the files with one FlashLFQ run, then
+    annotating the quantified proteins with the gene names of the FASTA and building the
+    normalized protein x sample matrix.
+    
+    Args:
+        percolator_result (dict): Output of percolator_step.
+        params (dict): Parameters for FlashLFQ (fasta_file, threads, timeout) and of the protein
+            matrix (matrix: log_base, normalization, imputation, min_valid, seed; None skips it).
+        
+    Returns:
+        list: Paths of the FlashLFQ outputs, the protein matrix and the annotated proteins first.
+    """
+    try:
+        started_at = time.time()
+        run_dir = _run_dir(self)
+        pairs = [(pin_file, msfragger.mzml_path(pin_file)) for pin_file in percolator_result['pin_files']]
+        with open(percolator_result['accepted_psms_file']) as f:
+            accepted = [line for line in f.read().splitlines() if line]
+
+        # FlashLFQ reads all the spectra files from one folder
+        spectra_dir = os.path.join(run_dir, 'spectra')
+        os.makedirs(spectra_dir, exist_ok=True)
+        for _, mzml_file in pairs:
+            link = os.path.join(spectra_dir, os.path.basename(mzml_file))
+            if not os.path.exists(link):
+                os.symlink(os.path.abspath(mzml_file), link)
+
+        identifications = extract_info_flashlfq.build_flashlfq_input(
+            pairs, os.path.join(run_dir, 'flashlfq_input.tsv'), accepted_ids=accepted
+        )
+        output_files = flashlfq.run_flashlfq(
+            identifications, os.path.join(spectra_dir, os.path.basename(pairs[0][1])),
+            os.path.join(run_dir, 'flashlfq'), threads=params.get('threads'), timeout=params.get('timeout')
+        )
+        outputs = list(output_files.values())
+        proteins_file = output_files['QuantifiedProteins.tsv']
+        fasta_file = params.get('fasta_file')
+        if fasta_file:
+            proteins_file = flashlfq.filter_and_annotate_quantified_proteins(proteins_file, fasta_file)
+            outputs.insert(0, proteins_file)
+        matrix_params = params.get('matrix', {})
+        if matrix_params is not None:
+            matrix_file = quantification_matrix.build_quantification_matrix(
+                proteins_file, os.path.join(run_dir, 'protein_matrix.parquet'),
+                log_base=matrix_params.get('log_base', 2),
+                normalization=matrix_params.get('normalization', 'median'),
+                imputation=matrix_params.get('imputation'),
+                min_valid=matrix_params.get('min_valid', 1),
+                seed=matrix_params.get('seed', 0),
+            )
+            outputs.insert(0, matrix_file)
+        _record_stage(self, 'flashlfq', started_at, outputs, identifications=identifications)
+        return outputs
+    except Exception as e:
+        print(f"Error in flashlfq_step_task: {str(e)}")
+        raise e
+
+@celery_microservice.task(bind=True, name='app.pipeline_tasks.proteomics.finalize_pipeline')
+def finalize_proteomics_pipeline(self, results, step_names, grouped=False):
+    """
+    Celery task closing the proteomics canvas: flattens the per-file results and stores them
+    on the pipeline document. Its id is the chain id returned to the client.
+
+    Args:
+        results: Result of the last step, or the list of per-file results when grouped.
+        step_names (list): Names of the steps that produced the results.
+        grouped (bool): Whether the results come from a group.
+
+    Returns:
+        list: List of paths to the output files.
+    """
+    try:
+        if not grouped:
+            results = [results]
+        output_files = []
+        for result in results:
+            if isinstance(result, list):
+                output_files.extend(result)
+            elif result is not None:
+                output_files.append(result)
+        ProteomicsPipelineModel.update_by_task_id(self.request.id, {
+            'output_files': output_files,
+            'last_step': step_names[-1],
+            'status': 'completed'
+        })
+        # metrics of the previous tasks of the canvas, collected under the root id
+        task_metrics = pop_run_metrics(self.request.root_id or self.request.id)
+        if task_metrics:
+            ProteomicsPipelineModel.push_metrics_by_task_id(self.request.id, task_metrics)
+        return output_files
+    except Exception as e:
+        print(f"Error in finalize_proteomics_pipeline_task: {str(e)}")
+        raise e
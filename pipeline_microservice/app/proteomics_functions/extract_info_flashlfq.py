@@ -1,24 +1,96 @@
 import pandas as pd
-from pyteomics import mzml
+import polars as pl
+import pyopenms as oms
 import os
 import re
-import io  # aggiungi questo import
+import logging
+from app.utils.pools import worker_pool
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# folder of the scan -> RT sidecars, next to the mzML files when not set
+RT_INDEX_CACHE_PATH = os.getenv('RT_INDEX_CACHE_PATH')
+RT_INDEX_SUFFIX = '.scan_rt.parquet'
+
+CHARGE_COLUMNS = [
+    'charge_1', 'charge_2', 'charge_3', 'charge_4',
+    'charge_5', 'charge_6', 'charge_7_or_more'
+]
+FLASHLFQ_COLUMNS = [
+    "File Name", "Base Sequence", "Full Sequence", "Peptide Monoisotopic Mass",
+    "Scan Retention Time", "Precursor Charge", "Protein Accession"
+]
+
+
+def rt_index_path(mzml_path):
+    if RT_INDEX_CACHE_PATH:
+        return os.path.join(RT_INDEX_CACHE_PATH, os.path.basename(mzml_path) + RT_INDEX_SUFFIX)
+    return mzml_path + RT_INDEX_SUFFIX
+
+
+def build_rt_index(mzml_path):
+    """
+    Reads the scan number and retention time (minutes) of every spectrum of an mzML file. Peak
+    data are not decoded, only the spectrum metadata.
+
+    Returns:
+        pl.DataFrame: Columns scan (Int64) and rt (Float64).
+    """
+    print(f"Indexing retention times of mzML: {mzml_path}")
+    options = oms.PeakFileOptions()
+    options.setFillData(False)
+    options.setSkipXMLChecks(True)
+    mzml_file = oms.MzMLFile()
+    mzml_file.setOptions(options)
+    exp = oms.MSExperiment()
+    mzml_file.load(mzml_path, exp)
+
+    native_ids = []
+    rts = []
+    for spectrum in exp:
+        native_ids.append(spectrum.getNativeID())
+        rts.append(spectrum.getRT() / 60.0)
+    index = (
+        pl.DataFrame({'native_id': native_ids, 'rt': rts}, schema={'native_id': pl.Utf8, 'rt': pl.Float64})
+        .with_columns(pl.col('native_id').str.extract(r'scan=(\d+)', 1).cast(pl.Int64).alias('scan'))
+        .drop_nulls('scan')
+        .unique('scan', keep='first')
+        .select('scan', 'rt')
+        .sort('scan')
+    )
+    print(f"Extracted {index.height} retention times from mzML.")
+    return index
+
+
+def load_rt_index(mzml_path):
+    """
+    Returns the scan -> RT table of an mzML file, built once and cached in a Parquet sidecar
+    that is rebuilt when the mzML file is newer.
+    """
+    sidecar = rt_index_path(mzml_path)
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(mzml_path):
+        return pl.read_parquet(sidecar)
+    index = build_rt_index(mzml_path)
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(sidecar)), exist_ok=True)
+        tmp_path = sidecar + '.tmp'
+        index.write_parquet(tmp_path, compression='zstd')
+        os.replace(tmp_path, sidecar)
+    except OSError as e:
+        logger.warning(f"Could not cache the retention times of {mzml_path}: {e}")
+    return index
+
 
 def get_retention_times(mzml_path):
-    rt_dict = {}
-    print(f"Parsing mzML: {mzml_path}")
-    with mzml.MzML(mzml_path) as reader:
-        for spectrum in reader:
-            scan_id = spectrum.get('id', '')
-            if 'scan=' in scan_id:
-                try:
-                    scan_number = int(scan_id.split('scan=')[-1].split()[0])
-                    rt = spectrum['scanList']['scan'][0]['scan start time']
-                    rt_dict[scan_number] = rt
-                except Exception as e:
-                    print(f"Error parsing spectrum {scan_id}: {e}")
-    print(f"Extracted {len(rt_dict)} retention times from mzML.")
-    return rt_dict
+    """
+    Returns a dict mapping the scan numbers of an mzML file to their retention time in minutes.
+    """
+    index = load_rt_index(mzml_path)
+    return dict(zip(index['scan'].to_list(), index['rt'].to_list()))
+
 
 def extract_protein_accession(protein_string):
     # Estrae solo l'accession da una stringa tipo "sp|P12345|PROTEIN_HUMAN"
@@ -29,49 +101,141 @@ def extract_protein_accession(protein_string):
     else:
         return protein_string
 
+
+def read_pin(pin_path):
+    """
+    Reads a Percolator PIN file as strings. Proteins is the last column and may hold several
+    tab separated accessions, they are joined with ';'.
+
+    Returns:
+        pl.DataFrame: One Utf8 column per header field.
+    """
+    with open(pin_path) as f:
+        header = f.readline().rstrip('\r\n').split('\t')
+        lines = [
+            line.rstrip('\r\n') for line in f
+            if line.strip() and not line.startswith(('#', 'DefaultDirection'))
+        ]
+    fields = pl.Series('line', lines, dtype=pl.Utf8).str.splitn('\t', len(header))
+    df = (
+        fields.struct.rename_fields(header)
+        .struct.unnest()
+    )
+    if 'Proteins' in df.columns:
+        df = df.with_columns(pl.col('Proteins').str.replace_all('\t', ';'))
+    return df
+
+
+def pin_to_flashlfq(pin, mzml_filename, rt_index=None, accepted_ids=None):
+    """
+    Converts the PSMs of a PIN table to the FlashLFQ identification format with column
+    expressions only.
+
+    Args:
+        pin (pl.DataFrame): Output of read_pin().
+        mzml_filename (str): Name of the spectra file of the PSMs.
+        rt_index (pl.DataFrame): scan/rt table of the file, the retentiontime column of the PIN is
+            used for the scans it does not contain.
+        accepted_ids (pl.Series): SpecIds to keep, e.g. the PSMs accepted by Percolator.
+
+    Returns:
+        pl.DataFrame: The FlashLFQ input rows, PSMs without a charge are dropped.
+    """
+    if accepted_ids is not None:
+        pin = pin.filter(pl.col('SpecId').is_in(accepted_ids))
+    charge_columns = [c for c in CHARGE_COLUMNS if c in pin.columns]
+    # the charge columns are one-hot encoded, charge_N holds charge N
+    charge = pl.coalesce([
+        pl.when(pl.col(c).cast(pl.Float64) > 0).then(pl.lit(int(re.search(r'\d+', c).group())))
+        for c in charge_columns
+    ]) if charge_columns else pl.lit(None, dtype=pl.Int64)
+
+    # K.PEPTIDE.R -> PEPTIDE, modifications are kept in the full sequence only
+    full_sequence = pl.col('Peptide').str.replace(r'^[^.]\.(.+)\.[^.]$', '$1')
+    df = pin.with_columns(
+        charge.alias('Precursor Charge'),
+        pl.col('ScanNr').cast(pl.Int64).alias('scan'),
+        full_sequence.alias('Full Sequence'),
+    )
+    missing = df.filter(pl.col('Precursor Charge').is_null()).height
+    if missing:
+        print(f"Skipping {missing} PSMs without a valid precursor charge")
+    df = df.filter(pl.col('Precursor Charge').is_not_null())
+
+    pin_rt = pl.col('retentiontime').cast(pl.Float64) if 'retentiontime' in pin.columns else pl.lit(None, dtype=pl.Float64)
+    if rt_index is not None:
+        df = df.join(rt_index, on='scan', how='left')
+        rt = pl.coalesce([pl.col('rt'), pin_rt])
+    else:
+        rt = pin_rt
+
+    # Estrai solo l'accession se ci sono più proteine separate da ';'
+    accessions = (
+        pl.col('Proteins').cast(pl.Utf8).str.split(';')
+        .list.eval(pl.coalesce([pl.element().str.extract(r'\|([A-Z0-9]+)\|', 1), pl.element()]))
+        .list.join(';')
+    )
+    return df.select(
+        pl.lit(mzml_filename).alias('File Name'),
+        pl.col('Full Sequence').str.replace_all(r'\[[^\]]*\]', '').str.replace_all(r'[^A-Z]', '').alias('Base Sequence'),
+        pl.col('Full Sequence'),
+        pl.col('ExpMass').cast(pl.Float64).alias('Peptide Monoisotopic Mass'),
+        rt.alias('Scan Retention Time'),
+        pl.col('Precursor Charge').cast(pl.Int64),
+        accessions.alias('Protein Accession'),
+    )
+
+
 def parse_pin(pin_path, mzml_path):
-    mzml_filename = os.path.basename(mzml_path)
-    rt_dict = get_retention_times(mzml_path)
-    rows = []
+    """
+    Builds the FlashLFQ input of a PIN file and the mzML file it was searched on.
 
+    Returns:
+        pd.DataFrame: The FlashLFQ identification rows.
+    """
     print(f"Parsing Percolator .pin: {pin_path}")
-    # Leggi il file .pin saltando eventuali righe di commento
-    with open(pin_path) as f:
-        lines = [line for line in f if not line.startswith('#')]
-    df = pd.read_csv(io.StringIO(''.join(lines)), sep='\t')
+    df = pin_to_flashlfq(read_pin(pin_path), os.path.basename(mzml_path), load_rt_index(mzml_path))
+    print(f"Parsed {df.height} PSMs from .pin.")
+    # built from python lists, to_pandas() would need pyarrow
+    return pd.DataFrame(df.to_dict(as_series=False), columns=FLASHLFQ_COLUMNS)
+
+
+def build_flashlfq_input(pin_mzml_pairs, output_path, max_workers=None, accepted_ids=None):
+    """
+    Builds one FlashLFQ identification file for a set of samples. The missing RT sidecars are
+    built in parallel processes (threads in a daemonic Celery worker), then the PIN files are
+    converted and concatenated.
+
+    Args:
+        pin_mzml_pairs (list): (pin_path, mzml_path) tuples.
+        output_path (str): Path of the TSV written for FlashLFQ.
+        max_workers (int): Workers used to index the mzML files.
+        accepted_ids (list): SpecIds of the PSMs to quantify, all by default.
+
+    Returns:
+        str: output_path
+    """
+    pairs = list(pin_mzml_pairs)
+    to_index = sorted({
+        mzml_path for _, mzml_path in pairs
+        if not os.path.exists(rt_index_path(mzml_path))
+        or os.path.getmtime(rt_index_path(mzml_path)) < os.path.getmtime(mzml_path)
+    })
+    if len(to_index) > 1:
+        with worker_pool(max_workers or min(len(to_index), os.cpu_count() or 1)) as executor:
+            list(executor.map(load_rt_index, to_index))
 
-    charge_columns = [
-        'charge_1', 'charge_2', 'charge_3', 'charge_4',
-        'charge_5', 'charge_6', 'charge_7_or_more'
+    if accepted_ids is not None:
+        accepted_ids = pl.Series('SpecId', list(accepted_ids), dtype=pl.Utf8)
+    frames = [
+        pin_to_flashlfq(read_pin(pin_path), os.path.basename(mzml_path), load_rt_index(mzml_path), accepted_ids)
+        for pin_path, mzml_path in pairs
     ]
+    df = pl.concat(frames, how='vertical') if frames else pl.DataFrame(schema={c: pl.Utf8 for c in FLASHLFQ_COLUMNS})
+    df.write_csv(output_path, separator='\t')
+    print(f"FlashLFQ input with {df.height} PSMs from {len(pairs)} files saved to: {output_path}")
+    return output_path
 
-    for idx, row in df.iterrows():
-        base_seq = row['Peptide']
-        theo_mass = row['ExpMass']
-        charge = None
-        for col in charge_columns:
-            if col in row and row[col] > 0:
-                charge = row[col]
-                break
-        if charge is None:
-            print(f"Skipping row {idx}: No valid precursor charge found (Peptide: {row['Peptide']}, ScanNr: {row['ScanNr']})")
-            continue
-        scan = int(row['ScanNr'])
-        protein_accession = row['Proteins']
-        rt = rt_dict.get(scan, row['retentiontime'] if 'retentiontime' in row else None)
-        # Estrai solo l'accession se ci sono più proteine separate da ';'
-        protein_accession = ';'.join([extract_protein_accession(p) for p in str(protein_accession).split(';')])
-        rows.append({
-            "File Name": mzml_filename,
-            "Base Sequence": base_seq,
-            "Full Sequence": base_seq,  # Modifica qui se vuoi aggiungere modifiche
-            "Peptide Monoisotopic Mass": theo_mass,
-            "Scan Retention Time": rt,
-            "Precursor Charge": int(charge),
-            "Protein Accession": protein_accession
-        })
-    print(f"Parsed {len(rows)} PSMs from .pin.")
-    return pd.DataFrame(rows)
 
 if __name__ == "__main__":
     pin_path = "/media/datastorage/it_cast/omnis_microservice_db/test_db/20250228_04_01.pin"
@@ -80,4 +244,4 @@ if __name__ == "__main__":
 
     df = parse_pin(pin_path, mzml_path)
     df.to_csv(output_path, sep="\t", index=False)
-    print(f"File pronto per FlashLFQ salvato in: {output_path}")
\ No newline at end of file
+    print(f"File pronto per FlashLFQ salvato in: {output_path}")
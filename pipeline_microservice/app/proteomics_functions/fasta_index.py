@@ -0,0 +1,192 @@
+import os
+import hashlib
+import logging
+import threading
+import polars as pl
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# one folder per FASTA content hash, shared by all the proteomics runs of the host
+FASTA_INDEX_CACHE_PATH = os.getenv("FASTA_INDEX_CACHE_PATH") or os.path.join(
+    os.getenv("PROTEOMICS_BASE_PATH") or "generated_files", "fasta_index"
+)
+INDEX_FILE = "index.arrow"
+
+INDEX_SCHEMA = {
+    "id": pl.Utf8,
+    "accession": pl.Utf8,
+    "entry_name": pl.Utf8,
+    "gene_name": pl.Utf8,
+    "organism": pl.Utf8,
+    "length": pl.Int32,
+}
+
+# sp|P12345|NAME_HUMAN, tr|A0A024R161|A0A024R161_HUMAN, with an optional decoy prefix
+UNIPROT_ID_PATTERN = r"(?:sp|tr|swiss-prot)\|([^|]+)\|"
+
+_file_digests = {}
+_indexes = {}
+_lock = threading.Lock()
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    SHA-256 of a file. FASTA files are large and rarely change, so the hash is kept per
+    (path, size, mtime) for the lifetime of the process.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in _file_digests:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+        _file_digests[key] = digest.hexdigest()
+    return _file_digests[key]
+
+
+def _read_headers(fasta_file):
+    """
+    Reads the header lines of a FASTA file and the length of each sequence.
+    """
+    headers = []
+    lengths = []
+    length = 0
+    with open(fasta_file) as f:
+        for line in f:
+            if line.startswith(">"):
+                if headers:
+                    lengths.append(length)
+                headers.append(line[1:].rstrip("\r\n"))
+                length = 0
+            else:
+                length += len(line.strip())
+    if headers:
+        lengths.append(length)
+    return headers, lengths
+
+
+def build_fasta_index(fasta_file):
+    """
+    Parses a FASTA file into a table of its proteins: id (first word of the header), accession,
+    entry name, gene name (GN=), organism (OS=) and sequence length, sorted by accession.
+
+    Returns:
+        pl.DataFrame: The index, columns as in INDEX_SCHEMA.
+    """
+    print(f"Indexing FASTA file: {fasta_file}")
+    headers, lengths = _read_headers(fasta_file)
+    header = pl.col("header")
+    index = (
+        pl.DataFrame({"header": headers, "length": lengths}, schema={"header": pl.Utf8, "length": pl.Int32})
+        .with_columns(header.str.extract(r"^(\S+)", 1).alias("id"))
+        .with_columns(
+            pl.coalesce([pl.col("id").str.extract(UNIPROT_ID_PATTERN, 1), pl.col("id")]).alias("accession"),
+            pl.col("id").str.extract(r"^[^|]+\|[^|]+\|(\S+)", 1).alias("entry_name"),
+            header.str.extract(r"\sGN=(\S+)", 1).alias("gene_name"),
+            header.str.extract(r"\sOS=(.+?)(?:\s+[A-Z]{2}=|$)", 1).alias("organism"),
+        )
+        .select(list(INDEX_SCHEMA))
+        .sort("accession")
+    )
+    print(f"Indexed {index.height} proteins from FASTA")
+    return index
+
+
+def load_fasta_index(fasta_file, cache_dir=None):
+    """
+    Returns the index of a FASTA file. It is built once per FASTA content, stored as an
+    uncompressed Arrow file and memory-mapped by the later runs, and kept in memory by the
+    process.
+
+    Args:
+        fasta_file (str): Path to the FASTA file.
+        cache_dir (str): Index cache, defaults to FASTA_INDEX_CACHE_PATH.
+
+    Returns:
+        pl.DataFrame: The index, see build_fasta_index().
+    """
+    if not os.path.exists(fasta_file):
+        raise FileNotFoundError(f"FASTA file not found: {fasta_file}")
+    digest = file_digest(fasta_file)
+    with _lock:
+        if digest in _indexes:
+            return _indexes[digest]
+        path = os.path.join(cache_dir or FASTA_INDEX_CACHE_PATH, digest, INDEX_FILE)
+        if os.path.exists(path):
+            # uncompressed IPC files are memory-mapped by read_ipc
+            index = pl.read_ipc(path)
+        else:
+            index = build_fasta_index(fasta_file)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = path + ".tmp"
+                # uncompressed so that the file can be memory-mapped
+                index.write_ipc(tmp_path, compression="uncompressed")
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"Could not cache the index of {fasta_file}: {e}")
+        _indexes[digest] = index
+        return index
+
+
+def normalize_accession(expr):
+    """
+    Polars expression extracting the accession from a protein id (sp|P12345|NAME_HUMAN -> P12345),
+    ids without the UniProt prefix are returned stripped.
+    """
+    expr = expr.str.strip_chars()
+    return pl.coalesce([expr.str.extract(UNIPROT_ID_PATTERN, 1), expr])
+
+
+def annotate_protein_groups(protein_groups, index, columns=("gene_name",), separator=";"):
+    """
+    Looks up the proteins of many protein groups ("P12345;Q67890") in one join.
+
+    Args:
+        protein_groups (list | pl.Series | pd.Series): Protein groups, one per row.
+        index (pl.DataFrame): Output of load_fasta_index().
+        columns (tuple): Index columns to return.
+        separator (str): Separator of the proteins within a group.
+
+    Returns:
+        pl.DataFrame: One row per input group with, for each column, the values of its proteins
+            joined with the separator; proteins missing from the index (or without a value)
+            get their own id.
+    """
+    groups = pl.DataFrame({"group": pl.Series(list(protein_groups), dtype=pl.Utf8)}).with_row_index("row")
+    proteins = (
+        groups.with_columns(pl.col("group").fill_null("").str.split(separator).alias("protein"))
+        .explode("protein")
+        .with_row_index("position")
+        .with_columns(normalize_accession(pl.col("protein")).alias("accession"))
+    )
+    lookup = index.select(["accession", *columns]).unique("accession", keep="first")
+    matched = proteins.join(lookup, on="accession", how="left").sort("position")
+    aggregated = (
+        matched.group_by("row", maintain_order=True)
+        .agg([
+            pl.coalesce([pl.col(column).cast(pl.Utf8), pl.col("protein")])
+            .filter(pl.col("protein") != "")
+            .str.join(separator)
+            .alias(column)
+            for column in columns
+        ])
+    )
+    return groups.join(aggregated, on="row", how="left").sort("row").select(["group", *columns])
+
+
+def missing_accessions(protein_groups, index, column="gene_name", separator=";"):
+    """
+    Accessions of the groups that are not in the index or have no value for the column.
+    """
+    proteins = (
+        pl.Series(list(protein_groups), dtype=pl.Utf8).fill_null("").str.split(separator).explode()
+        .to_frame("protein").filter(pl.col("protein") != "")
+        .with_columns(normalize_accession(pl.col("protein")).alias("accession"))
+    )
+    known = index.filter(pl.col(column).is_not_null()).select("accession")
+    return proteins.join(known, on="accession", how="anti")["accession"].unique().sort().to_list()
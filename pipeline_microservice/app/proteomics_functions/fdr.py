@@ -0,0 +1,236 @@
+import os
+import numpy as np
+import polars as pl
+from scipy import sparse
+from app.proteomics_functions.extract_info_flashlfq import read_pin
+
+# score columns tried in order when none is given, all of them are "higher is better"
+SCORE_COLUMNS = ("hyperscore", "score", "xcorr")
+DECOY_PREFIX = "rev_"
+
+
+def read_psms(path, score_column=None, decoy_prefix=DECOY_PREFIX):
+    """
+    Reads the PSMs of a PIN file or of an MSFragger TSV into the columns used by the FDR engine.
+
+    Args:
+        path (str): .pin file, or MSFragger .tsv output.
+        score_column (str): Column used to rank the PSMs (higher is better).
+        decoy_prefix (str): Prefix of the decoy proteins, used when the file has no Label column.
+
+    Returns:
+        pl.DataFrame: psm_id, is_decoy, score, peptide, proteins (list of accessions).
+    """
+    if path.lower().endswith(".pin"):
+        df = read_pin(path)
+        id_column, peptide_column, proteins = "SpecId", "Peptide", pl.col("Proteins").str.split(";")
+        is_decoy = pl.col("Label").cast(pl.Int32) < 0
+    else:
+        df = pl.read_csv(path, separator="\t", infer_schema_length=0)
+        id_column = "spectrum" if "spectrum" in df.columns else "scannum"
+        peptide_column = "modified_peptide" if "modified_peptide" in df.columns else "peptide"
+        proteins = pl.concat_list([
+            pl.col("protein").fill_null(""),
+            pl.col("alternative_proteins").fill_null("").str.split(",") if "alternative_proteins" in df.columns else pl.lit([], dtype=pl.List(pl.Utf8)),
+        ]).list.eval(pl.element().str.strip_chars().filter(pl.element() != ""))
+        is_decoy = None
+
+    score_column = score_column or next((c for c in SCORE_COLUMNS if c in df.columns), None)
+    if score_column is None:
+        raise ValueError(f"No score column found in {path}, pass score_column")
+
+    psms = df.select(
+        pl.col(id_column).alias("psm_id"),
+        pl.col(score_column).cast(pl.Float64).alias("score"),
+        # K.PEPTIDE.R -> PEPTIDE
+        pl.col(peptide_column).fill_null("").str.replace(r"^[^.]\.(.+)\.[^.]$", "$1").alias("peptide"),
+        proteins.alias("proteins"),
+    )
+    if is_decoy is None:
+        # a PSM is decoy when all its proteins are decoys
+        is_decoy = pl.col("proteins").list.eval(pl.element().str.starts_with(decoy_prefix)).list.all()
+        psms = psms.with_columns(is_decoy.alias("is_decoy"))
+    else:
+        psms = psms.with_columns(df.select(is_decoy.alias("is_decoy")).to_series())
+    return psms.filter(pl.col("score").is_not_null())
+
+
+def target_decoy_qvalues(scores, is_decoy):
+    """
+    Target-decoy q-values: the entries are sorted by decreasing score, the FDR at each score is
+    (decoys + 1) / targets from cumulative counts, and the q-value is the lowest FDR at that
+    score or below. Tied scores share the FDR of the last entry of the tie.
+
+    Args:
+        scores (np.ndarray): Scores, higher is better.
+        is_decoy (np.ndarray): Boolean decoy flags.
+
+    Returns:
+        np.ndarray: q-values aligned with the input.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    is_decoy = np.asarray(is_decoy, dtype=bool)
+    if scores.size == 0:
+        return np.empty(0)
+    order = np.argsort(-scores, kind="stable")
+    sorted_scores = scores[order]
+    decoys = np.cumsum(is_decoy[order])
+    targets = np.arange(1, scores.size + 1) - decoys
+    fdr = (decoys + 1) / np.maximum(targets, 1)
+    # last position of every run of tied scores
+    last_of_tie = np.r_[np.flatnonzero(np.diff(sorted_scores) != 0), scores.size - 1]
+    tie_index = np.repeat(last_of_tie, np.diff(np.r_[-1, last_of_tie]))
+    fdr = fdr[tie_index]
+    q_sorted = np.minimum.accumulate(fdr[::-1])[::-1]
+    q_values = np.empty_like(q_sorted)
+    q_values[order] = np.minimum(q_sorted, 1.0)
+    return q_values
+
+
+def best_per(df, key):
+    """
+    Keeps the best scoring row of every value of key.
+    """
+    return df.sort("score", descending=True).unique(key, keep="first", maintain_order=True)
+
+
+def _row_entries(matrix, rows):
+    """
+    Column indices of the non-zero entries of some rows of a CSR matrix, without slicing it.
+    """
+    starts = matrix.indptr[rows]
+    lengths = matrix.indptr[rows + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    return matrix.indices[offsets]
+
+
+def parsimony(peptides):
+    """
+    Parsimonious protein inference on a peptide x protein incidence matrix: proteins with the
+    same peptides form one group, then groups are picked greedily by the number of peptides not
+    yet explained, so that the smallest set of groups explains all the peptides.
+
+    Args:
+        peptides (pl.DataFrame): peptide, score, is_decoy and proteins (list).
+
+    Returns:
+        pl.DataFrame: protein_group (';' joined accessions), score (best peptide score),
+            is_decoy, n_peptides and peptides (';' joined).
+    """
+    peptide_names = peptides["peptide"].to_numpy()
+    # rows follow the order of the peptides table
+    pairs = (
+        peptides.select("proteins").with_row_index("row")
+        .explode("proteins").filter(pl.col("proteins").is_not_null() & (pl.col("proteins") != ""))
+    )
+    rows = pairs["row"].to_numpy().astype(np.int64)
+    protein_names, protein_codes = np.unique(pairs["proteins"].to_numpy().astype(str), return_inverse=True)
+    matrix = sparse.csc_matrix(
+        (np.ones(len(rows), dtype=np.int8), (rows, protein_codes)),
+        shape=(len(peptide_names), len(protein_names)),
+    )
+    # duplicated accessions of a peptide are summed by the constructor
+    matrix.data[:] = 1
+
+    # indistinguishable proteins: identical columns
+    matrix.sort_indices()
+    signatures = [matrix.indices[matrix.indptr[j]:matrix.indptr[j + 1]].tobytes() for j in range(matrix.shape[1])]
+    _, first, group_of = np.unique(np.array(signatures, dtype=object), return_index=True, return_inverse=True)
+    group_members = [[] for _ in range(len(first))]
+    for protein, group in enumerate(group_of):
+        group_members[group].append(protein_names[protein])
+    groups = matrix[:, first].tocsc()
+
+    # greedy set cover on the groups
+    uncovered = np.ones(groups.shape[0], dtype=bool)
+    remaining = np.asarray(groups.sum(axis=0)).ravel().astype(np.int64)
+    selected = []
+    groups_csr = groups.tocsr()
+    while uncovered.any():
+        best = int(np.argmax(remaining))
+        if remaining[best] <= 0:
+            break
+        selected.append(best)
+        newly = groups.indices[groups.indptr[best]:groups.indptr[best + 1]]
+        newly = newly[uncovered[newly]]
+        uncovered[newly] = False
+        # the newly explained peptides no longer count for the groups containing them
+        np.subtract.at(remaining, _row_entries(groups_csr, newly), 1)
+        remaining[best] = 0
+
+    scores = peptides["score"].to_numpy()
+    decoy_peptides = peptides["is_decoy"].to_numpy()
+    records = {"protein_group": [], "score": [], "is_decoy": [], "n_peptides": [], "peptides": []}
+    for group in selected:
+        rows_of_group = groups.indices[groups.indptr[group]:groups.indptr[group + 1]]
+        records["protein_group"].append(";".join(group_members[group]))
+        records["score"].append(float(scores[rows_of_group].max()))
+        records["is_decoy"].append(bool(decoy_peptides[rows_of_group].all()))
+        records["n_peptides"].append(len(rows_of_group))
+        records["peptides"].append(";".join(peptide_names[rows_of_group]))
+    return pl.DataFrame(records, schema={
+        "protein_group": pl.Utf8, "score": pl.Float64, "is_decoy": pl.Boolean, "n_peptides": pl.Int64, "peptides": pl.Utf8,
+    })
+
+
+def compute_fdr(psms):
+    """
+    PSM, peptide and protein group level target-decoy q-values.
+
+    Args:
+        psms (pl.DataFrame): Output of read_psms().
+
+    Returns:
+        dict: psms, peptides and proteins tables, each with a q_value column.
+    """
+    psms = psms.with_columns(
+        pl.Series("q_value", target_decoy_qvalues(psms["score"].to_numpy(), psms["is_decoy"].to_numpy()))
+    )
+    peptides = best_per(psms, "peptide").select("peptide", "score", "is_decoy", "proteins", pl.col("psm_id").alias("best_psm"))
+    peptides = peptides.with_columns(
+        pl.Series("q_value", target_decoy_qvalues(peptides["score"].to_numpy(), peptides["is_decoy"].to_numpy()))
+    )
+    proteins = parsimony(peptides)
+    proteins = proteins.with_columns(
+        pl.Series("q_value", target_decoy_qvalues(proteins["score"].to_numpy(), proteins["is_decoy"].to_numpy()))
+    ).sort("score", descending=True)
+    return {"psms": psms, "peptides": peptides, "proteins": proteins}
+
+
+def run_native_fdr(input_file, output_prefix, q_value=0.01, score_column=None, decoy_prefix=DECOY_PREFIX):
+    """
+    In-process alternative to run_percolator: plain target-decoy FDR on the search score,
+    without rescoring. The PSMs file has the columns of the Percolator target PSMs output, so
+    the following steps accept both.
+
+    Parameters:
+    - input_file (str): PIN file or MSFragger TSV.
+    - output_prefix (str): Prefix of the output files.
+    - q_value (float): Threshold reported in the log, every target PSM is written with its q-value.
+
+    Returns:
+    - dict: Paths of the PSMs, peptides and proteins tables.
+    """
+    tables = compute_fdr(read_psms(input_file, score_column=score_column, decoy_prefix=decoy_prefix))
+    psms, peptides, proteins = tables["psms"], tables["peptides"], tables["proteins"]
+    outputs = {
+        "psms": f"{output_prefix}_psms.pin",
+        "peptides": f"{output_prefix}_peptides.tsv",
+        "proteins": f"{output_prefix}_proteins.tsv",
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output_prefix)), exist_ok=True)
+    psms.filter(~pl.col("is_decoy")).sort("score", descending=True).select(
+        pl.col("psm_id").alias("PSMId"),
+        "score",
+        pl.col("q_value").alias("q-value"),
+        pl.lit(None, dtype=pl.Float64).alias("posterior_error_prob"),
+        "peptide",
+        pl.col("proteins").list.join("\t").alias("proteinIds"),
+    ).write_csv(outputs["psms"], separator="\t", quote_style="never")
+    peptides.with_columns(pl.col("proteins").list.join(";")).write_csv(outputs["peptides"], separator="\t")
+    proteins.write_csv(outputs["proteins"], separator="\t")
+
+    for level, table in (("PSMs", psms), ("peptides", peptides), ("protein groups", proteins)):
+        accepted = table.filter(~pl.col("is_decoy") & (pl.col("q_value") <= q_value)).height
+        print(f"{accepted} {level} at q-value <= {q_value}")
+    return outputs
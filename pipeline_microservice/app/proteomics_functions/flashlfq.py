@@ -1,10 +1,12 @@
 import os 
 import subprocess   
 from dotenv import load_dotenv
+from app.utils.tool_runner import run_tool, get_tool_runner
 import sys
 import pandas as pd
+import polars as pl
 import re
-from Bio import SeqIO
+from app.proteomics_functions import fasta_index, uniprot
 
 load_dotenv()
 
@@ -24,6 +26,7 @@ def verify_input_files(input_pin_file, mzml_file):
 def parse_fasta_for_gene_names(fasta_file):
     """
     Parse FASTA file to extract gene names for each protein accession.
+    The FASTA is indexed once per content (see fasta_index.load_fasta_index).
     
     Parameters:
     - fasta_file (str): Path to the FASTA file
@@ -31,28 +34,10 @@ def parse_fasta_for_gene_names(fasta_file):
     Returns:
     - dict: Dictionary mapping protein accessions to gene names
     """
-    gene_map = {}
-    
-    if not os.path.exists(fasta_file):
-        raise FileNotFoundError(f"FASTA file not found: {fasta_file}")
-    
-    print(f"Parsing FASTA file: {fasta_file}")
-    
-    with open(fasta_file, "r") as file:
-        for record in SeqIO.parse(file, "fasta"):
-            # Extract accession from the record ID
-            accession = record.id
-            
-            # Extract gene name from the description
-            description = record.description
-            gene_name = extract_gene_name_from_description(description)
-            
-            if gene_name:
-                gene_map[accession] = gene_name
-            else:
-                # If no gene name found, use the accession as fallback
-                gene_map[accession] = accession
-    
+    index = fasta_index.load_fasta_index(fasta_file)
+    # If no gene name found, use the accession as fallback
+    genes = index.select(pl.col("id"), pl.coalesce([pl.col("gene_name"), pl.col("id")]))
+    gene_map = dict(zip(genes["id"].to_list(), genes["gene_name"].to_list()))
     print(f"Extracted gene names for {len(gene_map)} proteins from FASTA")
     return gene_map
 
@@ -128,39 +113,17 @@ def filter_and_annotate_quantified_proteins(quantified_proteins_file, fasta_file
     
     print(f"After filtering zero intensities: {df_filtered.shape}")
     
-    # Parse FASTA file to get gene names
-    gene_map = parse_fasta_for_gene_names(fasta_file)
-    
-    # Add gene names to the dataframe
-    def get_gene_name(protein_groups):
-        if pd.isna(protein_groups) or protein_groups == '':
-            return ''
-        
-        # Split by semicolon if multiple proteins
-        proteins = str(protein_groups).split(';')
-        gene_names = []
-        
-        for protein in proteins:
-            protein = protein.strip()
-            
-            # Try direct lookup first
-            if protein in gene_map:
-                gene_names.append(gene_map[protein])
-                continue
-            
-            # Try to extract accession from UniProt format
-            accession = extract_accession_from_protein_id(protein)
-            if accession and accession in gene_map:
-                gene_names.append(gene_map[accession])
-                continue
-            
-            # If not found, use the original protein ID
-            gene_names.append(protein)
-        
-        return ';'.join(gene_names)
-    
-    # Apply gene name mapping
-    df_filtered['Gene Name'] = df_filtered['Protein Groups'].apply(get_gene_name)
+    # Gene names from the FASTA index, the proteins it does not name come from the local UniProt cache
+    index = fasta_index.load_fasta_index(fasta_file)
+    protein_groups = df_filtered['Protein Groups'].fillna('').astype(str).tolist()
+    missing = fasta_index.missing_accessions(protein_groups, index)
+    cached_genes = uniprot.get_gene_names(missing) if missing else {}
+    if cached_genes:
+        # first, so that they win over the index entries without gene name
+        cached = pl.DataFrame({'accession': list(cached_genes), 'gene_name': list(cached_genes.values())})
+        index = pl.concat([cached, index.select('accession', 'gene_name')], how='vertical')
+    annotated = fasta_index.annotate_protein_groups(protein_groups, index)
+    df_filtered['Gene Name'] = annotated['gene_name'].to_list()
     
     # Reorder columns to put Gene Name after Protein Groups
     cols = df_filtered.columns.tolist()
@@ -208,7 +171,7 @@ def extract_accession_from_protein_id(protein_id):
     # Return original if no pattern matches
     return protein_id
 
-def run_flashlfq(input_pin_file, mzml_file, output_dir):
+def run_flashlfq(input_pin_file, mzml_file, output_dir, threads=None, timeout=None):
     """
     Run FlashLFQ from the command line on the given PIN file.
     
@@ -216,6 +179,8 @@ def run_flashlfq(input_pin_file, mzml_file, output_dir):
     - input_pin_file (str): Path to the FlashLFQ input (.pin) or (.tsv) file.
     - mzml_file (str): Path to the mzML file.
     - output_dir (str): Output directory for FlashLFQ results.
+    - threads (int): Threads used by FlashLFQ, defaults to the whole tool CPU budget.
+    - timeout (float): Seconds before FlashLFQ is killed.
     
     Returns:
     - dict: Paths to the output files
@@ -239,17 +204,14 @@ def run_flashlfq(input_pin_file, mzml_file, output_dir):
         '--sha',
         "--chg",
     ]
+    threads = threads or get_tool_runner().max_cpus
+    command += ["--thr", str(threads)]
     
     print(f"Running FlashLFQ: {' '.join(command)}")
     try:
-        result = subprocess.run(
-            command,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        print("FlashLFQ Output:")
-        print(result.stdout)
+        # the output is streamed to the task log by the tool runner
+        result = run_tool(command, tool="dotnet", threads=threads, timeout=timeout, capture_output=True,
+                          label=os.path.basename(input_pin_file))
         
         # Check for expected output files
         expected_files = [
@@ -1,14 +1,45 @@
 import pyopenms
 import os
-import subprocess
+import re
+import json
+import shutil
+import fcntl
+import hashlib
+import logging
+from contextlib import contextmanager
 from dotenv import load_dotenv
+from app.utils.tool_runner import run_tool, parse_memory
+from app.proteomics_functions.fasta_index import file_digest
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# FASTA copies keyed by content and digestion parameters, MSFragger stores its .pepindex next to them
+MSFRAGGER_INDEX_CACHE_PATH = os.getenv("MSFRAGGER_INDEX_CACHE_PATH") or os.path.join(
+    os.getenv("PROTEOMICS_BASE_PATH") or "generated_files", "msfragger_index"
+)
+MSFRAGGER_MAX_BATCH_SIZE = int(os.getenv("MSFRAGGER_MAX_BATCH_SIZE", 16))
+# heap needed per byte of mzML searched in the same JVM, on top of the peptide index
+MSFRAGGER_HEAP_PER_MZML_BYTE = float(os.getenv("MSFRAGGER_HEAP_PER_MZML_BYTE", 1.5))
+# share of the heap kept for the peptide index and the JVM itself
+MSFRAGGER_INDEX_HEAP_SHARE = 0.4
+# memory of the JVM outside of the heap (metaspace, thread stacks, GC structures, direct buffers)
+MSFRAGGER_JVM_NATIVE_MEMORY = os.getenv("MSFRAGGER_JVM_NATIVE_MEMORY", "4G")
+
+# parameters that change the in-silico digest, and therefore the peptide index
+DIGEST_PARAM_PREFIXES = (
+    "database_name", "decoy_prefix", "search_enzyme", "num_enzyme_termini", "allowed_missed_cleavage",
+    "clip_nTerm_M", "digest_", "min_peptide_length", "max_peptide_length", "variable_mod",
+    "max_variable_mods", "allow_multiple_variable_mods", "add_", "mass_offsets", "isotope_error",
+    "precursor_mass_mode", "precursor_true_units", "precursor_true_tolerance",
+)
+
 
 ## create a basic function to run the correct msfragger
 
-def msfragger_node(spectra_file, msfragger_path, params_file, java_path="/usr/local/jdk-11.0.26+4/bin/java", memory="16G"):
+def msfragger_node(spectra_file, msfragger_path, params_file, java_path="/usr/local/jdk-11.0.26+4/bin/java", memory="16G",
+                   threads=None, timeout=None):
     """
     Function to run MSFragger on a given mzML file.
     Parameters:
@@ -16,18 +47,21 @@ def msfragger_node(spectra_file, msfragger_path, params_file, java_path="/usr/lo
         params_file (str): Path to the MSFragger parameters file.
         java_path (str): Path to the Java executable.
         memory (str): Memory allocation for Java (e.g., "16G").
+        threads (int): CPU slots reserved for MSFragger, None reserves the whole tool budget.
+        timeout (float): Seconds before MSFragger is killed.
     """
     
     # check the java version
     java_version_command = [java_path, "-version"]
-    java_version_process = subprocess.run(java_version_command, capture_output=True, text=True)
+    run_tool(java_version_command, tool="java-version", check=False)
     # add a debugging output defining the file processing
     
     # run ms fragger with the specified java version
     command = [java_path, "-Xmx" + memory, "-jar", msfragger_path, params_file, spectra_file]
     
-    # get the result of the msfragger process
-    result = subprocess.run(command, capture_output=True, text=True)
+    # get the result of the msfragger process, the heap plus the JVM overhead is reserved from the memory budget
+    result = run_tool(command, tool="java", threads=threads, timeout=timeout, check=False,
+                      memory_limit=jvm_memory_limit(memory), label=os.path.basename(spectra_file))
     
     # output the result of the msfragger process
     if result.returncode == 0:
@@ -36,10 +70,235 @@ def msfragger_node(spectra_file, msfragger_path, params_file, java_path="/usr/lo
         print(f"Error processing {spectra_file}: {result.stderr}")
         
     # return the path of the processed msfragger file 
-    return spectra_file.replace(".mzML", ".pin")
+    return pin_path(spectra_file)
+
+
+
+def jvm_memory_limit(memory):
+    """
+    Resident memory allowed to an MSFragger JVM: its heap plus a fixed native allowance, which
+    does not shrink with the heap like a proportional margin would.
+    """
+    return parse_memory(memory) + parse_memory(MSFRAGGER_JVM_NATIVE_MEMORY)
+
+
+def pin_path(spectra_file):
+    """
+    Path of the PIN file MSFragger writes next to a spectra file.
+    """
+    return os.path.splitext(spectra_file)[0] + ".pin"
+
+
+def mzml_path(pin_file):
+    return os.path.splitext(pin_file)[0] + ".mzML"
+
+
+def read_params(params_file):
+    """
+    Reads an MSFragger parameters file ("key = value # comment" lines) into a dict.
+    """
+    params = {}
+    with open(params_file) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if "=" in line:
+                key, value = line.split("=", 1)
+                params[key.strip()] = value.strip()
+    return params
+
+
+def write_params(params, params_file):
+    # written aside and renamed, MSFragger runs of the same run may be reading the file
+    tmp_path = f"{params_file}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        for key, value in params.items():
+            f.write(f"{key} = {value}\n")
+    os.replace(tmp_path, params_file)
+    return params_file
+
+
+def digest_key(params):
+    """
+    Key of the peptide index produced by a parameter set: hash of the FASTA content and of the
+    parameters that affect the digest.
+    """
+    fasta_files = [p for p in re.split(r"[:;]", params.get("database_name", "")) if p]
+    digest_params = {k: v for k, v in sorted(params.items()) if k.startswith(DIGEST_PARAM_PREFIXES) and k != "database_name"}
+    payload = {
+        "fasta": [file_digest(f) for f in fasta_files],
+        "params": digest_params,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def prepare_index_cache(params_file, output_dir, cache_dir=None):
+    """
+    Points the database of a parameters file to a FASTA in the index cache, so that the
+    .pepindex files MSFragger writes next to it are reused by every later run with the same
+    FASTA and digestion parameters, whatever the folder of the original FASTA.
+
+    Args:
+        params_file (str): MSFragger parameters file.
+        output_dir (str): Folder of the rewritten parameters file.
+        cache_dir (str): Index cache, defaults to MSFRAGGER_INDEX_CACHE_PATH.
+
+    Returns:
+        tuple: (parameters file to run MSFragger with, index cache folder or None).
+    """
+    params = read_params(params_file)
+    fasta_files = [p for p in re.split(r"[:;]", params.get("database_name", "")) if p]
+    if len(fasta_files) != 1 or not os.path.exists(fasta_files[0]):
+        # MSFragger indexes a single database, anything else is passed through untouched
+        return params_file, None
+    key = digest_key(params)
+    index_dir = os.path.join(cache_dir or MSFRAGGER_INDEX_CACHE_PATH, key)
+    cached_fasta = os.path.join(index_dir, os.path.basename(fasta_files[0]))
+    try:
+        os.makedirs(index_dir, exist_ok=True)
+        if not os.path.exists(cached_fasta):
+            try:
+                os.link(fasta_files[0], cached_fasta)
+            except OSError:
+                shutil.copyfile(fasta_files[0], cached_fasta)
+    except OSError as e:
+        logger.warning(f"Could not use the MSFragger index cache {index_dir}: {e}")
+        return params_file, None
+    print(f"MSFragger peptide index {key}: {'reused' if _has_index(index_dir) else 'built on the first run'}")
+    params["database_name"] = cached_fasta
+    os.makedirs(output_dir, exist_ok=True)
+    # the per-file tasks of a run share the file, it is written once
+    run_params_file = os.path.join(output_dir, f"fragger_{key}.params")
+    if not os.path.exists(run_params_file):
+        write_params(params, run_params_file)
+    return run_params_file, index_dir
+
 
+def _has_index(index_dir):
+    return any(name.endswith(".pepindex") for name in os.listdir(index_dir))
 
 
+@contextmanager
+def index_build_lock(index_dir):
+    """
+    Holds an exclusive lock on an index cache folder while it has no peptide index, so that a
+    single MSFragger run builds it and the concurrent ones wait for it instead of writing the
+    same files. Once the index exists the lock is released at once.
+    """
+    if index_dir is None:
+        yield
+        return
+    with open(os.path.join(index_dir, ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if _has_index(index_dir):
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        yield
+
+
+def memory_aware_batch_size(spectra_files, memory, max_batch_size=None):
+    """
+    Number of spectra files searched in one JVM: the heap left after the peptide index must
+    hold the largest files of the batch.
+    """
+    max_batch_size = max_batch_size or MSFRAGGER_MAX_BATCH_SIZE
+    heap = parse_memory(memory)
+    largest = max((os.path.getsize(f) for f in spectra_files if os.path.exists(f)), default=0)
+    per_file = largest * MSFRAGGER_HEAP_PER_MZML_BYTE
+    if per_file <= 0:
+        return max_batch_size
+    available = heap * (1 - MSFRAGGER_INDEX_HEAP_SHARE)
+    return int(max(1, min(max_batch_size, available // per_file)))
+
+
+def msfragger_batch(spectra_files, msfragger_path, params_file, java_path="/usr/local/jdk-11.0.26+4/bin/java",
+                    memory="16G", threads=None, timeout=None, batch_size=None, output_dir=None, cache_index=True):
+    """
+    Runs MSFragger on many mzML files with the same parameters, several files per JVM: the
+    peptide index is built once per invocation instead of once per file, and kept in the index
+    cache between runs.
+
+    Parameters:
+        spectra_files (list): Paths to the mzML files.
+        msfragger_path (str): Path to the MSFragger JAR file.
+        params_file (str): Path to the MSFragger parameters file.
+        java_path (str): Path to the Java executable.
+        memory (str): Memory allocation for Java (e.g., "16G").
+        threads (int): CPU slots reserved for MSFragger, None reserves the whole tool budget.
+        timeout (float): Seconds before an invocation is killed.
+        batch_size (int): Files per invocation, derived from the heap and the file sizes by default.
+        output_dir (str): Folder of the rewritten parameters file, the folder of the first file by default.
+        cache_index (bool): Reuse the peptide index between runs.
+
+    Returns:
+        list: Paths of the PIN files, in the order of spectra_files.
+
+    Raises:
+        RuntimeError: If an invocation fails or leaves a file without PIN, with its stderr.
+    """
+    spectra_files = list(spectra_files)
+    if not spectra_files:
+        return []
+    index_dir = None
+    if cache_index:
+        params_file, index_dir = prepare_index_cache(
+            params_file, output_dir or os.path.dirname(os.path.abspath(spectra_files[0])))
+    batch_size = batch_size or memory_aware_batch_size(spectra_files, memory)
+    batches = [spectra_files[i:i + batch_size] for i in range(0, len(spectra_files), batch_size)]
+    print(f"Running MSFragger on {len(spectra_files)} files in {len(batches)} batches of up to {batch_size}")
+
+    for batch in batches:
+        command = [java_path, "-Xmx" + memory, "-jar", msfragger_path, params_file, *batch]
+        with index_build_lock(index_dir):
+            result = run_tool(command, tool="java", threads=threads, timeout=timeout, check=False,
+                              memory_limit=jvm_memory_limit(memory),
+                              label=f"{len(batch)} files from {os.path.basename(batch[0])}")
+        missing = [f for f in batch if not os.path.exists(pin_path(f))]
+        if not result.ok or missing:
+            reason = "timeout" if result.timed_out else "memory limit" if result.memory_exceeded \
+                else f"exit code {result.returncode}"
+            if missing:
+                reason += f", no PIN file for {', '.join(os.path.basename(f) for f in missing)}"
+            raise RuntimeError(f"MSFragger failed on the batch starting at {batch[0]} ({reason}):\n{result.stderr}")
+        print(f"Successfully processed: {', '.join(os.path.basename(f) for f in batch)}")
+    return [pin_path(f) for f in spectra_files]
+
+
+def group_files_by_params(file_params):
+    """
+    Groups spectra files by the content of their parameters file, so that every group can run
+    in the same invocations.
+
+    Args:
+        file_params (list): (spectra_file, params_file) tuples.
+
+    Returns:
+        dict: params_file -> list of spectra files, one entry per distinct parameter set.
+    """
+    groups = {}
+    by_content = {}
+    for spectra_file, params_file in file_params:
+        content = json.dumps(read_params(params_file), sort_keys=True)
+        representative = by_content.setdefault(content, params_file)
+        groups.setdefault(representative, []).append(spectra_file)
+    return groups
+
+
+def run_msfragger_batches(file_params, msfragger_path, **kwargs):
+    """
+    Runs MSFragger in batch mode on files that may use different parameter sets, one series
+    of batches per parameter set.
+
+    Args:
+        file_params (list): (spectra_file, params_file) tuples.
+        kwargs: Passed to msfragger_batch().
+
+    Returns:
+        list: Paths of the PIN files, in the order of file_params.
+    """
+    outputs = {}
+    for params_file, spectra_files in group_files_by_params(file_params).items():
+        for spectra_file, pin_file in zip(spectra_files, msfragger_batch(spectra_files, msfragger_path, params_file, **kwargs)):
+            outputs[spectra_file] = pin_file
+    return [outputs[spectra_file] for spectra_file, _ in file_params]
 
 
 # test the function
@@ -1,31 +1,76 @@
 import pyopenms
 import os
-import subprocess
+import polars as pl
 from dotenv import load_dotenv
+from app.utils.tool_runner import run_tool
+from app.proteomics_functions.extract_info_flashlfq import read_pin
 
 load_dotenv()
 
 
 # set up the percolator node
-def run_percolator(input_pin_file, output_prefix):
+def run_percolator(input_pin_file, output_prefix, threads=3, timeout=None, train_fdr=0.01, test_fdr=0.01):
     """
     Run Percolator from the command line on the given PIN file.
     
     Parameters:
     - input_pin_file (str): Path to the Percolator input (.pin) file.
     - output_prefix (str): Prefix for output files generated by Percolator.
+    - threads (int): CPU slots reserved for Percolator (it trains the cross-validation folds in parallel).
+    - timeout (float): Seconds before Percolator is killed.
+    - train_fdr, test_fdr (float): FDR thresholds of the training and of the evaluation.
+    
+    Returns:
+    - str: Path of the target PSMs file.
     """
     percolator_command = [
         "percolator",
-        "--trainFDR", "0.01",
-        "--testFDR", "0.01",
+        "--trainFDR", str(train_fdr),
+        "--testFDR", str(test_fdr),
         "--results-psms", f"{output_prefix}_psms.pin",
         input_pin_file
     ]
     
     print(f"Running Percolator: {' '.join(percolator_command)}")
-    subprocess.run(percolator_command, check=True)
+    run_tool(percolator_command, threads=threads, timeout=timeout, label=os.path.basename(input_pin_file))
     print("Percolator processing complete.")
+    return f"{output_prefix}_psms.pin"
+
+
+def merge_pin_files(pin_files, output_file):
+    """
+    Concatenates the PIN files of several runs into one, so that Percolator scores all the PSMs
+    together and the FDR is consistent across the files. The header (and the DefaultDirection
+    line, if any) of the first file is kept; the SpecIds of MSFragger contain the file name and
+    stay unique.
+
+    Returns:
+        str: output_file
+    """
+    header = None
+    with open(output_file, "w") as out:
+        for pin_file in pin_files:
+            with open(pin_file) as f:
+                file_header = f.readline()
+                if header is None:
+                    header = file_header
+                    out.write(header)
+                elif file_header.split("\t") != header.split("\t"):
+                    raise ValueError(f"{pin_file} has different PIN columns than {pin_files[0]}")
+                for line in f:
+                    if line.startswith("DefaultDirection") and pin_file != pin_files[0]:
+                        continue
+                    out.write(line if line.endswith("\n") else line + "\n")
+    print(f"Merged {len(pin_files)} PIN files into {output_file}")
+    return output_file
+
+
+def accepted_psm_ids(psms_file, q_value=0.01):
+    """
+    Ids of the PSMs of a Percolator results file below a q-value threshold.
+    """
+    psms = read_pin(psms_file)
+    return psms.filter(pl.col("q-value").cast(pl.Float64) <= q_value)["PSMId"].to_list()
 
 
 if __name__ == "__main__":
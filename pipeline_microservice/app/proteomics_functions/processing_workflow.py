@@ -1,7 +1,11 @@
 import os 
+import re
+import json
+import time
+import numpy as np
 import pyopenms as oms 
-import subprocess
 from load_dotenv import load_dotenv
+from app.utils.tool_runner import run_tool, parse_memory
 
 # Load environment variables from .env file
 load_dotenv()
@@ -148,6 +152,324 @@ def select_spectra_by_precursor_mass(mzml_file, min_precursor_mass, max_precurso
     print(f"Number of selected spectra: {len(selected_spectra)}")
     return selected_spectra
 
+def scan_number(native_id):
+    """
+    Extracts the scan number from a native ID ("controllerType=0 controllerNumber=1 scan=42"),
+    None if the ID has no scan.
+    """
+    match = re.search(r'scan=(\d+)', native_id)
+    return int(match.group(1)) if match else None
+
+
+def build_spectrum_predicate(lower_rt=None, upper_rt=None, first_scan=None, last_scan=None, excluded_scans=None,
+                             lower_charge=None, upper_charge=None, min_precursor_mz=None, max_precursor_mz=None,
+                             ms_levels=None):
+    """
+    Combines the active selection criteria into a single predicate on a spectrum. Unset bounds
+    are ignored; charge and precursor criteria only apply to spectra with a precursor, so MS1
+    spectra are kept for quantification.
+
+    Parameters:
+        lower_rt, upper_rt (float): RT range in seconds.
+        first_scan, last_scan (int): Scan number range.
+        excluded_scans (list): Scan numbers to drop.
+        lower_charge, upper_charge (int): Precursor charge range.
+        min_precursor_mz, max_precursor_mz (float): Precursor m/z range.
+        ms_levels (list): MS levels to keep, all by default.
+
+    Returns:
+        callable: predicate(spectrum) -> bool
+    """
+    excluded = {int(scan) for scan in excluded_scans} if excluded_scans else None
+    levels = set(ms_levels) if ms_levels else None
+    checks = []
+    if levels is not None:
+        checks.append(lambda spectrum: spectrum.getMSLevel() in levels)
+    if lower_rt is not None:
+        checks.append(lambda spectrum: spectrum.getRT() >= lower_rt)
+    if upper_rt is not None:
+        checks.append(lambda spectrum: spectrum.getRT() <= upper_rt)
+    if first_scan is not None or last_scan is not None or excluded is not None:
+        def scan_check(spectrum):
+            scan = scan_number(spectrum.getNativeID())
+            if scan is None:
+                return True
+            if first_scan is not None and scan < first_scan:
+                return False
+            if last_scan is not None and scan > last_scan:
+                return False
+            return excluded is None or scan not in excluded
+        checks.append(scan_check)
+    if any(v is not None for v in (lower_charge, upper_charge, min_precursor_mz, max_precursor_mz)):
+        def precursor_check(spectrum):
+            precursors = spectrum.getPrecursors()
+            if not precursors:
+                return True
+            charge = precursors[0].getCharge()
+            mz = precursors[0].getMZ()
+            return ((lower_charge is None or charge >= lower_charge)
+                    and (upper_charge is None or charge <= upper_charge)
+                    and (min_precursor_mz is None or mz >= min_precursor_mz)
+                    and (max_precursor_mz is None or mz <= max_precursor_mz))
+        checks.append(precursor_check)
+    return lambda spectrum: all(check(spectrum) for check in checks)
+
+
+class _SelectingConsumer:
+    """
+    pyopenms consumer forwarding the spectra accepted by a predicate, and all the
+    chromatograms, to a writing consumer.
+    """
+
+    def __init__(self, writer, predicate):
+        self.writer = writer
+        self.predicate = predicate
+        self.read = 0
+        self.written = 0
+
+    def setExperimentalSettings(self, settings):
+        self.writer.setExperimentalSettings(settings)
+
+    def setExpectedSize(self, n_spectra, n_chromatograms):
+        self.writer.setExpectedSize(n_spectra, n_chromatograms)
+
+    def consumeSpectrum(self, spectrum):
+        self.read += 1
+        if self.predicate(spectrum):
+            self.written += 1
+            self.writer.consumeSpectrum(spectrum)
+
+    def consumeChromatogram(self, chromatogram):
+        self.writer.consumeChromatogram(chromatogram)
+
+
+def stream_select_spectra(mzml_file, output_file, **criteria):
+    """
+    Selects spectra in a single pass: the input mzML is streamed, every spectrum is checked
+    against all the active criteria (see build_spectrum_predicate) and the matching ones are
+    written straight to the output with the chromatograms and the run metadata. Memory use
+    does not depend on the size of the run.
+
+    Parameters:
+        mzml_file (str): Path to the mzML file.
+        output_file (str): Path of the filtered mzML file.
+        criteria: Selection criteria, all unset copies the whole file.
+
+    Returns:
+        dict: Number of spectra read and written.
+    """
+    predicate = build_spectrum_predicate(**criteria)
+    consumer = _SelectingConsumer(oms.PlainMSDataWritingConsumer(output_file), predicate)
+    oms.MzMLFile().transform(mzml_file.encode(), consumer)
+    # the output file is finalized when the writer is released
+    del consumer.writer
+    print(f"Selected {consumer.written} of {consumer.read} spectra from {mzml_file}")
+    return {"spectra_read": consumer.read, "spectra_written": consumer.written}
+
+
+# mass difference between the 13C and 12C isotopes, and proton mass
+ISOTOPE_SPACING = 1.0033548
+PROTON_MASS = 1.0072765
+
+
+def _flat_match(keys, targets, tolerance):
+    """
+    Index of the key closest to every target in a sorted flat array, -1 when none is within
+    the tolerance.
+    """
+    idx = np.clip(np.searchsorted(keys, targets), 1, len(keys) - 1)
+    left = idx - 1
+    nearest = np.where(np.abs(keys[left] - targets) <= np.abs(keys[idx] - targets), left, idx)
+    return np.where(np.abs(keys[nearest] - targets) <= tolerance, nearest, -1)
+
+
+def preprocess_peaks(mz, intensity, lengths, precursor_mz, top_n=150, min_intensity=0.0,
+                     min_relative_intensity=0.0, precursor_window=1.5, deisotope=True, max_charge=3,
+                     isotope_tolerance=0.01, single_charge=True):
+    """
+    Pre-processes the peaks of many spectra at once. The peaks of all the spectra are given as
+    flat arrays (the spectra one after the other, m/z sorted within each spectrum) and every
+    step is a vectorized operation on them:
+    - peaks within precursor_window of the precursor m/z are removed;
+    - isotope peaks are removed: a peak is the next isotope of another one when it is
+      ISOTOPE_SPACING / z above it and that peak was assigned charge z, charges are assigned
+      from the highest one with a following isotope;
+    - peaks below min_intensity or min_relative_intensity of the base peak are removed;
+    - the top_n most intense peaks of every spectrum are kept;
+    - with single_charge, the monoisotopic peaks of charge z > 1 are moved to their singly
+      charged m/z.
+
+    Args:
+        mz, intensity (np.ndarray): Flat peak arrays.
+        lengths (np.ndarray): Number of peaks of every spectrum.
+        precursor_mz (np.ndarray): Precursor m/z of every spectrum, NaN without precursor.
+
+    Returns:
+        tuple: mz, intensity and lengths of the kept peaks, same layout as the input.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    n_spectra = len(lengths)
+    spectrum = np.repeat(np.arange(n_spectra), lengths)
+    keep = np.ones(len(mz), dtype=bool)
+    if len(mz) == 0:
+        return mz, intensity, lengths
+
+    if precursor_window:
+        keep &= ~(np.abs(mz - np.asarray(precursor_mz, dtype=np.float64)[spectrum]) <= precursor_window)
+
+    charge = np.zeros(len(mz), dtype=np.int8)
+    if deisotope or single_charge:
+        # spectra are moved apart so that one sorted key array holds all of them
+        offset = float(np.max(mz)) + 10.0
+        keys = mz + spectrum * offset
+        for z in range(max_charge, 0, -1):
+            has_next = _flat_match(keys, keys + ISOTOPE_SPACING / z, isotope_tolerance) >= 0
+            charge[(charge == 0) & has_next] = z
+        if deisotope:
+            is_isotope = np.zeros(len(mz), dtype=bool)
+            for z in range(1, max_charge + 1):
+                previous = _flat_match(keys, keys - ISOTOPE_SPACING / z, isotope_tolerance)
+                is_isotope |= (previous >= 0) & (charge[np.maximum(previous, 0)] == z)
+            keep &= ~is_isotope
+
+    if min_intensity:
+        keep &= intensity >= min_intensity
+    if min_relative_intensity:
+        base_peak = np.zeros(n_spectra)
+        np.maximum.at(base_peak, spectrum[keep], intensity[keep])
+        keep &= intensity >= min_relative_intensity * base_peak[spectrum]
+
+    if top_n:
+        kept = np.flatnonzero(keep)
+        # rank of every kept peak by decreasing intensity within its spectrum
+        order = kept[np.lexsort((-intensity[kept], spectrum[kept]))]
+        counts = np.bincount(spectrum[order], minlength=n_spectra)
+        starts = np.cumsum(counts) - counts
+        rank = np.arange(len(order)) - np.repeat(starts, counts)
+        keep[order[rank >= top_n]] = False
+
+    mz, intensity, spectrum, charge = mz[keep], intensity[keep], spectrum[keep], charge[keep]
+    if single_charge:
+        multiply_charged = charge > 1
+        mz = np.where(multiply_charged, (mz - PROTON_MASS) * charge + PROTON_MASS, mz)
+        order = np.lexsort((mz, spectrum))
+        mz, intensity, spectrum = mz[order], intensity[order], spectrum[order]
+    return mz, intensity, np.bincount(spectrum, minlength=n_spectra)
+
+
+class _PreprocessingConsumer:
+    """
+    pyopenms consumer buffering the spectra of the selected MS levels, pre-processing their
+    peaks in batches with preprocess_peaks and forwarding them, in the input order, to a
+    writing consumer. Chromatograms are forwarded after the pending spectra.
+    """
+
+    def __init__(self, writer, ms_levels=(2,), batch_size=2000, **options):
+        self.writer = writer
+        self.ms_levels = set(ms_levels)
+        self.batch_size = batch_size
+        self.options = options
+        self.pending = []
+        self.spectra_read = 0
+        self.spectra_processed = 0
+        self.peaks_before = 0
+        self.peaks_after = 0
+
+    def setExperimentalSettings(self, settings):
+        self.writer.setExperimentalSettings(settings)
+
+    def setExpectedSize(self, n_spectra, n_chromatograms):
+        self.writer.setExpectedSize(n_spectra, n_chromatograms)
+
+    def consumeSpectrum(self, spectrum):
+        self.spectra_read += 1
+        self.pending.append(oms.MSSpectrum(spectrum))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def consumeChromatogram(self, chromatogram):
+        self.flush()
+        self.writer.consumeChromatogram(chromatogram)
+
+    def flush(self):
+        if not self.pending:
+            return
+        selected = [s for s in self.pending if s.getMSLevel() in self.ms_levels]
+        if selected:
+            peaks = [s.get_peaks() for s in selected]
+            lengths = np.array([len(p[0]) for p in peaks], dtype=np.int64)
+            mz = np.concatenate([p[0] for p in peaks]).astype(np.float64)
+            intensity = np.concatenate([p[1] for p in peaks]).astype(np.float64)
+            precursor_mz = np.array([
+                s.getPrecursors()[0].getMZ() if s.getPrecursors() else np.nan for s in selected
+            ])
+            new_mz, new_intensity, new_lengths = preprocess_peaks(mz, intensity, lengths, precursor_mz, **self.options)
+            ends = np.cumsum(new_lengths)
+            for s, start, end in zip(selected, ends - new_lengths, ends):
+                s.set_peaks((new_mz[start:end], new_intensity[start:end].astype(np.float32)))
+            self.spectra_processed += len(selected)
+            self.peaks_before += int(lengths.sum())
+            self.peaks_after += int(new_lengths.sum())
+        for s in self.pending:
+            self.writer.consumeSpectrum(s)
+        self.pending = []
+
+
+def preprocess_spectra(mzml_file, output_file, report_file=None, ms_levels=(2,), batch_size=2000, **options):
+    """
+    Writes a reduced copy of an mzML file for the database search: the MS2 peaks are filtered
+    by preprocess_peaks while the file is streamed, MS1 spectra and chromatograms are copied
+    unchanged so that the file can still be used for quantification.
+
+    Parameters:
+        mzml_file (str): Path to the mzML file.
+        output_file (str): Path of the pre-processed mzML file.
+        report_file (str): Path of the JSON report, not written when None.
+        ms_levels (tuple): MS levels to pre-process.
+        batch_size (int): Spectra pre-processed together.
+        options: Options of preprocess_peaks (top_n, min_intensity, min_relative_intensity,
+            precursor_window, deisotope, max_charge, isotope_tolerance, single_charge).
+
+    Returns:
+        dict: Report with the spectra, peaks and bytes before and after. The search time of
+            MSFragger grows with the number of fragment peaks, estimated_search_time_saving
+            is the fraction of MS2 peaks removed.
+    """
+    started_at = time.time()
+    consumer = _PreprocessingConsumer(
+        oms.PlainMSDataWritingConsumer(output_file), ms_levels=ms_levels, batch_size=batch_size, **options
+    )
+    oms.MzMLFile().transform(mzml_file.encode(), consumer)
+    consumer.flush()
+    # the output file is finalized when the writer is released
+    del consumer.writer
+
+    peaks_before, peaks_after = consumer.peaks_before, consumer.peaks_after
+    bytes_before, bytes_after = os.path.getsize(mzml_file), os.path.getsize(output_file)
+    report = {
+        "input_file": mzml_file,
+        "output_file": output_file,
+        "options": options,
+        "spectra_read": consumer.spectra_read,
+        "spectra_processed": consumer.spectra_processed,
+        "peaks_before": peaks_before,
+        "peaks_after": peaks_after,
+        "mean_peaks_before": round(peaks_before / max(consumer.spectra_processed, 1), 1),
+        "mean_peaks_after": round(peaks_after / max(consumer.spectra_processed, 1), 1),
+        "bytes_before": bytes_before,
+        "bytes_after": bytes_after,
+        "size_reduction": round(1 - bytes_after / bytes_before, 4) if bytes_before else 0.0,
+        "estimated_search_time_saving": round(1 - peaks_after / peaks_before, 4) if peaks_before else 0.0,
+        "wall_time_sec": round(time.time() - started_at, 3),
+    }
+    if report_file:
+        with open(report_file, "w") as f:
+            json.dump(report, f, indent=2)
+    print(f"Pre-processed {consumer.spectra_processed} spectra of {mzml_file}: {peaks_before} -> {peaks_after} peaks, "
+          f"{bytes_before} -> {bytes_after} bytes")
+    return report
+
+
 def save_selected_spectra(original_file, selected_spectra, output_file):
     """
     Saves the selected spectra to a new mzML file.
@@ -249,7 +571,8 @@ def run_msfragger(
     ]
 
     print(f"Running MSFragger with command: {' '.join(command)}")
-    process = subprocess.run(command, capture_output=True, text=True)
+    process = run_tool(command, tool="java", threads=None, check=False,
+                       memory_limit=int(parse_memory(memory) * 1.25), label=os.path.basename(spectra_file))
     if process.returncode == 0:
         print(f"MSFragger completed successfully. Output files are saved in {output_dir}.")
     else:
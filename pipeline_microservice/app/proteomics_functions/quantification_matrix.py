@@ -0,0 +1,153 @@
+import os
+import numpy as np
+import polars as pl
+
+INTENSITY_PREFIX = "Intensity_"
+ANNOTATION_COLUMNS = ["Protein Groups", "Gene Name", "Organism"]
+NORMALIZATIONS = ("median", "quantile", None)
+IMPUTATIONS = ("downshift", "min", "half_min", "zero", None)
+
+
+def read_quantified_proteins(quantified_proteins_file):
+    """
+    Reads a FlashLFQ QuantifiedProteins.tsv (or its annotated copy) into the annotation columns
+    and one intensity column per sample, named after the sample. Zero intensities are missing
+    values.
+
+    Returns:
+        tuple: (annotations pl.DataFrame, intensities pl.DataFrame with Float64 columns)
+    """
+    df = pl.read_csv(quantified_proteins_file, separator="\t", infer_schema_length=0)
+    intensity_columns = [c for c in df.columns if c.startswith(INTENSITY_PREFIX)]
+    if not intensity_columns:
+        raise ValueError(f"No {INTENSITY_PREFIX}<sample> column in {quantified_proteins_file}")
+    annotations = df.select([c for c in ANNOTATION_COLUMNS if c in df.columns])
+    intensities = df.select(
+        pl.col(c).cast(pl.Float64, strict=False).replace(0.0, None).alias(c[len(INTENSITY_PREFIX):])
+        for c in intensity_columns
+    )
+    return annotations, intensities
+
+
+def median_normalize(matrix):
+    """
+    Aligns the median of every sample (column) on the mean of the sample medians. The matrix
+    is in log space, so this is a shift of every column.
+    """
+    medians = np.nanmedian(matrix, axis=0)
+    return matrix - medians + np.nanmean(medians)
+
+
+def quantile_normalize(matrix):
+    """
+    Quantile normalization tolerating missing values: every sample gets the same distribution,
+    the mean of the sorted samples. Samples with fewer values are mapped on the reference by
+    their quantile.
+    """
+    n_rows, n_samples = matrix.shape
+    valid = ~np.isnan(matrix)
+    counts = valid.sum(axis=0)
+    # NaN sort last, the values of a sample are sorted[:count]
+    sorted_values = np.sort(matrix, axis=0)
+    grid = np.linspace(0.0, 1.0, n_rows)
+    reference = np.nanmean(np.column_stack([
+        np.interp(grid, np.linspace(0.0, 1.0, count), sorted_values[:count, j]) if count else np.full(n_rows, np.nan)
+        for j, count in enumerate(counts)
+    ]), axis=1)
+    # quantile of every value within its sample
+    order = np.argsort(matrix, axis=0, kind="stable")
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(n_rows)[:, None], axis=0)
+    quantiles = ranks / np.maximum(counts - 1, 1)
+    normalized = np.interp(quantiles, grid, reference)
+    return np.where(valid, normalized, np.nan)
+
+
+def impute(matrix, method="downshift", width=0.3, shift=1.8, seed=0, log_base=2):
+    """
+    Replaces the missing values of every sample at once.
+
+    Args:
+        matrix (np.ndarray): Intensities, NaN for missing values.
+        method (str): downshift (random values from a normal distribution shrunk by width and
+            moved down by shift standard deviations of the sample), min (sample minimum),
+            half_min (half of the sample minimum) or zero.
+        log_base (float): Base of the log of the intensities, None for linear intensities.
+
+    Returns:
+        np.ndarray: The imputed matrix.
+    """
+    missing = np.isnan(matrix)
+    if method is None or not missing.any():
+        return matrix
+    if method == "zero":
+        fill = np.zeros_like(matrix)
+    elif method in ("min", "half_min"):
+        minimum = np.nanmin(np.where(missing.all(axis=0), 0.0, matrix), axis=0)
+        if method == "half_min":
+            minimum = minimum - np.log(2) / np.log(log_base) if log_base else minimum / 2
+        fill = np.broadcast_to(minimum, matrix.shape)
+    elif method == "downshift":
+        mean = np.nanmean(matrix, axis=0)
+        std = np.nanstd(matrix, axis=0)
+        rng = np.random.default_rng(seed)
+        fill = rng.normal(mean - shift * std, width * std, size=matrix.shape)
+    else:
+        raise ValueError(f"Unknown imputation: {method}, expected one of {IMPUTATIONS}")
+    return np.where(missing, fill, matrix)
+
+
+def build_quantification_matrix(quantified_proteins_file, output_file=None, log_base=2, normalization="median",
+                                imputation=None, min_valid=1, seed=0):
+    """
+    Builds the protein x sample intensity matrix of a FlashLFQ run and stores it as Parquet.
+
+    Parameters:
+    - quantified_proteins_file (str): Path to the QuantifiedProteins.tsv file, annotated or not.
+    - output_file (str): Path of the Parquet file, <input>_matrix.parquet by default.
+    - log_base (float): Base of the log transform, None keeps linear intensities.
+    - normalization (str): median, quantile or None.
+    - imputation (str): Imputation of the missing values, see impute(); None keeps them null.
+    - min_valid (int | float): Values required to keep a protein, a count or a fraction of the samples.
+    - seed (int): Seed of the downshift imputation.
+
+    Returns:
+    - str: Path to the Parquet file. It has the annotation columns, one column per sample and
+      n_valid, the number of measured (not imputed) values of the protein.
+    """
+    if normalization not in NORMALIZATIONS:
+        raise ValueError(f"Unknown normalization: {normalization}, expected one of {NORMALIZATIONS}")
+    annotations, intensities = read_quantified_proteins(quantified_proteins_file)
+    samples = intensities.columns
+    matrix = intensities.to_numpy().astype(np.float64)
+
+    n_valid = (~np.isnan(matrix)).sum(axis=1)
+    required = min_valid * len(samples) if isinstance(min_valid, float) and min_valid < 1 else min_valid
+    keep = n_valid >= max(required, 1)
+    matrix, n_valid, annotations = matrix[keep], n_valid[keep], annotations.filter(pl.Series(keep))
+    print(f"Quantification matrix: {matrix.shape[0]} proteins x {len(samples)} samples "
+          f"({int((~keep).sum())} proteins below {min_valid} values)")
+
+    if log_base:
+        matrix = np.log(matrix) / np.log(log_base)
+    if matrix.shape[0]:
+        if normalization == "median":
+            matrix = median_normalize(matrix)
+        elif normalization == "quantile":
+            matrix = quantile_normalize(matrix)
+        matrix = impute(matrix, imputation, seed=seed, log_base=log_base)
+
+    result = pl.concat([
+        annotations,
+        pl.DataFrame({sample: matrix[:, j] for j, sample in enumerate(samples)},
+                     schema={sample: pl.Float64 for sample in samples}).fill_nan(None),
+        pl.DataFrame({"n_valid": n_valid}, schema={"n_valid": pl.Int32}),
+    ], how="horizontal")
+
+    if output_file is None:
+        output_file = f"{os.path.splitext(quantified_proteins_file)[0]}_matrix.parquet"
+    tmp_path = output_file + ".tmp"
+    result.write_parquet(tmp_path, compression="zstd", statistics=True)
+    os.replace(tmp_path, output_file)
+    print(f"Quantification matrix saved to: {output_file}")
+    return output_file
@@ -1,26 +1,120 @@
+import os
+import logging
+import threading
 import requests
 import pandas as pd
+import polars as pl
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# gene names already resolved, so that misses of the FASTA index do not hit the network again
+UNIPROT_CACHE_FILE = os.getenv("UNIPROT_CACHE_FILE") or os.path.join(
+    os.getenv("PROTEOMICS_BASE_PATH") or "generated_files", "fasta_index", "uniprot_genes.parquet"
+)
+# the REST API is only queried for accessions missing from the local cache when enabled
+UNIPROT_ONLINE_LOOKUP = os.getenv("UNIPROT_ONLINE_LOOKUP", "false").lower() in ("1", "true", "yes")
+# accessions per search request
+UNIPROT_BATCH_SIZE = 100
+
+CACHE_SCHEMA = {"accession": pl.Utf8, "gene_name": pl.Utf8}
+
+_cache_lock = threading.Lock()
+
 
 def get_gene_name_uniprot(accession):
     """Get gene name from UniProt using REST API"""
-    url = f"https://rest.uniprot.org/uniprotkb/{accession}"
-    params = {
-        'format': 'json',
-        'fields': 'gene_names,gene_primary'
-    }
-    
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-        data = response.json()
-        if 'genes' in data and data['genes']:
-            print(f"Found gene name for {accession}: {data['genes'][0]['geneName']['value']}")
-            return data['genes'][0]['geneName']['value']
-    return None
+    cached = get_gene_names([accession], online=True)
+    return cached.get(accession)
+
+
+def load_gene_cache(cache_file=None):
+    cache_file = cache_file or UNIPROT_CACHE_FILE
+    if os.path.exists(cache_file):
+        return pl.read_parquet(cache_file)
+    return pl.DataFrame(schema=CACHE_SCHEMA)
+
+
+def _store_gene_cache(cache, cache_file):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    tmp_path = cache_file + ".tmp"
+    cache.write_parquet(tmp_path)
+    os.replace(tmp_path, cache_file)
+
+
+def fetch_gene_names(accessions):
+    """
+    Queries the UniProt REST API for many accessions, UNIPROT_BATCH_SIZE per request.
+
+    Returns:
+        dict: accession -> primary gene name, None for the accessions without gene.
+    """
+    results = {}
+    for start in range(0, len(accessions), UNIPROT_BATCH_SIZE):
+        batch = accessions[start:start + UNIPROT_BATCH_SIZE]
+        params = {
+            'query': " OR ".join(f"accession:{accession}" for accession in batch),
+            'format': 'tsv',
+            'fields': 'accession,gene_primary',
+            'size': len(batch),
+        }
+        try:
+            response = requests.get("https://rest.uniprot.org/uniprotkb/search", params=params, timeout=30)
+        except requests.RequestException as e:
+            logger.warning(f"UniProt lookup failed: {e}")
+            continue
+        if response.status_code != 200:
+            logger.warning(f"UniProt lookup failed with status {response.status_code}")
+            continue
+        for line in response.text.splitlines()[1:]:
+            fields = line.split("\t")
+            if fields and fields[0]:
+                results[fields[0]] = fields[1] if len(fields) > 1 and fields[1] else None
+        for accession in batch:
+            results.setdefault(accession, None)
+    return results
+
+
+def get_gene_names(accessions, online=None, cache_file=None):
+    """
+    Gene names of many accessions from the local cache. With online lookups enabled (argument
+    or UNIPROT_ONLINE_LOOKUP), the missing ones are fetched in batches and added to the cache,
+    accessions without gene are cached too.
+
+    Returns:
+        dict: accession -> gene name, for the accessions with a known gene.
+    """
+    online = UNIPROT_ONLINE_LOOKUP if online is None else online
+    cache_file = cache_file or UNIPROT_CACHE_FILE
+    accessions = sorted({a for a in accessions if a})
+    with _cache_lock:
+        cache = load_gene_cache(cache_file)
+        requested = pl.DataFrame({"accession": accessions}, schema={"accession": pl.Utf8})
+        found = requested.join(cache, on="accession", how="inner")
+        missing = requested.join(cache, on="accession", how="anti")["accession"].to_list()
+        if online and missing:
+            print(f"Querying UniProt for {len(missing)} accessions")
+            fetched = fetch_gene_names(missing)
+            if fetched:
+                new_rows = pl.DataFrame(
+                    {"accession": list(fetched), "gene_name": list(fetched.values())}, schema=CACHE_SCHEMA
+                )
+                found = pl.concat([found, new_rows])
+                try:
+                    _store_gene_cache(pl.concat([cache, new_rows]).unique("accession", keep="last"), cache_file)
+                except OSError as e:
+                    logger.warning(f"Could not update the UniProt cache {cache_file}: {e}")
+    found = found.filter(pl.col("gene_name").is_not_null())
+    return dict(zip(found["accession"].to_list(), found["gene_name"].to_list()))
+
 
 if __name__ == "__main__":
-    # get the csv file and get the gene names for all the accession numbers in the csv file 
+    # get the csv file and get the gene names for all the accession numbers in the csv file
     df = pd.read_csv('QuantifiedProteins.tsv', sep='\t')
-    df['Gene Name'] = df['Protein Groups'].apply(get_gene_name_uniprot)
+    gene_names = get_gene_names(df['Protein Groups'].dropna().tolist(), online=True)
+    df['Gene Name'] = df['Protein Groups'].map(gene_names)
     print(df[['Protein Groups', 'Gene Name']].head(10))  # Display first 10 rows for verification
     df.to_csv('QuantifiedProteins_with_gene_names.tsv', sep='\t', index=False)
-    print("Gene names added to the DataFrame and saved to 'QuantifiedProteins_with_gene_names.tsv'.")
\ No newline at end of file
+    print("Gene names added to the DataFrame and saved to 'QuantifiedProteins_with_gene_names.tsv'.")
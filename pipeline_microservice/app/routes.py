@@ -1,5 +1,7 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, Response, stream_with_context
+from urllib.parse import urlencode
 from app.tasks import create_pipeline_chain, create_flow_cytometry_pipeline_chain, run_proteomics_pipeline, run_metabolomics_pipeline_task
+from app.utils.progress import register_run, stream_events, get_snapshot
 
 bp = Blueprint('tasks', __name__)
 
@@ -12,6 +14,8 @@ def run_pipeline():
     try:
         # Creazione della catena e avvio della pipeline
         pipeline_chain = create_pipeline_chain(data)
+        # ids are assigned before the launch so that every task publishes its progress on the chain id
+        register_run(pipeline_chain.freeze())
         result = pipeline_chain.apply_async()
 
         # Restituisci l'ID della catena per monitoraggio
@@ -30,6 +34,8 @@ def run_flow_cytometry():
     try:
         # Creazione della catena e avvio della pipeline
         pipeline_chain = create_flow_cytometry_pipeline_chain(data)
+        # ids are assigned before the launch so that every task publishes its progress on the chain id
+        register_run(pipeline_chain.freeze())
         result = pipeline_chain.apply_async()
 
         # Restituisci l'ID della catena per monitoraggio
@@ -41,6 +47,18 @@ def run_flow_cytometry():
     
     
     
+@bp.route('/api/v1/process_proteomics_pipeline', methods=['POST'])
+def process_proteomics_pipeline():
+    data = request.get_json()
+    print(data)
+    try:
+        result = run_proteomics_pipeline(data)
+        return jsonify({'chain_id': result.id}), 202
+    except Exception as e:
+        print(str(e))
+        return jsonify({'error': str(e)}), 400
+
+
 @bp.route('/api/v1/process_metabolomics_pipeline', methods=['POST'])
 def run_metabolomics_pipeline():
     data = request.get_json()
@@ -56,7 +74,21 @@ def run_metabolomics_pipeline():
         return jsonify({'error': str(e)}), 400
 
 
-# route to check the status of a task
+def _run_document(task_id):
+    """
+    Returns the pipeline run stored for a task or chain id, whatever the omics.
+    """
+    from app.models.metabolomics import PipelineModel
+    from app.models.flow_cytometry import FlowCytoPipelineRun
+    from app.models.proteomics import ProteomicsPipelineModel
+    for find in (PipelineModel.find_by_task_id, FlowCytoPipelineRun.find_by_chain_id, ProteomicsPipelineModel.find_by_task_id):
+        document = find(task_id)
+        if document is not None:
+            return document
+    return None
+
+
+# route to check the status of a task, the results are served by /api/task_results
 @bp.route('/api/task_status/<task_id>', methods=['GET'])
 def task_status(task_id):
     from .tasks import celery_app
@@ -70,12 +102,102 @@ def task_status(task_id):
     elif task.state != 'FAILURE':
         response = {
             'state': task.state,
-            'result': task.result
+            # custom states (e.g. PROGRESS) carry a small dict with the progress of the task
+            'progress': task.info if task.state not in ('SUCCESS', 'REVOKED') and isinstance(task.info, dict) else None
         }
+        if task.state == 'SUCCESS':
+            response['results_url'] = f'/api/task_results/{task_id}'
     else:
         response = {
             'state': task.state,
             'status': str(task.info)  # this is the exception raised
         }
+
+    try:
+        document = _run_document(task_id)
+    except Exception as e:
+        print(f'Could not read the pipeline run of {task_id}: {e}')
+        document = None
+    if document is not None:
+        response['metrics'] = document.get('metrics', [])
+        if 'timing_report' in document:
+            response['timing_report'] = document['timing_report']
     
-    return jsonify(response)
\ No newline at end of file
+    return jsonify(response)
+
+
+def _float_arg(name):
+    value = request.args.get(name)
+    return float(value) if value not in (None, '') else None
+
+
+# paginated, projected and filtered results of a task, streamed as NDJSON or Arrow IPC
+@bp.route('/api/task_results/<task_id>', methods=['GET'])
+def task_results(task_id):
+    from .tasks import celery_app
+    from app.utils import artifacts
+    task = celery_app.AsyncResult(task_id)
+    if task.state != 'SUCCESS':
+        return jsonify({'state': task.state, 'error': 'Results are not available'}), 409
+
+    try:
+        path = artifacts.resolve_artifact(task_id, task.result, request.args.get('artifact'))
+        columns = [c for c in request.args.get('columns', '').split(',') if c]
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = max(int(request.args.get('limit', artifacts.RESULTS_DEFAULT_PAGE_SIZE)), 1)
+        page, filtered = artifacts.query_artifact(
+            path,
+            columns=columns,
+            offset=offset,
+            limit=limit,
+            mz_range=(_float_arg('mz_min'), _float_arg('mz_max')),
+            rt_range=(_float_arg('rt_min'), _float_arg('rt_max')),
+        )
+        total = artifacts.count_rows(filtered)
+    except artifacts.ArtifactNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    limit = min(limit, artifacts.RESULTS_MAX_PAGE_SIZE)
+    headers = {
+        'X-Total-Count': str(total),
+        'X-Offset': str(offset),
+        'X-Limit': str(limit),
+    }
+    if offset + limit < total:
+        next_args = dict(request.args, offset=offset + limit, limit=limit)
+        headers['Link'] = f'</api/task_results/{task_id}?{urlencode(next_args)}>; rel="next"'
+
+    output_format = request.args.get('format', 'ndjson')
+    if output_format == 'arrow':
+        return Response(artifacts.to_arrow_ipc(page), mimetype='application/vnd.apache.arrow.stream', headers=headers)
+    if output_format != 'ndjson':
+        return jsonify({'error': f'Unknown format {output_format}, use ndjson or arrow'}), 400
+    return Response(stream_with_context(artifacts.stream_ndjson(page)), mimetype='application/x-ndjson', headers=headers)
+
+
+# live progress of a pipeline run as Server-Sent Events: the last known state first, then every update
+@bp.route('/api/pipeline_progress/<run_id>/events', methods=['GET'])
+def pipeline_progress_events(run_id):
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(stream_events(run_id)), mimetype='text/event-stream', headers=headers)
+
+
+@bp.route('/api/pipeline_progress/<run_id>', methods=['GET'])
+def pipeline_progress(run_id):
+    snapshot = get_snapshot(run_id)
+    if snapshot is None:
+        return jsonify({'run_id': run_id, 'error': 'No progress recorded for this run'}), 404
+    return jsonify(snapshot)
+
+
+# aggregate step, task and tool metrics in the Prometheus text format
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    from app.utils.instrumentation import render_prometheus_metrics
+    try:
+        return Response(render_prometheus_metrics(), mimetype='text/plain; version=0.0.4')
+    except Exception as e:
+        print(str(e))
+        return Response(f'# metrics unavailable: {e}\n', status=503, mimetype='text/plain')
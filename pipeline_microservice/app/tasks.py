@@ -1,13 +1,15 @@
-from app.celery_app import celery_app
+from app.celery_app import celery_app, redis_client
 from celery import chain
 from .metabolomics_function import basic, spectra, compounds, alignment
+from .metabolomics_function.basic import serialize_ms_experiment
 from app.proteomics_functions import msfragger, percolator, extract_info_flashlfq, flashlfq, uniprot
 from app.models.proteomics import ProteomicsPipelineModel
 from .pipeline_tasks import flow_cytometry, proteomics
 import pyopenms as oms
-import redis
 import pandas as pd
 import os 
+import json
+import time
 from app.models.metabolomics import PipelineModel
 from app.metabolomics_function.cd_pipeline.mass_trace import run_mass_trace_detection
 from app.metabolomics_function.cd_pipeline.elution_peak import run_elution_peak_detection
@@ -15,14 +17,19 @@ from app.metabolomics_function.cd_pipeline.feature_map import run_feature_mappin
 from app.metabolomics_function.cd_pipeline.align_chromatograms import align_featureXML_files
 from app.metabolomics_function.cd_pipeline.link_features import link_features
 from app.metabolomics_function.cd_pipeline.hmdb_indexing import parse_hmdb_to_dataframe_streaming, consensus_to_feature_dicts, load_kegg_compounds_csv
+from app.metabolomics_function.cd_pipeline.ms2_identification import run_ms2_identification_native
 import subprocess
+from app.utils.tool_runner import ToolJob, get_tool_runner
+from app.flow_cytometry_functions import knn_graph
+from app.utils.dag import DagStep, DagExecutor, CanvasStep, build_celery_canvas
+from app.utils.instrumentation import count_items
+from app.utils.artifacts import save_table_artifact
+from app.utils.progress import ProgressReporter, register_run
 from pyteomics import mztab
 import numpy as np
 from scipy.stats import ttest_ind
 
 
-redis_client = redis.StrictRedis(host='localhost', port=6379, db=0, decode_responses=True)
-
 tools_path = os.getenv("TOOLS_BASE_PATH")
 METABOLOMICS_BASE_PATH = os.getenv('METABOLOMICS_BASE_PATH')
 PROTEOMICS_BASE_PATH = os.getenv('PROTEOMICS_BASE_PATH')
@@ -45,60 +52,6 @@ def group_annotations_by_id_group(df):
     return grouped
 
 
-def serialize_ms_experiment(exp):
-    """
-    Serializza un oggetto MSExperiment in formato JSON, includendo tutti i metadati disponibili
-    e aggiungendo un campo per la polarità basato su getPolarity().
-    
-    Args:
-        exp (oms.MSExperiment): Oggetto MSExperiment da serializzare.
-    
-    Returns:
-        str: JSON con dati e metadati degli spettri.
-    """
-    spectra = exp.getSpectra()
-
-    # Inizializza una lista per i dati degli spettri
-    serialized_data = []
-
-    for spectrum in spectra:
-        spectrum_data = {
-            'RT': spectrum.getRT(),
-            'mzarray': list(spectrum.get_peaks()[0]),
-            'intarray': list(spectrum.get_peaks()[1]),
-            'scan_number': spectrum.getNativeID(),
-            'ms_level': spectrum.getMSLevel()
-        }
-
-        # Aggiungi tutti i metadati disponibili
-        meta_keys = []  # Lista vuota per raccogliere le chiavi
-        spectrum.getKeys(meta_keys)  # Popola meta_keys con le chiavi disponibili
-
-        for key in meta_keys:
-            try:
-                spectrum_data[key] = spectrum.getMetaValue(key)
-            except KeyError:
-                print(f"Metadata key '{key}' not found in spectrum with RT: {spectrum.getRT()}")
-
-        # Determina la polarità
-        polarity_value = spectrum.getInstrumentSettings().getPolarity()
-        polarity_map = {0: 'unknown', 1: 'positive', 2: 'negative'}
-        spectrum_data['polarity'] = polarity_map.get(polarity_value, 'unknown')
-
-        serialized_data.append(spectrum_data)
-
-    # Crea un DataFrame
-    df = pd.DataFrame(serialized_data)
-
-    # Rinominare le colonne con b'' in stringhe normali
-    df.rename(columns=lambda x: x.decode('utf-8') if isinstance(x, bytes) else x, inplace=True)
-
-    # Log per verifica
-    print(df[['scan_number', 'polarity']].head())
-
-    return df.to_json()
-
-
 @celery_app.task
 def read_mzML_files_task(file_paths:list):
     # lista vuota per leggere i file mzML
@@ -213,17 +166,18 @@ def detect_compounds_task(serialized_experiments, parameters):
             pass
     return chromatograms
     
-@celery_app.task
-def group_compounds_task(chromatograms_json, parameters):
+@celery_app.task(bind=True)
+def group_compounds_task(self, chromatograms_json, parameters):
     """
     Task to group compounds from the chromatograms using specified parameters.
+    The grouped compounds are stored as a Parquet artifact served by /api/task_results.
 
     Parameters:
     - chromatograms_json (str): JSON string representing the chromatograms.
     - parameters (dict): Dictionary containing parameters for grouping compounds.
 
     Returns:
-    - str: JSON string of grouped compounds.
+    - dict: Path, number of rows and columns of the grouped compounds artifact.
     """
     # Extract parameters with default values
     rt_tolerance = parameters.get('rt_tolerance', 0.8)
@@ -238,7 +192,11 @@ def group_compounds_task(chromatograms_json, parameters):
         use_isotope_pattern=use_isotope_pattern
     )
 
-    return grouped_compounds_json
+    grouped_compounds = json.loads(grouped_compounds_json)
+    for group in grouped_compounds:
+        group['n_members'] = len(group['members'])
+    count_items('compounds', len(grouped_compounds))
+    return save_table_artifact(self.request.id, grouped_compounds)
     
     
 
@@ -286,7 +244,9 @@ def create_pipeline_chain(data):
 # Create a pipeline chain for flow cytometry analysis
 def create_flow_cytometry_pipeline_chain(data):
     """
-    Create a Celery chain of tasks for flow cytometry analysis.
+    Create a Celery canvas of tasks for flow cytometry analysis. Each step declares the data it
+    consumes and produces: the steps reading the same clustering result (heatmap, plots) run in
+    parallel and a final task stores the merged results on the pipeline run.
 
     Args:
         data (dict): The pipeline configuration data.
@@ -299,38 +259,60 @@ def create_flow_cytometry_pipeline_chain(data):
     print("name:", name)
     
     steps = data.get('pipeline', {}).get('steps', [])
-    print("\n\n\n\n")
     print("steps:", steps)
-    task_chain = []
+    canvas_steps = []
     if not steps:
         raise ValueError("Pipeline steps not defined in the data.")
+    # the kNN graph is built once with the most neighbors any step needs, each step keeps its nearest ones
+    neighbors = knn_graph.graph_neighbors(steps)
 
     for step in steps:
         print("step:", step)
         name = step.get('name')
         parameters = step.get('parameters', {})
+        if name in ('knn_graph', 'umap', 'louvain_clustering', 'leiden_clustering', 'leiden_sweep'):
+            parameters = {**parameters, 'graph_neighbors': neighbors}
 
         if name == 'select_fcs_files':
-            print("functioning")
             file_paths = parameters.get('file_paths', [])
-            task_chain.append(flow_cytometry.select_fcs_files_task.s(file_paths))
+            canvas_steps.append(CanvasStep(
+                name, lambda _, f=file_paths: flow_cytometry.select_fcs_files_task.s(f),
+                outputs=['fcs_data']))
+
+        if name == 'knn_graph':
+            # the kNN graph is saved in the event store and reused by UMAP, Leiden and Louvain
+            canvas_steps.append(CanvasStep(
+                name, lambda _, p=parameters: flow_cytometry.knn_graph_task.s(p),
+                inputs=['fcs_data'], outputs=['fcs_data']))
 
         if name == 'umap':
             # UMAP step outputs both reduced and original data
-            task_chain.append(flow_cytometry.umap_dimensionality_reduction_task.s(parameters))
+            canvas_steps.append(CanvasStep(
+                name, lambda _, p=parameters: flow_cytometry.umap_dimensionality_reduction_task.s(p),
+                inputs=['fcs_data'], outputs=['umap_data']))
 
         if name == 'louvain_clustering':
             # Louvain clustering (assuming it uses UMAP-reduced data)
-            task_chain.append(flow_cytometry.louvain_clustering_task.s(parameters))
+            canvas_steps.append(CanvasStep(
+                name, lambda _, p=parameters: flow_cytometry.louvain_clustering_task.s(p),
+                inputs=['umap_data'], outputs=['clustering_result']))
 
         if name == 'leiden_clustering':
             # Leiden clustering now expects the full UMAP result
-            print("Adding Leiden clustering task to the chain. \n\n", parameters)
-            task_chain.append(flow_cytometry.leiden_clustering_task.s(parameters))
+            canvas_steps.append(CanvasStep(
+                name, lambda _, p=parameters: flow_cytometry.leiden_clustering_task.s(p),
+                inputs=['umap_data'], outputs=['clustering_result']))
         
+        if name == 'leiden_sweep':
+            # Leiden at many resolutions on the cached kNN graph, labelings and report only
+            canvas_steps.append(CanvasStep(
+                name, lambda _, p=parameters: flow_cytometry.leiden_sweep_task.s(p),
+                inputs=['umap_data'], outputs=['leiden_sweep']))
+
         if name == "generate_heatmap_data":
-            print("Adding generate_heatmap_data_task to the chain. \n\n", parameters)
-            task_chain.append(flow_cytometry.generate_heatmap_data_task.s(parameters))
+            canvas_steps.append(CanvasStep(
+                name, lambda _, p=parameters: flow_cytometry.generate_heatmap_data_task.s(p),
+                inputs=['clustering_result'], outputs=['heatmap_data']))
         
         if name == "flowsom_clustering":
             # Extract the flowsom parameters
@@ -338,47 +320,55 @@ def create_flow_cytometry_pipeline_chain(data):
             parameters.update(flowsom_parameters)
 
             # Extract required arguments
-            json_str = parameters.get('json_str', '')
             n_clusters = int(parameters.get('n_clusters', 10))
             xdim = int(parameters.get('xdim', 10))
             ydim = int(parameters.get('ydim', 10))
 
-            print("Adding flowsom_clustering_task to the chain. \n\n", parameters)
-
-            # Add the task to the chain with keyword arguments
-            task_chain.append(
-                flow_cytometry.flowsom_clustering_task.s(
-                    n_clusters=n_clusters,
-                    xdim=xdim,
-                    ydim=ydim
-                )
-            )
+            print("Adding flowsom_clustering_task to the pipeline. \n\n", parameters)
+            canvas_steps.append(CanvasStep(
+                name,
+                lambda _, n=n_clusters, x=xdim, y=ydim: flow_cytometry.flowsom_clustering_task.s(
+                    n_clusters=n,
+                    xdim=x,
+                    ydim=y
+                ),
+                inputs=['fcs_data'], outputs=['flowsom_result']))
         
         if name == "plot_scatter":
-            task_chain.append(flow_cytometry.plot_scatter_task.s(parameters))    
+            canvas_steps.append(CanvasStep(
+                name, lambda _, p=parameters: flow_cytometry.plot_scatter_task.s(p),
+                inputs=['clustering_result'], outputs=['scatter_plot']))
                      
         if name == 'plot_matrix':
-            task_chain.append(flow_cytometry.plot_matrix_task.s(parameters))
+            canvas_steps.append(CanvasStep(
+                name, lambda _, p=parameters: flow_cytometry.plot_matrix_task.s(p),
+                inputs=['clustering_result'], outputs=['matrix_plot']))
 
-    return chain(*task_chain)
+    return build_celery_canvas(
+        canvas_steps,
+        finalize=lambda step_names, grouped: flow_cytometry.finalize_flow_cytometry_pipeline_task.s(step_names, grouped)
+    )
 
 
 # create a pipeline chain for proteomics analysis
 def create_proteomics_pipeline_chain(data):
     """
-    Crea ed esegue una catena di task Celery basata sui dati della pipeline.
+    Crea la catena di task Celery basata sui dati della pipeline. Gli step che lavorano sul
+    singolo file (select_spectra, preprocess_spectra, msfragger) vengono eseguiti come una catena per file, tutte in
+    parallelo; percolator e flashlfq lavorano una sola volta su tutti i file.
     
     Args:
         data (dict): Configurazione della pipeline.
     
     Returns:
-        AsyncResult: Risultato asincrono della catena.
+        chain: Canvas Celery della pipeline.
     """
     steps = data.get('pipeline', {}).get('steps', [])
     if not steps:
         raise ValueError("Pipeline steps not defined in the data.")
 
-    task_chain = []
+    canvas_steps = []
+    file_paths = []
 
     for step in steps:
         name = step.get('name')
@@ -386,19 +376,74 @@ def create_proteomics_pipeline_chain(data):
         print("name:", name)
         if name == 'select_mzML_files':
             file_paths = parameters.get('file_paths', [])
-            task_chain.append(proteomics.select_mzml_files.s(file_paths))
+            canvas_steps.append(CanvasStep(
+                name, lambda files: proteomics.select_mzml_files.s(files),
+                outputs=['mzml_files'], per_file=True))
         elif name == 'select_spectra':
-            task_chain.append(proteomics.select_spectra.s(parameters))
+            canvas_steps.append(CanvasStep(
+                name,
+                lambda _, p=parameters: proteomics.select_spectra.s(
+                    lower_rt=p.get('lower_rt'),
+                    upper_rt=p.get('upper_rt'),
+                    first_scan=p.get('first_scan'),
+                    last_scan=p.get('last_scan'),
+                    **{k: p[k] for k in ('excluded_scans', 'lower_charge', 'upper_charge',
+                                         'min_precursor_mz', 'max_precursor_mz', 'ms_levels') if k in p}
+                ),
+                inputs=['mzml_files'], outputs=['mzml_files'], per_file=True))
+        elif name == 'preprocess_spectra':
+            canvas_steps.append(CanvasStep(
+                name, lambda _, p=parameters: proteomics.preprocess_spectra.s(p),
+                inputs=['mzml_files'], outputs=['mzml_files'], per_file=True))
         elif name == 'msfragger':
-            # MSFragger step outputs both reduced and original data
-            task_chain.append(proteomics.msfragger_step.s(parameters))
-
-
+            # one search per file in the chain of the file, batch=True searches all the files together
+            canvas_steps.append(CanvasStep(
+                name, lambda _, p=parameters: proteomics.msfragger_step.s(p),
+                inputs=['mzml_files'], outputs=['pin_files'], per_file=not parameters.get('batch', False)))
+        elif name == 'percolator':
+            # fan-in: one Percolator run over the PSMs of all the files
+            canvas_steps.append(CanvasStep(
+                name, lambda _, p=parameters: proteomics.percolator_step.s(p),
+                inputs=['pin_files'], outputs=['psms']))
+        elif name == 'flashlfq':
+            canvas_steps.append(CanvasStep(
+                name, lambda _, p=parameters: proteomics.flashlfq_step.s(p),
+                inputs=['psms'], outputs=['quantified_proteins']))
         else:
             raise ValueError(f"Unknown step: {name}")
 
     # Costruire la catena
-    return chain(*task_chain)   
+    return build_celery_canvas(
+        canvas_steps,
+        file_paths=file_paths,
+        finalize=lambda step_names, grouped: proteomics.finalize_proteomics_pipeline.s(step_names, grouped)
+    )
+
+
+def run_proteomics_pipeline(data):
+    """
+    Avvia la pipeline di proteomica: per file select_spectra e MSFragger, poi un unico
+    Percolator sui PIN uniti e un'unica quantificazione FlashLFQ con annotazione delle proteine.
+    
+    Args:
+        data (dict): Configurazione della pipeline.
+    
+    Returns:
+        AsyncResult: Risultato dell'ultimo task, il suo id e' l'id della pipeline.
+    """
+    pipeline_chain = create_proteomics_pipeline_chain(data)
+    # ids are assigned before the launch so that every task publishes its progress on the chain id
+    frozen = pipeline_chain.freeze()
+    register_run(frozen)
+    # the run document must exist before the tasks record their stages and metrics on it
+    ProteomicsPipelineModel.create_run(frozen.id, {
+        'status': 'running',
+        'steps': [step.get('name') for step in data.get('pipeline', {}).get('steps', [])],
+        'stages': [],
+        'metrics': [],
+        'created_at': time.time(),
+    })
+    return pipeline_chain.apply_async()
 
 
 @celery_app.task(bind=True) 
@@ -419,6 +464,8 @@ def metabolomics_workflow(self, data):
     # initialize empty dict for results and empty list for the paths of the file selected for the analysis
     results = {}
     file_paths = []
+    tool_runner = get_tool_runner()
+    reporter = ProgressReporter(task_id, task=self)
 
     # check if the steps are present in the pipeline, otherwise return an error
     if not steps:
@@ -439,55 +486,66 @@ def metabolomics_workflow(self, data):
     for step_idx, step in enumerate(steps):
         name = step.get('name')
         parameters = step.get('parameters')
+        # the step parameters come from JSON, numbers may arrive as strings
+        timeout = float(parameters.get("timeout") or 0) or None
 
         if name == "FeatureFinder":
             feature_files = []
+            jobs = []
+            threads = int(parameters.get("threads", 1))
             for file_path in file_paths:
                 base_name = os.path.basename(file_path).replace(".mzML", "")
                 feature_file = os.path.join(results_dir, f"{base_name}.featureXML")
                 feature_files.append(feature_file)
                 cmd = [
-                    "FeatureFinderMetabo", "-in", file_path, "-out", feature_file
+                    "FeatureFinderMetabo", "-in", file_path, "-out", feature_file, "-threads", threads
                 ]
-                try:
-                    subprocess.run(cmd, check=True)
-                except subprocess.CalledProcessError as e:
-                    print(f"Error in processing the {file_path} file: {e}")
+                # errors are reported per file without stopping the other files
+                jobs.append(ToolJob(cmd, threads=threads, check=False, label=base_name,
+                                    timeout=timeout))
+            on_done = lambda done, total, job: reporter.update(name, done=done, total=total, message=job.label)
+            for file_path, tool_result in zip(file_paths, tool_runner.run_many(jobs, on_done=on_done)):
+                if not tool_result.ok:
+                    print(f"Error in processing the {file_path} file: exit code {tool_result.returncode}")
         elif name.lower() == "aligner":
-            aligned_files = [os.path.join(results_dir, f"aligned_{os.path.basename(file_path).replace(".mzML","")}.featureXML") for file_path in file_paths]
+            aligned_files = [os.path.join(results_dir, "aligned_" + os.path.basename(file_path).replace(".mzML", "") + ".featureXML") for file_path in file_paths]
 
             cmd = ["MapAlignerPoseClustering", "-in", *feature_files, "-out", *aligned_files]
             try:
-                subprocess.run(cmd, check=True)
-            except subprocess.CalledProcessError as e:
+                tool_runner.run(ToolJob(cmd, timeout=timeout))
+            except subprocess.SubprocessError as e:
                 print(f"Error during map alignment: {e}")
         elif name.lower() == "LinkingQT":
             output_consensus = os.path.join(results_dir, "consensus_file.consensusXML")
             cmd = ["FeatureLinkerUnlabeledQT", "-in", *aligned_files, "-out", output_consensus]
             try:
-                subprocess.run(cmd, check=True)
-            except subprocess.CalledProcessError as e:
+                tool_runner.run(ToolJob(cmd, timeout=timeout))
+            except subprocess.SubprocessError as e:
                 print(f"Error during the feature linking step: {e}")    
         elif name.lower() == "ms1_annotation":
             cmd = ["AccurateMassSearch", "-in", output_consensus, "-out", os.path.join(results_dir, "annotated_consensus.mzTab")]
             try:
-                subprocess.run(cmd, check=True)
-            except subprocess.CalledProcessError as e:
+                tool_runner.run(ToolJob(cmd, timeout=timeout))
+            except subprocess.SubprocessError as e:
                 print(f"Error during the mass accurate search step: {e}")
         elif name.lower() == "sirius_annotation":
             sirius_output_dir = os.path.join(results_dir, "sirius_output")
             if not os.path.exists(sirius_output_dir):
                 os.makedirs(sirius_output_dir)
+            jobs = []
             for file_path in file_paths:
                 base_name = os.path.basename(file_path).replace(".mzML", "")
                 sirius_output_file_mztab = os.path.join(sirius_output_dir, f"{base_name}_sirius.mzTab")
                 sirius_cmd = [
                     "SiriusAdapter", "-in", file_path, "-out_sirius", sirius_output_file_mztab 
                 ]
-                try:
-                    subprocess.run(sirius_cmd, check=True)
-                except subprocess.CalledProcessError as e:
-                    print(f"Error during SIRIUS annotation for file {file_path}: {e}")
+                jobs.append(ToolJob(sirius_cmd, threads=int(parameters.get("threads", 1)), check=False,
+                                    label=base_name, timeout=timeout,
+                                    memory_limit=parameters.get("memory_limit")))
+            on_done = lambda done, total, job: reporter.update(name, done=done, total=total, message=job.label)
+            for file_path, tool_result in zip(file_paths, tool_runner.run_many(jobs, on_done=on_done)):
+                if not tool_result.ok:
+                    print(f"Error during SIRIUS annotation for file {file_path}: exit code {tool_result.returncode}")
         elif name.lower() == "mztab_processing":
             mztab_file = os.path.join(results_dir, "annotated_consensus.mzTab")
             # implement the mzTab processing function here
@@ -520,22 +578,22 @@ def metabolomics_workflow(self, data):
 @celery_app.task(bind=True)
 def run_metabolomics_pipeline_task(self, data):
     """ 
-    Esegue la pipeline di proteomica attraverso i dati forniti tramite un file JSON che serve a costruire la pipeline utilizzando i parametri personalizzati dall'utente
+    Esegue la pipeline di metabolomica attraverso i dati forniti tramite un file JSON che serve a costruire la pipeline utilizzando i parametri personalizzati dall'utente.
+    Gli step vengono eseguiti come un DAG: gli step per file partono appena i loro input sono pronti
+    e i rami indipendenti (es. ms2_identification) vengono eseguiti in parallelo.
     
     Args:
         data(dict): Configurazione della pipeline di metabolomica.
         
     Returns:
-        AsyncResult: Risultato ottenuto in modo asincrono dalla catena di task
+        str: Path del CSV con i risultati della ricerca HMDB, None se la ricerca non ha prodotto risultati
     
     """
     task_id = self.request.id
     print(f"Running metabolomics pipeline with task ID: {task_id}")
     
     steps = data.get('pipeline', {}).get('steps', [])
-    results = {}
     file_paths = []
-    output_file_consensus = None
     
     if not steps:
         raise ValueError('Pipeline steps are not defined in the data')
@@ -549,145 +607,181 @@ def run_metabolomics_pipeline_task(self, data):
             break
     if not file_paths:
         raise ValueError('No select mzML file found in the pipeline')
-    
-    # initialize result 
-    for file_path in file_paths:
-        results[file_path] = {}
-        print(f'Initialized {os.path.basename(file_path)}')
-        
-    print('Executing Pipeline steps')
-    
-    for step_idx, step in enumerate(steps):
+
+    dag_steps = []
+    for step in steps:
         name = step.get('name', None)
         parameters = step.get('parameters', {})
-        
         if name == 'select_mzML_files':
-            print('files already loaded')
             continue
-        
-        elif name == 'mass_trace_detection':
-            polarity = parameters.get('polarity', 'negative')
-            print('Running mass traces polarity')
-            for i, file_path in enumerate(file_paths):
-                try:
-                    mass_traces = run_mass_trace_detection(file_path, polarity=polarity)   
-                    results[file_path]['mass_traces'] = mass_traces
-                except Exception as e:
-                    print(f'Mass trace detection failed due to the following error: \n {e}')
-                    raise e
-        
-        elif name == 'elution_peak_detection':
-            print('Running elution peak detection')
-            for i, file_path in enumerate(file_paths):
-                if 'mass_traces' not in results[file_path]:
-                    raise ValueError(f'mass_traces not found for the {file_path}, Run mass trace step before elution peak')
-                try:
-                    mass_traces_split = run_elution_peak_detection(results[file_path]['mass_traces'])
-                    results[file_path]['elution_peaks'] = mass_traces_split
-                except Exception as e:
-                    print('Elution peak detection failed due to the following error: \n {e}')
-                    raise e
-            
-        elif name == 'feature_mapping':
-            print('Running feature mapping step')
-            for i, file_path in enumerate(file_paths):
-                if 'elution_peaks' not in results[file_path]:
-                    raise ValueError(f'Elution peak not found for the {file_path}, please run first the elution peak detection step for this sample')
-                try:
-                    run_feature_mapping(file_path, results[file_path]['elution_peaks'])
-                    output_path = file_path.replace('.mzML', '_feature_map.featureXML')
-                    results[file_path]['output_feature_mapping'] = output_path
-                    print(f'Feature mapping for the {file_path} file completed')
-                    
-                except Exception as e:
-                    print(f'Feature mapping failed due to the following error \n {e}')
-                    raise e
-                
-        elif name == 'align_chromatograms':
+        dag_step = build_metabolomics_dag_step(task_id, name, parameters, file_paths)
+        if dag_step is None:
+            print(f'Unknown step name - {name} - SKIPPING \n')
+            continue
+        dag_steps.append(dag_step)
+
+    print('Executing Pipeline steps')
+    reporter = ProgressReporter(task_id, task=self)
+
+    def report_progress(done, total, node):
+        step_name, file_path = node
+        file_index = file_paths.index(file_path) if file_path is not None else None
+        reporter.update(step_name, done=done, total=total, file_index=file_index, n_files=len(file_paths))
+
+    executor = DagExecutor(dag_steps, file_paths, pipeline='metabolomics', progress=report_progress)
+    try:
+        artifacts = executor.run()
+    except Exception as e:
+        reporter.finish('FAILURE', message=str(e))
+        raise
+    finally:
+        if executor.metrics:
+            PipelineModel.push_metrics_by_task_id(task_id, executor.metrics.values())
+    timing_report = executor.log_critical_path()
+    PipelineModel.update_by_task_id(task_id, {'timing_report': timing_report})
+
+    output_csv_path = artifacts.get(('hmdb_search_results', None))
+    reporter.finish('SUCCESS')
+    print('\n PIPELINE COMPLETED SUCCESFULLY')
+    return output_csv_path
+
+
+def build_metabolomics_dag_step(task_id, name, parameters, file_paths):
+    """
+    Builds the DagStep of a metabolomics pipeline step.
+
+    Args:
+        task_id (str): Id of the pipeline task.
+        name (str): Name of the step in the pipeline configuration.
+        parameters (dict): Parameters of the step.
+        file_paths (list): mzML files of the pipeline.
+
+    Returns:
+        DagStep: The step, None if the name is unknown.
+    """
+    if name == 'mass_trace_detection':
+        polarity = parameters.get('polarity', 'negative')
+
+        def mass_trace_detection(file_path, inputs):
+            print(f'Running mass traces detection on {os.path.basename(file_path)}')
+            return {'mass_traces': run_mass_trace_detection(file_path, polarity=polarity)}
+
+        return DagStep(name, mass_trace_detection, outputs=['mass_traces'], per_file=True)
+
+    if name == 'elution_peak_detection':
+        def elution_peak_detection(file_path, inputs):
+            print(f'Running elution peak detection on {os.path.basename(file_path)}')
+            return {'elution_peaks': run_elution_peak_detection(inputs['mass_traces'])}
+
+        return DagStep(name, elution_peak_detection, inputs=['mass_traces'], outputs=['elution_peaks'], per_file=True)
+
+    if name == 'feature_mapping':
+        def feature_mapping(file_path, inputs):
+            output_path = run_feature_mapping(file_path, inputs['elution_peaks'])
+            print(f'Feature mapping for the {file_path} file completed')
+            return {'feature_files': output_path}
+
+        return DagStep(name, feature_mapping, inputs=['elution_peaks'], outputs=['feature_files'], per_file=True)
+
+    if name == 'align_chromatograms':
+        def align_chromatograms(inputs):
             print("📊 Running chromatogram alignment")
-            
-            # collect feature files
-            feature_files = []
-            for file_path in file_paths:
-                if 'output_feature_mapping' not in results[file_path]:
-                    raise ValueError(f'output_feature_mapping not found for {file_path}')
-                feature_files.append(results[file_path]['output_feature_mapping'])
-                
+            feature_files = [inputs['feature_files'][f] for f in file_paths]
             try:
                 metrics = align_featureXML_files(feature_files)
             except Exception as e:
                 print(f'The alignment process ended with the following error: \n {e}')
-        
-        elif name == 'feature_linking':
+                metrics = None
+            return {'alignment_metrics': metrics}
+
+        return DagStep(name, align_chromatograms, inputs=['feature_files'], outputs=['alignment_metrics'])
+
+    if name == 'feature_linking':
+        def feature_linking(inputs):
             print('Running feature linking step')
+            feature_files = [inputs['feature_files'][f] for f in file_paths]
+            output_file_consensus = os.path.join(METABOLOMICS_BASE_PATH, 'final.consensusXML')
             try:
-                output_file_consensus = os.path.join(METABOLOMICS_BASE_PATH, 'final.consensusXML')
-                linked_features = link_features(feature_files, output_file_consensus)
-                # store consensus results globally and not per file since it's merged data
-                results['_consensus'] = {
-                    'consensus_file': output_file_consensus, 
-                    'linked_features': linked_features
-                }
+                link_features(feature_files, output_file_consensus)
             except Exception as e:
                 print(f'The feature linking step ended due to the following error: {e}')
-        
-        elif name == 'hmdb_search':
+                output_file_consensus = None
+            return {'consensus_file': output_file_consensus}
+
+        return DagStep(name, feature_linking, inputs=['feature_files'], outputs=['consensus_file'])
+
+    if name == 'ms2_identification':
+        library_file = parameters.get('library_file', os.path.join(tools_path, 'GNPS-LIBRARY.mzML'))
+
+        def ms2_identification(inputs):
+            print('Running MS2 spectral library identification')
+            if not os.path.exists(library_file):
+                raise FileNotFoundError(f'Spectral library not found: {library_file}')
+            ms2_results = run_ms2_identification_native(
+                file_paths,
+                library_file,
+                os.path.join(METABOLOMICS_BASE_PATH, task_id, 'ms2_identification'),
+                precursor_tolerance_ppm=float(parameters.get('precursor_tolerance_ppm', 10.0)),
+                min_score=float(parameters.get('min_score', 0.7)),
+                min_matched_peaks=int(parameters.get('min_matched_peaks', 3)),
+                top_k=int(parameters.get('top_k', 1)),
+                score=parameters.get('score', 'modified_cosine'),
+                n_workers=int(parameters['n_workers']) if parameters.get('n_workers') else None,
+            )
+            PipelineModel.update_by_task_id(task_id, {'ms2_identification_results': list(ms2_results.values())})
+            return {'ms2_identifications': ms2_results}
+
+        # reads the raw mzML files only, so it runs alongside the feature detection branch
+        return DagStep(name, ms2_identification, outputs=['ms2_identifications'])
+
+    if name == 'hmdb_search':
+        def hmdb_search(inputs):
             print('running hmdb search')
-            
-            # check if consensus file exists
-            if not output_file_consensus or '_consensus' not in results:
+            output_file_consensus = inputs['consensus_file']
+            if not output_file_consensus:
                 raise ValueError('Consensus file not found, run feature_linking first')
-            
-            try:
-                xml_db_path = os.path.join(tools_path, 'hmdb_metabolites.xml')
-                if not os.path.exists(xml_db_path):
-                    raise FileNotFoundError(f'HMDB Database not found: {xml_db_path}')
-                
-                kegg_db_path = os.path.join(tools_path, 'kegg_compounds.csv')
-                if not os.path.exists(kegg_db_path):
-                    raise FileNotFoundError(f'KEGG Database not found: {kegg_db_path}')
-                kegg_df = load_kegg_compounds_csv(kegg_db_path)
-
-                print('Loading hmdb database... \n')
-                hmdb_df = parse_hmdb_to_dataframe_streaming(xml_db_path)
-                
-                print('searching features against HMDB.. \n')
-                feature_dicts = consensus_to_feature_dicts(output_file_consensus, hmdb_df, kegg_df)
-                print(f'Found {len(feature_dicts)} in the consensus map')
-                
-                if feature_dicts:
-                    df = pd.DataFrame(feature_dicts)
-                    initial_count = len(df)
-                    # filter and process results
-                    df = df[df['hmdb_matches'].apply(lambda x: len(x) > 0)]
-                    filtered_count = len(df)
-                    
-                    if filtered_count > 0:     
-                        df = df.sort_values(
-                            by='input_maps',
-                            key=lambda x: x.str.len(),
-                            ascending = False
-                        ).drop_duplicates(subset=['hmdb_matches'], keep = 'first')
-                        output_csv_path = os.path.join(METABOLOMICS_BASE_PATH, 'hmdb_search_results_pipeline.csv')
-                        df.to_csv(output_csv_path)
-                        results['_consensus']['hmdb_search_results'] = output_csv_path
-                        # save the csv into the metabolomics database 
-                        PipelineModel.update_by_task_id(task_id,  {'hmdb_search_result':output_csv_path})
-                        PipelineModel.update_status_by_task_id(task_id, 'completed')
-                        print('HMDB search completed')
-                    else:
-                        print('No HMDB matches found')
+
+            xml_db_path = os.path.join(tools_path, 'hmdb_metabolites.xml')
+            if not os.path.exists(xml_db_path):
+                raise FileNotFoundError(f'HMDB Database not found: {xml_db_path}')
+
+            kegg_db_path = os.path.join(tools_path, 'kegg_compounds.csv')
+            if not os.path.exists(kegg_db_path):
+                raise FileNotFoundError(f'KEGG Database not found: {kegg_db_path}')
+            kegg_df = load_kegg_compounds_csv(kegg_db_path)
+
+            print('Loading hmdb database... \n')
+            hmdb_df = parse_hmdb_to_dataframe_streaming(xml_db_path)
+
+            print('searching features against HMDB.. \n')
+            feature_dicts = consensus_to_feature_dicts(output_file_consensus, hmdb_df, kegg_df)
+            print(f'Found {len(feature_dicts)} in the consensus map')
+            count_items('features', len(feature_dicts))
+
+            output_csv_path = None
+            if feature_dicts:
+                df = pd.DataFrame(feature_dicts)
+                # filter and process results
+                df = df[df['hmdb_matches'].apply(lambda x: len(x) > 0)]
+
+                if len(df) > 0:
+                    df = df.sort_values(
+                        by='input_maps',
+                        key=lambda x: x.str.len(),
+                        ascending=False
+                    ).drop_duplicates(subset=['hmdb_matches'], keep='first')
+                    output_csv_path = os.path.join(METABOLOMICS_BASE_PATH, 'hmdb_search_results_pipeline.csv')
+                    df.to_csv(output_csv_path)
+                    # save the csv into the metabolomics database
+                    PipelineModel.update_by_task_id(task_id, {'hmdb_search_result': output_csv_path})
+                    PipelineModel.update_status_by_task_id(task_id, 'completed')
+                    print('HMDB search completed')
                 else:
-                    print('No features found in consensus map')
-                
-            except Exception as e:
-                print('HMDB search failed')
-                raise e
-            
-        else:
-            print(f'Unknown step name - {name} - SKIPPING \n')
-            
-    print('\n PIPELINE COMPLETED SUCCESFULLY')
-    return output_csv_path
+                    print('No HMDB matches found')
+            else:
+                print('No features found in consensus map')
+            return {'hmdb_search_results': output_csv_path}
 
+        return DagStep(name, hmdb_search, inputs=['consensus_file'], outputs=['hmdb_search_results'])
 
+    return None
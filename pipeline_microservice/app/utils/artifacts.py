@@ -0,0 +1,205 @@
+import os
+import io
+import re
+import logging
+import polars as pl
+from dotenv import load_dotenv
+from app.flow_cytometry_functions import event_store
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+ARTIFACTS_BASE_PATH = os.getenv("PIPELINE_ARTIFACTS_PATH") or os.path.join(
+    os.getenv("METABOLOMICS_BASE_PATH") or "generated_files", "artifacts"
+)
+RESULTS_DEFAULT_PAGE_SIZE = int(os.getenv("RESULTS_DEFAULT_PAGE_SIZE", 1000))
+RESULTS_MAX_PAGE_SIZE = int(os.getenv("RESULTS_MAX_PAGE_SIZE", 100000))
+# rows encoded at a time when streaming NDJSON
+STREAM_CHUNK_ROWS = 5000
+
+TABLE_SUFFIXES = (".parquet", ".csv", ".tsv", ".arrow", ".ipc", ".feather")
+MZ_COLUMNS = ("mz", "MZ", "m/z", "exp_mass_to_charge", "mass_to_charge", "precursor_mz")
+RT_COLUMNS = ("rt", "RT", "retention_time", "rt_seconds")
+
+
+class ArtifactNotFound(LookupError):
+    """Raised when a task has no tabular result to serve."""
+
+
+# task ids and artifact names come from the request, they must stay single path components
+SAFE_NAME = re.compile(r"^[\w-]+$")
+
+
+def artifact_path(task_id, name="result"):
+    """
+    Path of an artifact of a task under ARTIFACTS_BASE_PATH.
+
+    Raises:
+        ValueError: If the task id or the name is not a plain name, or leaves the artifacts folder.
+    """
+    for value in (task_id, name):
+        if not isinstance(value, str) or not SAFE_NAME.match(value):
+            raise ValueError(f"Invalid artifact name: {value!r}")
+    base = os.path.realpath(ARTIFACTS_BASE_PATH)
+    path = os.path.realpath(os.path.join(base, task_id, f"{name}.parquet"))
+    if os.path.commonpath([base, path]) != base:
+        raise ValueError(f"Invalid artifact name: {name!r}")
+    return path
+
+
+def save_table_artifact(task_id, data, name="result"):
+    """
+    Stores a tabular task result as Parquet next to the other artifacts of the task, so that it
+    can be served page by page instead of travelling through the Celery result backend.
+
+    Args:
+        task_id (str): Id of the task producing the result.
+        data (pl.DataFrame | pd.DataFrame | list): The table, or a list of row dicts.
+        name (str): Name of the artifact.
+
+    Returns:
+        dict: Path and number of rows of the artifact, a small payload for the result backend.
+    """
+    if isinstance(data, pl.DataFrame):
+        df = data
+    elif isinstance(data, list):
+        df = pl.DataFrame(data, infer_schema_length=None) if data else pl.DataFrame()
+    else:
+        df = pl.from_pandas(data)
+    path = artifact_path(task_id, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    df.write_parquet(tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+    logger.info(f"Stored {df.height} rows of task {task_id} in {path}")
+    return {"artifact": path, "rows": df.height, "columns": df.columns}
+
+
+def _is_table(path):
+    if not isinstance(path, str):
+        return False
+    if event_store.is_column_set(path) or event_store.is_event_store(path):
+        return True
+    return path.lower().endswith(TABLE_SUFFIXES) and os.path.exists(path)
+
+
+def resolve_artifact(task_id, result=None, name=None):
+    """
+    Finds the table holding the result of a task: the Parquet artifact stored with
+    save_table_artifact, or a table path returned by the task (directly or in a dict), which
+    may be an event store or a column set.
+
+    Args:
+        task_id (str): Id of the task.
+        result: The Celery result of the task, if known.
+        name (str): Name of the artifact, or key of the path in a dict result (e.g. clustering_result).
+
+    Raises:
+        ArtifactNotFound: If no table can be found.
+        ValueError: If the name is not a plain artifact name.
+    """
+    stored = artifact_path(task_id, name or "result")
+    if os.path.exists(stored):
+        return stored
+    if _is_table(result):
+        return result
+    if isinstance(result, dict):
+        if name is not None:
+            for key in (name, f"{name}_path"):
+                if _is_table(result.get(key)):
+                    return result[key]
+        elif _is_table(result.get("artifact")):
+            return result["artifact"]
+        else:
+            for value in result.values():
+                if _is_table(value):
+                    return value
+    raise ArtifactNotFound(f"No tabular result found for task {task_id}")
+
+
+def scan_artifact(path):
+    """
+    Lazily scans a table artifact, so that projection, filters and slicing are pushed down to
+    the reader. A column set is read joined to the events it labels.
+    """
+    if event_store.is_column_set(path) or event_store.is_event_store(path):
+        return event_store.scan_table(path)
+    lower = path.lower()
+    if lower.endswith(".parquet"):
+        return pl.scan_parquet(path)
+    if lower.endswith((".arrow", ".ipc", ".feather")):
+        return pl.scan_ipc(path)
+    return pl.scan_csv(path, separator="\t" if lower.endswith(".tsv") else ",", infer_schema_length=10000)
+
+
+def _find_column(schema, candidates):
+    for column in candidates:
+        if column in schema:
+            return column
+    return None
+
+
+def query_artifact(path, columns=None, offset=0, limit=None, mz_range=None, rt_range=None):
+    """
+    Builds the query of a results page.
+
+    Args:
+        path (str): Table artifact.
+        columns (list): Columns to return, all by default.
+        offset (int): Index of the first row of the page.
+        limit (int): Rows per page, capped to RESULTS_MAX_PAGE_SIZE.
+        mz_range (tuple): (min, max) m/z, either bound may be None.
+        rt_range (tuple): (min, max) retention time, either bound may be None.
+
+    Returns:
+        tuple: (page LazyFrame, filtered LazyFrame used to count the matching rows)
+
+    Raises:
+        ValueError: On unknown columns or on a filter the table does not support.
+    """
+    lf = scan_artifact(path)
+    schema = lf.collect_schema()
+
+    for bounds, candidates, label in ((mz_range, MZ_COLUMNS, "m/z"), (rt_range, RT_COLUMNS, "RT")):
+        if not bounds or all(b is None for b in bounds):
+            continue
+        column = _find_column(schema, candidates)
+        if column is None:
+            raise ValueError(f"The result has no {label} column to filter on")
+        low, high = bounds
+        if low is not None:
+            lf = lf.filter(pl.col(column) >= low)
+        if high is not None:
+            lf = lf.filter(pl.col(column) <= high)
+
+    if columns:
+        unknown = [c for c in columns if c not in schema]
+        if unknown:
+            raise ValueError(f"Unknown columns: {unknown}, available: {list(schema.names())}")
+        lf = lf.select(columns)
+
+    limit = min(int(limit or RESULTS_DEFAULT_PAGE_SIZE), RESULTS_MAX_PAGE_SIZE)
+    return lf.slice(int(offset), limit), lf
+
+
+def count_rows(lf):
+    return lf.select(pl.len()).collect().item()
+
+
+def stream_ndjson(page):
+    """
+    Yields the rows of a page as newline delimited JSON, a chunk of rows at a time.
+    """
+    df = page.collect()
+    for start in range(0, df.height, STREAM_CHUNK_ROWS):
+        yield df.slice(start, STREAM_CHUNK_ROWS).write_ndjson()
+
+
+def to_arrow_ipc(page):
+    """
+    Encodes a page in the Arrow IPC streaming format.
+    """
+    buffer = io.BytesIO()
+    page.collect().write_ipc_stream(buffer)
+    return buffer.getvalue()
@@ -0,0 +1,331 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from celery import chain, group
+from app.utils.instrumentation import measure, record_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DagStep:
+    """
+    A step of a pipeline DAG.
+
+    Args:
+        name (str): Unique name of the step.
+        func (callable): For per-file steps func(file_path, inputs) and for batch steps func(inputs).
+            inputs maps every declared input to its value (per-file steps) or, when the producer
+            is a per-file step, to a {file_path: value} dict (batch steps). The function returns a
+            dict with a value for each declared output.
+        inputs (list): Names of the artifacts consumed by the step.
+        outputs (list): Names of the artifacts produced by the step.
+        per_file (bool): Run the step once per input file instead of once for the whole batch.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), per_file=False):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.per_file = per_file
+
+
+class DagExecutionError(RuntimeError):
+    """Raised when a node of the DAG fails, the original exception is chained."""
+
+    def __init__(self, node, error):
+        super().__init__(f"Step {format_node(node)} failed: {error}")
+        self.node = node
+        self.error = error
+
+
+def format_node(node):
+    step, file_path = node
+    return step if file_path is None else f"{step}[{os.path.basename(file_path)}]"
+
+
+class DagExecutor:
+    """
+    Runs a list of DagStep over a set of files. Every (step, file) pair is a node: per-file nodes
+    start as soon as the upstream nodes of their own file are done, and independent branches run
+    concurrently on a thread pool. Timings are recorded per node for the critical-path report.
+
+    Args:
+        steps (list): DagStep objects; an input is produced by the closest previous step declaring it.
+        file_paths (list): Files processed by the per-file steps.
+        max_workers (int): Size of the thread pool, defaults to PIPELINE_MAX_WORKERS or the CPU count.
+        pipeline (str): Name of the pipeline, used as label of the node metrics.
+        progress (callable): Called as progress(done, total, node) every time a node completes.
+    """
+
+    def __init__(self, steps, file_paths, max_workers=None, pipeline=None, progress=None):
+        self.steps = {}
+        self.pipeline = pipeline
+        self.progress = progress
+        self.file_paths = list(file_paths)
+        self.max_workers = max_workers or int(os.getenv("PIPELINE_MAX_WORKERS", 0)) or os.cpu_count() or 1
+        self.artifacts = {}
+        self.timings = {}
+        self.metrics = {}
+        self.dependencies = {}
+        self._lock = threading.Lock()
+        self._build(steps)
+
+    def _build(self, steps):
+        producers = {}
+        for step in steps:
+            if step.name in self.steps:
+                raise ValueError(f"Duplicate step name: {step.name}")
+            step_producers = {}
+            for artifact in step.inputs:
+                if artifact not in producers:
+                    raise ValueError(f"Step {step.name} needs '{artifact}' but no previous step produces it")
+                step_producers[artifact] = producers[artifact]
+            self.steps[step.name] = (step, step_producers)
+            for artifact in step.outputs:
+                producers[artifact] = step
+
+            for node in self._nodes_of(step):
+                deps = set()
+                for producer in step_producers.values():
+                    if producer.per_file and step.per_file:
+                        deps.add((producer.name, node[1]))
+                    else:
+                        deps.update(self._nodes_of(producer))
+                self.dependencies[node] = deps
+
+    def _nodes_of(self, step):
+        if step.per_file:
+            return [(step.name, file_path) for file_path in self.file_paths]
+        return [(step.name, None)]
+
+    def _inputs_for(self, node):
+        step, step_producers = self.steps[node[0]]
+        inputs = {}
+        for artifact, producer in step_producers.items():
+            if not producer.per_file:
+                inputs[artifact] = self.artifacts[(artifact, None)]
+            elif step.per_file:
+                inputs[artifact] = self.artifacts[(artifact, node[1])]
+            else:
+                inputs[artifact] = {f: self.artifacts[(artifact, f)] for f in self.file_paths}
+        return inputs
+
+    def _run_node(self, node):
+        step, _ = self.steps[node[0]]
+        inputs = self._inputs_for(node)
+        labels = {"pipeline": self.pipeline} if self.pipeline else None
+        start = time.monotonic()
+        instrument = measure(step.name, labels=labels)
+        try:
+            with instrument:
+                outputs = step.func(node[1], inputs) if step.per_file else step.func(inputs)
+        finally:
+            end = time.monotonic()
+            record_metrics(instrument.measurement)
+            with self._lock:
+                self.metrics[node] = dict(instrument.measurement.to_dict(), file=node[1])
+        outputs = outputs or {}
+        missing = [artifact for artifact in step.outputs if artifact not in outputs]
+        if missing:
+            raise ValueError(f"Step {step.name} did not produce {missing}")
+        with self._lock:
+            for artifact in step.outputs:
+                self.artifacts[(artifact, node[1])] = outputs[artifact]
+            self.timings[node] = (start, end)
+        return node
+
+    def run(self):
+        """
+        Executes the DAG, raising DagExecutionError on the first failing node (the running
+        nodes are allowed to finish, no new node is started).
+
+        Returns:
+            dict: The produced artifacts keyed by (artifact, file_path), file_path is None for batch outputs.
+        """
+        self.started_at = time.monotonic()
+        remaining = {node: set(deps) for node, deps in self.dependencies.items()}
+        done = set()
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="dag") as executor:
+            while remaining or running:
+                if error is None:
+                    ready = [node for node, deps in remaining.items() if deps <= done]
+                    for node in ready:
+                        del remaining[node]
+                        logger.info(f"Starting {format_node(node)}")
+                        running[executor.submit(self._run_node, node)] = node
+                if not running:
+                    break
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(node)
+                        self._report_progress(len(done), node)
+                    except Exception as e:
+                        logger.error(f"Step {format_node(node)} failed: {e}")
+                        if error is None:
+                            error = DagExecutionError(node, e)
+                            error.__cause__ = e
+
+        self.finished_at = time.monotonic()
+        if error is not None:
+            raise error
+        if remaining:
+            raise RuntimeError(f"Unreachable steps in the pipeline: {[format_node(n) for n in remaining]}")
+        return self.artifacts
+
+    def _report_progress(self, n_done, node):
+        if self.progress is None:
+            return
+        try:
+            self.progress(n_done, len(self.dependencies), node)
+        except Exception as e:
+            logger.warning(f"Progress callback failed for {format_node(node)}: {e}")
+
+    def critical_path_report(self):
+        """
+        Builds the timing report of the last run: per-node durations, the critical path (the
+        longest chain of dependent nodes) and how much of the wall time it explains.
+        """
+        durations = {node: end - start for node, (start, end) in self.timings.items()}
+        finish = {}
+        previous = {}
+        for node in sorted(self.timings, key=lambda n: self.timings[n][1]):
+            deps = [d for d in self.dependencies[node] if d in finish]
+            best = max(deps, key=lambda d: finish[d], default=None)
+            finish[node] = durations[node] + (finish[best] if best is not None else 0.0)
+            previous[node] = best
+
+        path = []
+        node = max(finish, key=finish.get, default=None)
+        while node is not None:
+            path.append(node)
+            node = previous[node]
+        path.reverse()
+
+        wall_time = getattr(self, "finished_at", time.monotonic()) - getattr(self, "started_at", time.monotonic())
+        busy_time = sum(durations.values())
+        return {
+            "wall_time_sec": round(wall_time, 3),
+            "busy_time_sec": round(busy_time, 3),
+            "parallelism": round(busy_time / wall_time, 2) if wall_time > 0 else None,
+            "critical_path_sec": round(finish[path[-1]], 3) if path else 0.0,
+            "critical_path": [
+                {"step": n[0], "file": n[1], "duration_sec": round(durations[n], 3)} for n in path
+            ],
+            "nodes": [
+                {
+                    "step": n[0],
+                    "file": n[1],
+                    "start_sec": round(self.timings[n][0] - self.started_at, 3),
+                    "duration_sec": round(durations[n], 3),
+                }
+                for n in sorted(self.timings, key=lambda n: self.timings[n][0])
+            ],
+        }
+
+    def log_critical_path(self):
+        report = self.critical_path_report()
+        lines = [
+            f"Pipeline wall time {report['wall_time_sec']} s, busy time {report['busy_time_sec']} s "
+            f"(parallelism {report['parallelism']}), critical path {report['critical_path_sec']} s:"
+        ]
+        for item in report["critical_path"]:
+            lines.append(f"  {format_node((item['step'], item['file']))}: {item['duration_sec']} s")
+        logger.info("\n".join(lines))
+        print("\n".join(lines))
+        return report
+
+
+class CanvasStep:
+    """
+    A step of a Celery pipeline with the artifacts it consumes and produces.
+
+    Args:
+        name (str): Name of the step.
+        signature (callable): Returns the Celery signature of the step; per-file steps receive
+            the list with their single file.
+        inputs (list): Names of the artifacts consumed by the step.
+        outputs (list): Names of the artifacts produced by the step.
+        per_file (bool): Fan the step out per input file.
+    """
+
+    def __init__(self, name, signature, inputs=(), outputs=(), per_file=False):
+        self.name = name
+        self.signature = signature
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.per_file = per_file
+
+
+def build_celery_canvas(steps, file_paths=None, finalize=None):
+    """
+    Turns declared steps into a Celery canvas instead of a flat chain:
+
+    - the leading per-file steps become one chain per file, all running in a group;
+    - the following batch steps form the trunk, each one consuming the result of the previous one;
+    - trailing steps whose outputs nobody consumes (e.g. plots, heatmaps) run concurrently in a group;
+    - finalize(step_names, grouped) returns the signature of the closing task; it receives the
+      result of the last stage (a list aligned with step_names when grouped) so that the id of
+      the canvas, which is the id of its last task, still points to a single task.
+
+    Raises:
+        ValueError: If a trunk step needs an artifact that the previous stage does not produce.
+    """
+    if not steps:
+        raise ValueError("Pipeline steps not defined in the data.")
+
+    prefix = []
+    for step in steps:
+        if not step.per_file:
+            break
+        prefix.append(step)
+    rest = steps[len(prefix):]
+
+    consumed = set()
+    leaves = []
+    for step in reversed(rest):
+        if consumed.intersection(step.outputs):
+            break
+        leaves.insert(0, step)
+        consumed.update(step.inputs)
+    trunk = rest[:len(rest) - len(leaves)]
+
+    # a single trailing step is simply the end of the trunk
+    if len(leaves) == 1:
+        trunk, leaves = trunk + leaves, []
+    if leaves:
+        available = set(trunk[-1].outputs if trunk else prefix[-1].outputs if prefix else [])
+        if not all(set(step.inputs) <= available for step in leaves):
+            trunk, leaves = trunk + leaves, []
+
+    previous = []
+    for step in prefix + trunk:
+        if not set(step.inputs) <= set(previous):
+            raise ValueError(f"Step {step.name} needs {step.inputs} but the previous step produces {previous}")
+        previous = step.outputs
+
+    stages = []
+    if prefix:
+        if not file_paths:
+            raise ValueError("Per-file steps need at least one input file")
+        stages.append(group(chain(*[step.signature([f]) for step in prefix]) for f in file_paths))
+    stages.extend(step.signature(None) for step in trunk)
+    if leaves:
+        stages.append(group(step.signature(None) for step in leaves))
+
+    if finalize is not None:
+        if leaves:
+            stages.append(finalize([step.name for step in leaves], True))
+        elif trunk:
+            stages.append(finalize([trunk[-1].name], False))
+        else:
+            stages.append(finalize([prefix[-1].name], True))
+    return chain(*stages)
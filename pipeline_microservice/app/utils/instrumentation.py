@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import logging
+import threading
+import psutil
+from dotenv import load_dotenv
+from celery.signals import task_prerun, task_postrun
+from app.celery_app import redis_client
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+METRICS_SAMPLE_INTERVAL = float(os.getenv("METRICS_SAMPLE_INTERVAL", 0.2))
+METRICS_PREFIX = "pipeline_metrics"
+# task metrics are kept per chain root for a day, the finalize tasks move them on the run document
+RUN_METRICS_TTL = 24 * 3600
+
+_local = threading.local()
+
+
+def _process_tree_rss(process):
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+    return rss
+
+
+def _io_counters(process):
+    try:
+        counters = process.io_counters()
+        return counters.read_bytes, counters.write_bytes
+    except (AttributeError, psutil.AccessDenied):
+        # io_counters is not available on every platform
+        return None, None
+
+
+class StepMeasurement:
+    """
+    Resource usage of a pipeline step or Celery task, filled by measure().
+
+    CPU time, bytes read/written and the peak RSS are read for the whole worker process and its
+    children (the external tools), so steps running concurrently in the same process overlap.
+    """
+
+    def __init__(self, name, kind="step", labels=None):
+        self.name = name
+        self.kind = kind
+        self.labels = labels or {}
+        self.items = {}
+        self.tools = []
+        self.status = "running"
+        self.wall_time_sec = None
+        self.cpu_time_sec = None
+        self.peak_rss_bytes = None
+        self.read_bytes = None
+        self.written_bytes = None
+        self.started_at = None
+
+    def count(self, item, n):
+        """
+        Adds n processed items (e.g. spectra, features, events) to the measurement.
+        """
+        self.items[item] = self.items.get(item, 0) + int(n)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "status": self.status,
+            "started_at": self.started_at,
+            "wall_time_sec": self.wall_time_sec,
+            "cpu_time_sec": self.cpu_time_sec,
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "read_bytes": self.read_bytes,
+            "written_bytes": self.written_bytes,
+            "items": dict(self.items),
+            "throughput": {
+                item: round(n / self.wall_time_sec, 3)
+                for item, n in self.items.items()
+                if self.wall_time_sec
+            },
+            "tools": list(self.tools),
+        }
+
+
+class measure:
+    """
+    Context manager measuring wall time, CPU time, peak RSS and I/O of a block. The RSS is
+    sampled by a background thread every METRICS_SAMPLE_INTERVAL seconds.
+
+    Usage:
+        with measure('feature_mapping') as m:
+            ...
+            m.count('features', feature_map.size())
+    """
+
+    def __init__(self, name, kind="step", labels=None):
+        self.measurement = StepMeasurement(name, kind, labels)
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def _sample(self):
+        while not self._stop.wait(METRICS_SAMPLE_INTERVAL):
+            try:
+                rss = _process_tree_rss(self._process)
+            except psutil.Error:
+                continue
+            if rss > self.measurement.peak_rss_bytes:
+                self.measurement.peak_rss_bytes = rss
+
+    def __enter__(self):
+        self._process = psutil.Process()
+        self._stack().append(self.measurement)
+        self.measurement.started_at = time.time()
+        self.measurement.peak_rss_bytes = _process_tree_rss(self._process)
+        self._read, self._written = _io_counters(self._process)
+        times = os.times()
+        self._cpu = times.user + times.system + times.children_user + times.children_system
+        self._wall = time.perf_counter()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        return self.measurement
+
+    def __exit__(self, exc_type, exc, tb):
+        m = self.measurement
+        m.wall_time_sec = round(time.perf_counter() - self._wall, 3)
+        times = os.times()
+        m.cpu_time_sec = round(times.user + times.system + times.children_user + times.children_system - self._cpu, 3)
+        self._stop.set()
+        self._sampler.join()
+        read, written = _io_counters(self._process)
+        if read is not None and self._read is not None:
+            m.read_bytes = read - self._read
+            m.written_bytes = written - self._written
+        m.status = "failed" if exc_type is not None else "completed"
+        stack = self._stack()
+        if stack and stack[-1] is m:
+            stack.pop()
+        return False
+
+    @staticmethod
+    def _stack():
+        if not hasattr(_local, "stack"):
+            _local.stack = []
+        return _local.stack
+
+
+def current_measurement():
+    """
+    Returns the innermost measurement active in this thread, None outside of measure().
+    """
+    stack = measure._stack()
+    return stack[-1] if stack else None
+
+
+def count_items(item, n):
+    """
+    Adds n processed items to the measurement of the running step, if any. Safe to call from
+    library code that does not know whether it runs inside a pipeline.
+    """
+    m = current_measurement()
+    if m is not None:
+        m.count(item, n)
+
+
+def _labels(labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return ",".join(f'{k}="{escape(v)}"' for k, v in sorted(labels.items()))
+
+
+def record_metrics(measurement):
+    """
+    Adds a finished measurement to the aggregate counters exposed by /metrics. Errors are only
+    logged: metrics must never make a pipeline fail.
+    """
+    try:
+        labels = dict(measurement.labels, name=measurement.name, kind=measurement.kind)
+        base = _labels(labels)
+        counters = {
+            f"pipeline_step_runs_total{{{_labels(dict(labels, status=measurement.status))}}}": 1,
+            f"pipeline_step_wall_seconds_total{{{base}}}": measurement.wall_time_sec or 0,
+            f"pipeline_step_cpu_seconds_total{{{base}}}": measurement.cpu_time_sec or 0,
+            f"pipeline_step_read_bytes_total{{{base}}}": measurement.read_bytes or 0,
+            f"pipeline_step_written_bytes_total{{{base}}}": measurement.written_bytes or 0,
+        }
+        for item, n in measurement.items.items():
+            counters[f"pipeline_step_items_total{{{_labels(dict(labels, item=item))}}}"] = n
+
+        pipe = redis_client.pipeline()
+        for key, value in counters.items():
+            pipe.hincrbyfloat(f"{METRICS_PREFIX}:counters", key, value)
+        pipe.hset(f"{METRICS_PREFIX}:gauges", f"pipeline_step_last_peak_rss_bytes{{{base}}}", measurement.peak_rss_bytes or 0)
+        pipe.hset(f"{METRICS_PREFIX}:gauges", f"pipeline_step_last_wall_seconds{{{base}}}", measurement.wall_time_sec or 0)
+        pipe.execute()
+        _update_max(f"pipeline_step_max_peak_rss_bytes{{{base}}}", measurement.peak_rss_bytes or 0)
+    except Exception as e:
+        logger.warning(f"Could not record the metrics of {measurement.name}: {e}")
+
+
+def _update_max(key, value):
+    current = redis_client.hget(f"{METRICS_PREFIX}:gauges", key)
+    if current is None or float(current) < value:
+        redis_client.hset(f"{METRICS_PREFIX}:gauges", key, value)
+
+
+def record_tool_result(result):
+    """
+    ToolRunner on_result callback: aggregates the runtime and memory of the external tools and
+    attaches the invocation to the measurement of the running step.
+    """
+    m = current_measurement()
+    if m is not None:
+        m.tools.append(result.to_dict())
+    try:
+        status = "ok" if result.ok else ("timeout" if result.timed_out else "failed")
+        base = _labels({"tool": result.tool})
+        pipe = redis_client.pipeline()
+        pipe.hincrbyfloat(f"{METRICS_PREFIX}:counters", f"pipeline_tool_runs_total{{{_labels({'tool': result.tool, 'status': status})}}}", 1)
+        pipe.hincrbyfloat(f"{METRICS_PREFIX}:counters", f"pipeline_tool_wall_seconds_total{{{base}}}", result.runtime_sec or 0)
+        pipe.execute()
+        _update_max(f"pipeline_tool_max_peak_rss_bytes{{{base}}}", result.peak_rss or 0)
+    except Exception as e:
+        logger.warning(f"Could not record the metrics of {result.tool}: {e}")
+
+
+def push_run_metrics(run_id, metrics):
+    """
+    Keeps the metrics of a task under the id of its chain, so that the task closing the chain
+    can store them on the run document.
+    """
+    try:
+        key = f"{METRICS_PREFIX}:run:{run_id}"
+        redis_client.rpush(key, json.dumps(metrics, default=str))
+        redis_client.expire(key, RUN_METRICS_TTL)
+    except Exception as e:
+        logger.warning(f"Could not store the metrics of run {run_id}: {e}")
+
+
+def pop_run_metrics(run_id):
+    """
+    Returns and deletes the task metrics collected for a chain.
+    """
+    try:
+        key = f"{METRICS_PREFIX}:run:{run_id}"
+        pipe = redis_client.pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        items, _ = pipe.execute()
+        return [json.loads(item) for item in items]
+    except Exception as e:
+        logger.warning(f"Could not read the metrics of run {run_id}: {e}")
+        return []
+
+
+_METRIC_HELP = {
+    "pipeline_step_runs_total": ("counter", "Finished pipeline steps and Celery tasks by status."),
+    "pipeline_step_wall_seconds_total": ("counter", "Wall time spent in pipeline steps."),
+    "pipeline_step_cpu_seconds_total": ("counter", "CPU time of the worker and its tools during pipeline steps."),
+    "pipeline_step_read_bytes_total": ("counter", "Bytes read during pipeline steps."),
+    "pipeline_step_written_bytes_total": ("counter", "Bytes written during pipeline steps."),
+    "pipeline_step_items_total": ("counter", "Items (spectra, features, events) processed by pipeline steps."),
+    "pipeline_step_last_peak_rss_bytes": ("gauge", "Peak RSS of the last run of a step."),
+    "pipeline_step_last_wall_seconds": ("gauge", "Wall time of the last run of a step."),
+    "pipeline_step_max_peak_rss_bytes": ("gauge", "Highest peak RSS observed for a step."),
+    "pipeline_tool_runs_total": ("counter", "External tool invocations by status."),
+    "pipeline_tool_wall_seconds_total": ("counter", "Wall time spent in external tools."),
+    "pipeline_tool_max_peak_rss_bytes": ("gauge", "Highest peak RSS observed for an external tool."),
+}
+
+
+def render_prometheus_metrics():
+    """
+    Renders the aggregate metrics in the Prometheus text exposition format.
+    """
+    samples = {}
+    samples.update(redis_client.hgetall(f"{METRICS_PREFIX}:counters"))
+    samples.update(redis_client.hgetall(f"{METRICS_PREFIX}:gauges"))
+
+    families = {}
+    for key, value in samples.items():
+        families.setdefault(key.split("{", 1)[0], []).append((key, value))
+
+    lines = []
+    for family in sorted(families):
+        metric_type, help_text = _METRIC_HELP.get(family, ("untyped", family))
+        lines.append(f"# HELP {family} {help_text}")
+        lines.append(f"# TYPE {family} {metric_type}")
+        for key, value in sorted(families[family]):
+            lines.append(f"{key} {float(value)!r}")
+    return "\n".join(lines) + "\n"
+
+
+_task_measurements = {}
+
+
+@task_prerun.connect
+def _start_task_measurement(task_id=None, task=None, **kwargs):
+    m = measure(task.name, kind="task")
+    _task_measurements[task_id] = m
+    m.__enter__()
+
+
+@task_postrun.connect
+def _stop_task_measurement(task_id=None, task=None, state=None, **kwargs):
+    m = _task_measurements.pop(task_id, None)
+    if m is None:
+        return
+    m.__exit__(None, None, None)
+    measurement = m.measurement
+    if state is not None and state != "SUCCESS":
+        measurement.status = "failed"
+    record_metrics(measurement)
+    metrics = dict(measurement.to_dict(), task_id=task_id)
+    root_id = getattr(task.request, "root_id", None)
+    if root_id:
+        push_run_metrics(root_id, metrics)
+    logger.info(f"Task {task.name} took {measurement.wall_time_sec} s, peak RSS {measurement.peak_rss_bytes} bytes")
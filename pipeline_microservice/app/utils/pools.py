@@ -0,0 +1,27 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def in_daemon_process():
+    """
+    True in the children of Celery's prefork pool, which are daemonic and cannot start processes.
+    """
+    return multiprocessing.current_process().daemon
+
+
+def worker_pool(max_workers, initializer=None, initargs=()):
+    """
+    Executor of the CPU-bound fan-outs of a step: a process pool, or a thread pool (same
+    initializer, run once per thread) when the step runs in a daemonic Celery worker process.
+    The work should then release the GIL (numpy, numba, C++ extensions) to run in parallel.
+
+    Returns:
+        concurrent.futures.Executor: The pool, to use as a context manager.
+    """
+    if in_daemon_process():
+        logger.info(f"Daemonic worker process, running {max_workers} threads instead of processes")
+        return ThreadPoolExecutor(max_workers=max_workers, initializer=initializer, initargs=initargs)
+    return ProcessPoolExecutor(max_workers=max_workers, initializer=initializer, initargs=initargs)
@@ -0,0 +1,244 @@
+import json
+import time
+import logging
+import threading
+from celery.signals import task_prerun, task_postrun
+from app.celery_app import redis_client
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_PREFIX = "pipeline_progress"
+# snapshots and run aliases outlive the run so that late subscribers can still catch up
+PROGRESS_TTL = 7 * 24 * 3600
+TERMINAL_STATES = ("SUCCESS", "FAILURE", "REVOKED")
+# seconds between two SSE keep-alive comments
+HEARTBEAT_INTERVAL = 15
+
+
+def channel_name(run_id):
+    return f"{PROGRESS_PREFIX}:{run_id}"
+
+
+def snapshot_key(run_id):
+    return f"{PROGRESS_PREFIX}:{run_id}:snapshot"
+
+
+def _result_ids(result):
+    """
+    Ids of all the nodes of a (frozen) canvas result, the parents and for groups the children,
+    plus the number of actual tasks.
+    """
+    ids = []
+    n_tasks = 0
+    pending = [result]
+    while pending:
+        node = pending.pop()
+        if node is None:
+            continue
+        ids.append(node.id)
+        pending.append(node.parent)
+        children = getattr(node, "results", None)
+        if children is None:
+            n_tasks += 1
+        else:
+            pending.extend(children)
+    return ids, n_tasks
+
+
+def register_run(result):
+    """
+    Maps every task of a canvas to the id returned to the client (the id of the last task), so
+    that all of them publish on the channel the client subscribes to. Call it on the result of
+    canvas.freeze() before apply_async(), so that the first tasks cannot start unmapped.
+    """
+    ids, n_tasks = _result_ids(result)
+    pipe = redis_client.pipeline()
+    for task_id in ids:
+        pipe.set(f"{PROGRESS_PREFIX}:alias:{task_id}", result.id, ex=PROGRESS_TTL)
+    pipe.set(f"{PROGRESS_PREFIX}:{result.id}:total", n_tasks, ex=PROGRESS_TTL)
+    pipe.execute()
+    publish_progress(result.id, None, state="PENDING", percent=0.0, done=0, total=n_tasks)
+
+
+def resolve_run_id(task_id, root_id=None):
+    """
+    Returns the run a task belongs to, None if the task is not part of a registered canvas.
+    """
+    for candidate in (task_id, root_id):
+        if candidate:
+            alias = redis_client.get(f"{PROGRESS_PREFIX}:alias:{candidate}")
+            if alias:
+                return alias
+    return None
+
+
+def publish_progress(run_id, step, state="PROGRESS", file_index=None, n_files=None, percent=None,
+                     eta_sec=None, message=None, **extra):
+    """
+    Publishes a progress event of a run on its Redis channel and stores it as the snapshot of
+    the run. Errors are only logged: progress must never make a pipeline fail.
+
+    Returns:
+        dict: The published event.
+    """
+    event = {
+        "run_id": run_id,
+        "step": step,
+        "state": state,
+        "file_index": file_index,
+        "n_files": n_files,
+        "percent": round(percent, 1) if percent is not None else None,
+        "eta_sec": round(eta_sec, 1) if eta_sec is not None else None,
+        "message": message,
+        "timestamp": time.time(),
+    }
+    event.update(extra)
+    try:
+        event["seq"] = redis_client.incr(f"{PROGRESS_PREFIX}:{run_id}:seq")
+        payload = json.dumps(event, default=str)
+        pipe = redis_client.pipeline()
+        pipe.set(snapshot_key(run_id), payload, ex=PROGRESS_TTL)
+        pipe.expire(f"{PROGRESS_PREFIX}:{run_id}:seq", PROGRESS_TTL)
+        pipe.publish(channel_name(run_id), payload)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Could not publish the progress of run {run_id}: {e}")
+    return event
+
+
+def get_snapshot(run_id):
+    payload = redis_client.get(snapshot_key(run_id))
+    return json.loads(payload) if payload else None
+
+
+class ProgressReporter:
+    """
+    Tracks the completed units of work of a run and publishes percent and ETA.
+
+    Args:
+        run_id (str): Id the client subscribes to.
+        total (int): Number of units of work (e.g. DAG nodes), may be updated later.
+        task: Bound Celery task, its state is set to PROGRESS with the last event as meta.
+    """
+
+    def __init__(self, run_id, total=None, task=None):
+        self.run_id = run_id
+        self.total = total
+        self.task = task
+        self.done = 0
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _eta(self, done, total):
+        if not done or not total:
+            return None
+        elapsed = time.monotonic() - self.started_at
+        return elapsed / done * (total - done)
+
+    def update(self, step, done=None, total=None, file_index=None, n_files=None, message=None):
+        """
+        Publishes the progress of a step. done/total default to the units completed by advance().
+        """
+        with self._lock:
+            done = self.done if done is None else done
+            total = total or self.total
+        percent = 100.0 * done / total if total else None
+        event = publish_progress(
+            self.run_id, step, file_index=file_index, n_files=n_files, percent=percent,
+            eta_sec=self._eta(done, total), message=message, done=done, total=total,
+        )
+        if self.task is not None:
+            try:
+                self.task.update_state(state="PROGRESS", meta=event)
+            except Exception as e:
+                logger.warning(f"Could not update the state of task {self.run_id}: {e}")
+        return event
+
+    def advance(self, step, n=1, **kwargs):
+        """
+        Marks n more units of work as completed and publishes the progress.
+        """
+        with self._lock:
+            self.done += n
+        return self.update(step, **kwargs)
+
+    def finish(self, state="SUCCESS", message=None, **extra):
+        return publish_progress(
+            self.run_id, None, state=state, percent=100.0 if state == "SUCCESS" else None,
+            eta_sec=0 if state == "SUCCESS" else None, message=message, **extra
+        )
+
+
+def stream_events(run_id, heartbeat=HEARTBEAT_INTERVAL):
+    """
+    Generator of Server-Sent Events for a run: the snapshot first, then every new event until
+    the run reaches a terminal state.
+    """
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    # subscribe before reading the snapshot so that no event published in between is lost
+    pubsub.subscribe(channel_name(run_id))
+    try:
+        last_seq = 0
+        snapshot = get_snapshot(run_id)
+        if snapshot is not None:
+            last_seq = snapshot.get("seq", 0)
+            yield f"id: {last_seq}\nevent: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+            if snapshot.get("state") in TERMINAL_STATES:
+                return
+        while True:
+            message = pubsub.get_message(timeout=heartbeat)
+            if message is None:
+                yield ": keep-alive\n\n"
+                continue
+            event = json.loads(message["data"])
+            if event.get("seq", 0) <= last_seq:
+                continue
+            last_seq = event.get("seq", last_seq)
+            yield f"id: {last_seq}\nevent: progress\ndata: {message['data']}\n\n"
+            if event.get("state") in TERMINAL_STATES:
+                return
+    finally:
+        pubsub.close()
+
+
+def _short_name(task_name):
+    return task_name.rsplit(".", 1)[-1]
+
+
+@task_prerun.connect
+def _publish_task_started(task_id=None, task=None, **kwargs):
+    try:
+        run_id = resolve_run_id(task_id, getattr(task.request, "root_id", None))
+    except Exception as e:
+        logger.warning(f"Could not resolve the run of task {task_id}: {e}")
+        return
+    # standalone tasks (e.g. the metabolomics DAG) report their own progress
+    if run_id is not None:
+        publish_progress(run_id, _short_name(task.name), state="STARTED", task_id=task_id)
+
+
+@task_postrun.connect
+def _publish_task_finished(task_id=None, task=None, state=None, **kwargs):
+    try:
+        run_id = resolve_run_id(task_id, getattr(task.request, "root_id", None))
+    except Exception as e:
+        logger.warning(f"Could not resolve the run of task {task_id}: {e}")
+        return
+    if state == "FAILURE":
+        publish_progress(run_id or task_id, _short_name(task.name), state="FAILURE", task_id=task_id)
+    elif run_id is not None:
+        # the last task of a canvas has the id returned to the client
+        try:
+            pipe = redis_client.pipeline()
+            pipe.incr(f"{PROGRESS_PREFIX}:{run_id}:done")
+            pipe.expire(f"{PROGRESS_PREFIX}:{run_id}:done", PROGRESS_TTL)
+            pipe.get(f"{PROGRESS_PREFIX}:{run_id}:total")
+            done, _, total = pipe.execute()
+            total = int(total) if total else None
+        except Exception as e:
+            logger.warning(f"Could not count the finished tasks of run {run_id}: {e}")
+            done, total = None, None
+        step_state = "SUCCESS" if run_id == task_id else "STEP_DONE"
+        percent = 100.0 * done / total if done and total else None
+        publish_progress(run_id, _short_name(task.name), state=step_state, percent=percent, task_id=task_id,
+                         done=done, total=total)
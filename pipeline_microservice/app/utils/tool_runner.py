@@ -0,0 +1,440 @@
+import os
+import re
+import json
+import time
+import uuid
+import fcntl
+import signal
+import tempfile
+import logging
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import psutil
+from dotenv import load_dotenv
+from app.utils.instrumentation import record_tool_result
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# default number of concurrent invocations per tool, the CPU budget still applies on top of it
+DEFAULT_TOOL_LIMITS = {
+    "java": 1,  # MSFragger
+    "dotnet": 1,  # FlashLFQ
+    "percolator": 2,
+    "SiriusAdapter": 2,
+    "MetaboliteSpectralMatcher": 2,
+    "MapAlignerPoseClustering": 1,
+    "FeatureLinkerUnlabeledQT": 1,
+}
+
+# how often the process tree is sampled for memory usage and the deadline checked
+POLL_INTERVAL = 0.2
+
+# number of output lines kept in memory for error messages when the output is not captured
+TAIL_LINES = 200
+
+# reservations of the running tools of all the worker processes of the machine
+TOOL_BUDGET_FILE = os.getenv("TOOL_BUDGET_FILE") or os.path.join(tempfile.gettempdir(), "omnis_tool_budget.json")
+
+
+class ToolMemoryExceeded(subprocess.SubprocessError):
+    """Raised when an external tool goes above its memory limit and gets killed."""
+
+    def __init__(self, cmd, memory_limit, peak_rss, output=None, stderr=None):
+        self.cmd = cmd
+        self.memory_limit = memory_limit
+        self.peak_rss = peak_rss
+        self.output = output
+        self.stderr = stderr
+
+    def __str__(self):
+        return (f"Command '{self.cmd}' killed after exceeding the memory limit "
+                f"({format_bytes(self.peak_rss)} > {format_bytes(self.memory_limit)})")
+
+
+def parse_memory(value):
+    """
+    Converts a memory size ("16G", "512M", "1.5GB", 1024) into bytes.
+    """
+    if value is None or isinstance(value, (int, float)):
+        return int(value) if value is not None else None
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)B?\s*", str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid memory size: {value}")
+    number, unit = match.groups()
+    factor = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}[unit.upper()]
+    return int(float(number) * factor)
+
+
+def format_bytes(value):
+    if value is None:
+        return "n/a"
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(value) < 1024:
+            return f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} TB"
+
+
+def parse_tool_limits(value):
+    """
+    Parses the TOOL_CONCURRENCY variable, e.g. "FeatureFinderMetabo=4,java=1".
+    """
+    limits = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            tool, limit = item.split("=", 1)
+            limits[tool.strip()] = int(limit)
+    return limits
+
+
+class ToolJob:
+    """
+    A command to run through the ToolRunner.
+
+    Args:
+        cmd (list): Command and arguments.
+        tool (str): Name used for the concurrency limit, defaults to the executable name.
+        threads (int): CPU slots reserved while the tool runs, None reserves the whole budget.
+        timeout (float): Seconds before the process tree is killed.
+        memory_limit (int | str): Resident memory above which the process tree is killed.
+        capture_output (bool): Keep the whole stdout/stderr on the result.
+        check (bool): Raise on a non-zero exit code, timeout or memory limit.
+        cwd (str): Working directory.
+        env (dict): Extra environment variables.
+        label (str): Short description used in the log, e.g. the input file.
+    """
+
+    def __init__(self, cmd, tool=None, threads=1, timeout=None, memory_limit=None, capture_output=False,
+                 check=True, cwd=None, env=None, label=None):
+        self.cmd = [str(c) for c in cmd]
+        self.tool = tool or os.path.basename(self.cmd[0])
+        self.threads = threads
+        self.timeout = float(timeout) if timeout else None
+        self.memory_limit = parse_memory(memory_limit)
+        self.capture_output = capture_output
+        self.check = check
+        self.cwd = cwd
+        self.env = env
+        self.label = label
+
+
+class ToolResult:
+    """
+    Outcome and resource usage of a single tool invocation.
+    """
+
+    def __init__(self, job, returncode, runtime_sec, peak_rss, stdout, stderr, timed_out=False, memory_exceeded=False):
+        self.job = job
+        self.cmd = job.cmd
+        self.tool = job.tool
+        self.returncode = returncode
+        self.runtime_sec = runtime_sec
+        self.peak_rss = peak_rss
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.memory_exceeded = memory_exceeded
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out and not self.memory_exceeded
+
+    def to_dict(self):
+        return {
+            "tool": self.tool,
+            "label": self.job.label,
+            "cmd": " ".join(self.cmd),
+            "returncode": self.returncode,
+            "runtime_sec": round(self.runtime_sec, 3),
+            "peak_rss_bytes": self.peak_rss,
+            "threads": self.job.threads,
+            "timed_out": self.timed_out,
+            "memory_exceeded": self.memory_exceeded,
+        }
+
+
+class _ResourceBudget:
+    """
+    Counting budget of CPU slots, memory and per-tool invocations shared by all the running
+    tools of the machine. Every Celery prefork child has its own runner, so the reservations
+    are kept in a ledger file locked with flock; those of processes that died are dropped.
+    """
+
+    def __init__(self, max_cpus, max_memory=None, ledger_path=None):
+        self.max_cpus = max_cpus
+        self.max_memory = max_memory
+        self.ledger_path = ledger_path or TOOL_BUDGET_FILE
+        self.condition = threading.Condition()
+        self._created = psutil.Process().create_time()
+
+    def clamp(self, threads, memory):
+        cpus = self.max_cpus if threads is None else max(1, min(int(threads), self.max_cpus))
+        if self.max_memory is None or memory is None:
+            return cpus, 0
+        return cpus, min(memory, self.max_memory)
+
+    @staticmethod
+    def _alive(entry):
+        try:
+            return psutil.Process(entry["pid"]).create_time() == entry["created"]
+        except psutil.Error:
+            return False
+
+    def _update(self, change):
+        """
+        Applies change(entries) to the reservations under the file lock and returns its result.
+        """
+        with open(self.ledger_path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                entries = json.loads(f.read() or "[]")
+            except ValueError:
+                entries = []
+            entries = [e for e in entries if self._alive(e)]
+            result = change(entries)
+            f.seek(0)
+            f.truncate()
+            json.dump(entries, f)
+            return result
+
+    def acquire(self, cpus, memory, tool=None, tool_limit=None):
+        """
+        Blocks until the reservation fits in the budget.
+
+        Returns:
+            str: Token of the reservation, for release().
+        """
+        token = uuid.uuid4().hex
+
+        def reserve(entries):
+            fits = (sum(e["cpus"] for e in entries) + cpus <= self.max_cpus
+                    and (self.max_memory is None or sum(e["memory"] for e in entries) + memory <= self.max_memory)
+                    and (tool_limit is None or sum(e["tool"] == tool for e in entries) < tool_limit))
+            if fits:
+                entries.append({"token": token, "pid": os.getpid(), "created": self._created,
+                                "tool": tool, "cpus": cpus, "memory": memory})
+            return fits
+
+        with self.condition:
+            # released slots of this process wake the waiters, those of other processes are polled
+            while not self._update(reserve):
+                self.condition.wait(POLL_INTERVAL)
+        return token
+
+    def release(self, token):
+        def drop(entries):
+            entries[:] = [e for e in entries if e["token"] != token]
+
+        with self.condition:
+            self._update(drop)
+            self.condition.notify_all()
+
+
+class ToolRunner:
+    """
+    Runs external tools (OpenMS, SIRIUS, MSFragger, Percolator, FlashLFQ) with a CPU and memory
+    budget and per-tool concurrency limits shared by the worker processes of the machine,
+    timeouts, memory limits and streamed output.
+
+    Args:
+        max_cpus (int): CPU slots shared by all the tools, defaults to TOOL_MAX_CPUS or the CPU count.
+        max_memory (int | str): Memory reserved by the jobs with a memory limit, defaults to TOOL_MAX_MEMORY.
+        tool_limits (dict): Maximum concurrent invocations per tool, merged over DEFAULT_TOOL_LIMITS
+            and TOOL_CONCURRENCY.
+        on_result (callable): Called with every ToolResult, e.g. to store the metrics of a run.
+    """
+
+    def __init__(self, max_cpus=None, max_memory=None, tool_limits=None, on_result=None):
+        max_cpus = max_cpus or int(os.getenv("TOOL_MAX_CPUS", 0)) or os.cpu_count() or 1
+        self.budget = _ResourceBudget(max_cpus, parse_memory(max_memory or os.getenv("TOOL_MAX_MEMORY")))
+        self.tool_limits = dict(DEFAULT_TOOL_LIMITS)
+        self.tool_limits.update(parse_tool_limits(os.getenv("TOOL_CONCURRENCY")))
+        self.tool_limits.update(tool_limits or {})
+        self.default_timeout = float(os.getenv("TOOL_TIMEOUT", 0)) or None
+        self.on_result = on_result
+
+    @property
+    def max_cpus(self):
+        return self.budget.max_cpus
+
+    def run(self, job):
+        """
+        Runs a single job, blocking until a slot in the budget is available.
+
+        Returns:
+            ToolResult: Exit code, runtime, peak RSS and output of the invocation.
+
+        Raises (only when job.check is set, otherwise the failure is reported on the result):
+            subprocess.CalledProcessError: If the exit code is non-zero.
+            subprocess.TimeoutExpired: If the job runs longer than its timeout.
+            ToolMemoryExceeded: If the job goes above its memory limit.
+        """
+        cpus, memory = self.budget.clamp(job.threads, job.memory_limit)
+        token = self.budget.acquire(cpus, memory, job.tool, self.tool_limits.get(job.tool))
+        try:
+            result = self._execute(job, cpus)
+        finally:
+            self.budget.release(token)
+
+        if self.on_result is not None:
+            self.on_result(result)
+
+        stdout, stderr = result.stdout, result.stderr
+        if not job.check:
+            return result
+        if result.timed_out:
+            raise subprocess.TimeoutExpired(job.cmd, job.timeout or self.default_timeout, output=stdout, stderr=stderr)
+        if result.memory_exceeded:
+            raise ToolMemoryExceeded(job.cmd, job.memory_limit, result.peak_rss, output=stdout, stderr=stderr)
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, job.cmd, output=stdout, stderr=stderr)
+        return result
+
+    def run_many(self, jobs, max_workers=None, on_done=None):
+        """
+        Runs a queue of jobs concurrently within the budget and returns the results in order.
+        The first failing job (with check=True) raises once all the submitted jobs are done.
+        on_done(done, total, job) is called as soon as each job ends, e.g. to report progress.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return []
+        max_workers = max_workers or min(len(jobs), self.max_cpus)
+        done = []
+        done_lock = threading.Lock()
+
+        def notify(job):
+            with done_lock:
+                done.append(job)
+                count = len(done)
+            try:
+                on_done(count, len(jobs), job)
+            except Exception as e:
+                logger.warning(f"Progress callback failed: {e}")
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool") as executor:
+            futures = [executor.submit(self.run, job) for job in jobs]
+            if on_done is not None:
+                for future, job in zip(futures, jobs):
+                    future.add_done_callback(lambda _, job=job: notify(job))
+            errors = [f.exception() for f in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+        return [f.result() for f in futures]
+
+    def _execute(self, job, cpus):
+        env = dict(os.environ)
+        env.update(job.env or {})
+        # keep the thread pools of the tools inside their CPU slots
+        env.setdefault("OMP_NUM_THREADS", str(cpus))
+
+        timeout = job.timeout or self.default_timeout
+        label = f"{job.tool}" + (f" [{job.label}]" if job.label else "")
+        logger.info(f"Starting {label} with {cpus} CPU slot(s): {' '.join(job.cmd)}")
+
+        start = time.monotonic()
+        process = subprocess.Popen(
+            job.cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors="replace",
+            cwd=job.cwd, env=env, start_new_session=True
+        )
+        stdout = [] if job.capture_output else deque(maxlen=TAIL_LINES)
+        stderr = [] if job.capture_output else deque(maxlen=TAIL_LINES)
+        readers = [
+            threading.Thread(target=self._stream, args=(process.stdout, stdout, label, logging.INFO), daemon=True),
+            threading.Thread(target=self._stream, args=(process.stderr, stderr, label, logging.WARNING), daemon=True),
+        ]
+        for reader in readers:
+            reader.start()
+
+        peak_rss = 0
+        timed_out = memory_exceeded = False
+        try:
+            ps_process = psutil.Process(process.pid)
+        except psutil.Error:
+            ps_process = None
+
+        while True:
+            try:
+                process.wait(timeout=POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            rss = self._tree_rss(ps_process)
+            peak_rss = max(peak_rss, rss)
+            if job.memory_limit is not None and rss > job.memory_limit:
+                memory_exceeded = True
+            elif timeout is not None and time.monotonic() - start > timeout:
+                timed_out = True
+            if timed_out or memory_exceeded:
+                self._kill(process)
+                process.wait()
+                break
+
+        for reader in readers:
+            reader.join()
+        runtime = time.monotonic() - start
+
+        result = ToolResult(job, process.returncode, runtime, peak_rss or None, "".join(stdout), "".join(stderr),
+                            timed_out=timed_out, memory_exceeded=memory_exceeded)
+        reason = " (timeout)" if timed_out else " (memory limit)" if memory_exceeded else ""
+        logger.info(f"Finished {label}: exit code {process.returncode}{reason}, "
+                    f"{runtime:.1f} s, peak RSS {format_bytes(result.peak_rss)}")
+        return result
+
+    @staticmethod
+    def _stream(pipe, buffer, label, level):
+        for line in iter(pipe.readline, ""):
+            buffer.append(line)
+            logger.log(level, f"[{label}] {line.rstrip()}")
+        pipe.close()
+
+    @staticmethod
+    def _tree_rss(ps_process):
+        if ps_process is None:
+            return 0
+        try:
+            processes = [ps_process] + ps_process.children(recursive=True)
+        except psutil.Error:
+            return 0
+        rss = 0
+        for p in processes:
+            try:
+                rss += p.memory_info().rss
+            except psutil.Error:
+                continue
+        return rss
+
+    @staticmethod
+    def _kill(process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            process.kill()
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_tool_runner():
+    """
+    Returns the tool runner shared by all the tasks of the worker process.
+    """
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = ToolRunner(on_result=record_tool_result)
+        return _runner
+
+
+def run_tool(cmd, **kwargs):
+    """
+    Shortcut to run a single command through the shared runner, kwargs are passed to ToolJob.
+    """
+    return get_tool_runner().run(ToolJob(cmd, **kwargs))
@@ -0,0 +1,273 @@
+"""
+Benchmark harness of the metabolomics stages on synthetic data.
+
+Every stage runs on the datasets generated by synthetic_mzml for each requested scale and is
+measured with app.utils.instrumentation.measure (wall time, CPU time, peak RSS, processed
+items). Results are stored as a JSON baseline that later runs can be compared against.
+
+Usage (from pipeline_microservice/):
+    python -m benchmarks.run_benchmarks --scales small medium
+    python -m benchmarks.run_benchmarks --scales small --compare benchmarks/baselines/<commit>.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINES_DIR = os.path.join(BENCHMARKS_DIR, "baselines")
+
+STAGES = [
+    "mass_trace_detection",
+    "elution_peak_detection",
+    "feature_mapping",
+    "align_chromatograms",
+    "feature_linking",
+    "consensus_to_feature_dicts",
+    "compounds_filters",
+]
+
+
+def _prepare_environment(workdir):
+    # the cd_pipeline modules read their output folder at import time and importing app needs
+    # the Mongo URIs: the clients are lazy, so placeholders are enough for the benchmarks
+    os.environ["METABOLOMICS_BASE_PATH"] = os.path.join(workdir, "output")
+    os.makedirs(os.environ["METABOLOMICS_BASE_PATH"], exist_ok=True)
+    for key in ("MONGO_URI_FLOW_CYTOMETRY", "MONGO_URI_PROTEOMICS", "MONGO_URI_METABOLOMICS"):
+        os.environ.setdefault(key, "mongodb://localhost:27017/benchmarks")
+    sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARKS_DIR, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return "unknown"
+
+
+def _summary(measurements):
+    """
+    Merges the measurements of a stage run once per file: times and items are summed, the peak
+    RSS is the highest one.
+    """
+    wall = sum(m.wall_time_sec for m in measurements)
+    items = {}
+    for m in measurements:
+        for item, n in m.items.items():
+            items[item] = items.get(item, 0) + n
+    return {
+        "wall_time_sec": round(wall, 3),
+        "cpu_time_sec": round(sum(m.cpu_time_sec for m in measurements), 3),
+        "peak_rss_bytes": max(m.peak_rss_bytes for m in measurements),
+        "items": items,
+        "throughput": {item: round(n / wall, 3) for item, n in items.items() if wall > 0},
+    }
+
+
+def _synthetic_databases(truth_file, seed):
+    """
+    HMDB and KEGG tables containing the neutral masses of the synthetic compounds plus decoys,
+    with the columns produced by parse_hmdb_to_dataframe_streaming and load_kegg_compounds_csv.
+    The neutral masses are those of the ground truth (ion m/z corrected by the proton mass of
+    the [M+H]+ or [M-H]- ion), like the monoisotopic masses of the real databases.
+    """
+    import numpy as np
+    import polars as pl
+
+    truth = pl.read_csv(truth_file)
+    rng = np.random.default_rng(seed)
+    masses = np.concatenate([truth["neutral_mass"].to_numpy(), rng.uniform(80, 1000, 20 * len(truth))])
+    names = [f"compound_{i}" for i in range(len(masses))]
+    hmdb_df = pl.DataFrame({
+        "accession": [f"HMDB{i:07d}" for i in range(len(masses))],
+        "name": names,
+        "mass": masses,
+    }).sort("mass")
+    kegg_df = pl.DataFrame({
+        "KEGG_ID": [f"C{i:05d}" for i in range(len(masses))],
+        "Name": names,
+        "Formula": [""] * len(masses),
+        "Exact_Mass": masses,
+    }).sort("Exact_Mass")
+    return hmdb_df, kegg_df
+
+
+def run_scale(scale, stages, workdir, seed=None):
+    """
+    Generates the dataset of a scale and runs the requested stages on it.
+
+    Returns:
+        dict: Dataset configuration and one summary per stage.
+    """
+    from benchmarks.synthetic_mzml import make_config, generate_dataset
+    from app.utils.instrumentation import measure
+    from app.metabolomics_function.cd_pipeline.mass_trace import run_mass_trace_detection
+    from app.metabolomics_function.cd_pipeline.elution_peak import run_elution_peak_detection
+    from app.metabolomics_function.cd_pipeline.feature_map import run_feature_mapping
+    from app.metabolomics_function.cd_pipeline.align_chromatograms import align_featureXML_files
+    from app.metabolomics_function.cd_pipeline.link_features import link_features
+    from app.metabolomics_function.cd_pipeline.hmdb_indexing import consensus_to_feature_dicts
+
+    config = make_config(scale, seed=seed)
+    data_dir = os.path.join(workdir, scale)
+    start = time.perf_counter()
+    dataset = generate_dataset(data_dir, config)
+    print(f"[{scale}] generated {config['n_samples']} samples in {time.perf_counter() - start:.1f} s")
+    files = dataset["mzml_files"]
+    results = {}
+
+    def run_stage(name, func, per_file_inputs=None):
+        measurements = []
+        outputs = {}
+        for key in (per_file_inputs or [None]):
+            with measure(name, kind="benchmark") as m:
+                outputs[key] = func(key, m)
+            measurements.append(m)
+        results[name] = _summary(measurements)
+        print(f"[{scale}] {name}: {results[name]['wall_time_sec']} s, "
+              f"peak RSS {results[name]['peak_rss_bytes'] / 2 ** 20:.0f} MiB, items {results[name]['items']}")
+        return outputs
+
+    needed = set(stages)
+    # stages depend on the outputs of the previous ones
+    if needed & {"elution_peak_detection", "feature_mapping", "align_chromatograms", "feature_linking",
+                 "consensus_to_feature_dicts"}:
+        needed.update({"mass_trace_detection", "elution_peak_detection", "feature_mapping"})
+    if "consensus_to_feature_dicts" in needed:
+        needed.add("feature_linking")
+
+    if "mass_trace_detection" in needed:
+        traces = run_stage(
+            "mass_trace_detection", lambda f, m: run_mass_trace_detection(f, polarity=config["polarity"]), files
+        )
+    if "elution_peak_detection" in needed:
+        def elution(f, m):
+            split = run_elution_peak_detection(traces[f])
+            m.count("mass_traces", len(traces[f]))
+            return split
+        peaks = run_stage("elution_peak_detection", elution, files)
+    if "feature_mapping" in needed:
+        feature_files = run_stage("feature_mapping", lambda f, m: run_feature_mapping(f, peaks[f]), files)
+        feature_files = [feature_files[f] for f in files]
+    if "align_chromatograms" in needed:
+        def align(_, m):
+            metrics = align_featureXML_files(feature_files)
+            m.count("features", sum(metrics["features_per_file"]))
+            return metrics
+        run_stage("align_chromatograms", align)
+    if "feature_linking" in needed:
+        consensus_file = os.path.join(data_dir, "benchmark.consensusXML")
+        run_stage("feature_linking", lambda _, m: link_features(feature_files, consensus_file))
+    if "consensus_to_feature_dicts" in needed:
+        hmdb_df, kegg_df = _synthetic_databases(dataset["truth_file"], config["seed"])
+
+        def annotate(_, m):
+            feature_dicts = consensus_to_feature_dicts(consensus_file, hmdb_df, kegg_df)
+            m.count("consensus_features", len(feature_dicts))
+            return feature_dicts
+        run_stage("consensus_to_feature_dicts", annotate)
+    if "compounds_filters" in needed:
+        import pyopenms as oms
+        from app.metabolomics_function.basic import serialize_ms_experiment
+        from app.metabolomics_function import compounds
+
+        def filters(f, m):
+            exp = oms.MSExperiment()
+            oms.MzMLFile().load(f, exp)
+            m.count("spectra", exp.size())
+            chromatograms = compounds.extract_chromatograms_from_json(serialize_ms_experiment(exp), 10)
+            chromatograms = compounds.filter_peaks_by_intensity(chromatograms, config["noise_intensity"] * 5)
+            return compounds.filter_chromatograms_by_scans(chromatograms, 3)
+        run_stage("compounds_filters", filters, files)
+
+    for stage in list(results):
+        if stage not in stages:
+            results[stage]["dependency_only"] = True
+    return {"config": config, "stages": results}
+
+
+def compare(current, baseline, threshold):
+    """
+    Compares the wall time and peak RSS of every stage with a baseline.
+
+    Returns:
+        list: Regressions above the relative threshold.
+    """
+    regressions = []
+    for scale, scale_results in current["results"].items():
+        base_scale = baseline.get("results", {}).get(scale)
+        if base_scale is None:
+            continue
+        for stage, result in scale_results["stages"].items():
+            base = base_scale["stages"].get(stage)
+            if base is None:
+                continue
+            for metric in ("wall_time_sec", "peak_rss_bytes"):
+                if not base.get(metric):
+                    continue
+                ratio = result[metric] / base[metric]
+                line = f"{scale:8s} {stage:28s} {metric:15s} {base[metric]:>14} -> {result[metric]:>14} ({ratio:.2f}x)"
+                if ratio > 1 + threshold:
+                    regressions.append(line)
+                    line += "  REGRESSION"
+                print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the metabolomics stages on synthetic LC-MS data")
+    parser.add_argument("--scales", nargs="+", default=["small"], help="Dataset scales, see synthetic_mzml.SCALES")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workdir", default=None, help="Folder for the generated data, a temporary one by default")
+    parser.add_argument("--output", default=None, help="JSON file of the results, benchmarks/baselines/<commit>.json by default")
+    parser.add_argument("--compare", default=None, help="Baseline JSON to compare the results with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative slowdown reported as regression")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="metabolomics_benchmarks_")
+    _prepare_environment(workdir)
+    import pyopenms as oms
+
+    report = {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "pyopenms": oms.__version__,
+            "cpu_count": os.cpu_count(),
+        },
+        "results": {},
+    }
+    try:
+        for scale in args.scales:
+            report["results"][scale] = run_scale(scale, args.stages, workdir, seed=args.seed)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output or os.path.join(BASELINES_DIR, f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions above {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
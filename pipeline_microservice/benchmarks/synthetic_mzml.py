@@ -0,0 +1,233 @@
+"""
+Deterministic synthetic LC-MS data for the metabolomics benchmarks.
+
+A set of compounds (monoisotopic m/z, apex RT, peak width, abundance) is drawn once from the
+seed and shared by all the samples. Each sample applies its own RT drift and abundance
+variation, then writes centroided MS1 spectra with the carbon isotope envelope of every eluting
+compound plus random noise peaks. Spectra are streamed to disk with PlainMSDataWritingConsumer,
+so large scales do not need to fit in memory.
+"""
+import os
+import json
+import argparse
+import numpy as np
+import pyopenms as oms
+from scipy.special import comb
+
+C13_MASS_DIFF = 1.0033548
+PROTON_MASS = 1.00727646
+# probability of a carbon atom being 13C
+C13_ABUNDANCE = 0.0107
+
+SCALES = {
+    "small": {"n_samples": 2, "n_spectra": 300, "peaks_per_spectrum": 150, "n_compounds": 150},
+    "medium": {"n_samples": 3, "n_spectra": 1500, "peaks_per_spectrum": 400, "n_compounds": 800},
+    "large": {"n_samples": 6, "n_spectra": 4000, "peaks_per_spectrum": 1000, "n_compounds": 3000},
+}
+
+DEFAULT_CONFIG = {
+    "n_samples": 2,
+    "n_spectra": 300,
+    "peaks_per_spectrum": 150,
+    "n_compounds": 150,
+    "rt_start": 30.0,
+    "cycle_time": 0.5,
+    "mz_min": 80.0,
+    "mz_max": 1000.0,
+    "peak_fwhm": 6.0,
+    "rt_drift": 2.0,
+    "rt_drift_nonlinear": 1.0,
+    "n_isotopes": 3,
+    "charge": 1,
+    "mz_noise_ppm": 2.0,
+    "intensity_noise": 0.05,
+    "noise_intensity": 500.0,
+    "min_abundance": 1e4,
+    "max_abundance": 1e7,
+    "polarity": "negative",
+    "seed": 42,
+}
+
+
+def make_config(scale=None, **overrides):
+    """
+    Returns the generator configuration of a named scale (see SCALES) with the given overrides.
+    """
+    config = dict(DEFAULT_CONFIG)
+    if scale is not None:
+        if scale not in SCALES:
+            raise ValueError(f"Unknown scale {scale}, choose one of {list(SCALES)}")
+        config.update(SCALES[scale])
+    config.update({k: v for k, v in overrides.items() if v is not None})
+    return config
+
+
+def isotope_envelope(n_carbons, n_isotopes):
+    """
+    Relative abundances (most abundant = 1) of the M, M+1, ... peaks from the binomial 13C
+    distribution.
+
+    Parameters:
+        n_carbons (np.ndarray): Number of carbon atoms of each compound.
+        n_isotopes (int): Number of isotope peaks.
+
+    Returns:
+        np.ndarray: (len(n_carbons), n_isotopes) relative abundances.
+    """
+    k = np.arange(n_isotopes)
+    n = np.asarray(n_carbons)[:, None]
+    probabilities = comb(n, k) * C13_ABUNDANCE ** k * (1 - C13_ABUNDANCE) ** (n - k)
+    return probabilities / probabilities.max(axis=1, keepdims=True)
+
+
+def generate_compounds(config):
+    """
+    Draws the compounds shared by all the samples.
+
+    Returns:
+        dict: Arrays mz (monoisotopic m/z of the ion), rt (apex in seconds), sigma (elution
+            width), abundance, n_carbons and the isotope envelope.
+    """
+    rng = np.random.default_rng(config["seed"])
+    n = config["n_compounds"]
+    rt_end = config["rt_start"] + config["n_spectra"] * config["cycle_time"]
+    mz = np.sort(rng.uniform(config["mz_min"], config["mz_max"], n))
+    # roughly one carbon every 14 Da for small molecules
+    n_carbons = np.clip(np.round(mz / 14.0 * rng.uniform(0.7, 1.1, n)), 1, None).astype(int)
+    rt = rng.uniform(config["rt_start"] + 3 * config["peak_fwhm"], rt_end - 3 * config["peak_fwhm"], n)
+    sigma = config["peak_fwhm"] / 2.355 * rng.uniform(0.7, 1.4, n)
+    abundance = np.exp(rng.uniform(np.log(config["min_abundance"]), np.log(config["max_abundance"]), n))
+    return {
+        "mz": mz,
+        "rt": rt,
+        "sigma": sigma,
+        "abundance": abundance,
+        "n_carbons": n_carbons,
+        "envelope": isotope_envelope(n_carbons, config["n_isotopes"]),
+    }
+
+
+def _sample_rt_shift(config, sample_index, rt):
+    # linear drift plus a smooth non linear component, different for every sample
+    phase = sample_index * 1.3
+    span = max(rt.max() - rt.min(), 1.0) if len(rt) else 1.0
+    return (config["rt_drift"] * sample_index
+            + config["rt_drift_nonlinear"] * np.sin(2 * np.pi * (rt - rt.min()) / span + phase))
+
+
+def generate_sample(output_file, compounds, config, sample_index):
+    """
+    Writes one synthetic sample as centroided MS1 mzML.
+
+    Parameters:
+        output_file (str): Path of the mzML file.
+        compounds (dict): Output of generate_compounds().
+        config (dict): Generator configuration.
+        sample_index (int): Index of the sample, drives the RT drift and the random state.
+
+    Returns:
+        dict: Number of spectra and peaks written.
+    """
+    rng = np.random.default_rng([config["seed"], sample_index + 1])
+    rt_apex = compounds["rt"] + _sample_rt_shift(config, sample_index, compounds["rt"])
+    abundance = compounds["abundance"] * rng.lognormal(0.0, 0.2, len(rt_apex))
+    sigma = compounds["sigma"]
+    n_isotopes = config["n_isotopes"]
+    isotope_offsets = np.arange(n_isotopes) * C13_MASS_DIFF / config["charge"]
+    isotope_mz = compounds["mz"][:, None] + isotope_offsets[None, :]
+
+    order = np.argsort(rt_apex)
+    rt_sorted = rt_apex[order]
+    max_sigma = sigma.max() if len(sigma) else 0.0
+
+    polarity = oms.IonSource.Polarity.NEGATIVE if config["polarity"] == "negative" else oms.IonSource.Polarity.POSITIVE
+    settings = oms.InstrumentSettings()
+    settings.setPolarity(polarity)
+
+    consumer = oms.PlainMSDataWritingConsumer(output_file)
+    n_peaks = 0
+    for scan in range(config["n_spectra"]):
+        rt = config["rt_start"] + scan * config["cycle_time"]
+        # compounds eluting within 4 sigma of this scan
+        lo = np.searchsorted(rt_sorted, rt - 4 * max_sigma)
+        hi = np.searchsorted(rt_sorted, rt + 4 * max_sigma)
+        idx = order[lo:hi]
+        profile = abundance[idx] * np.exp(-0.5 * ((rt - rt_apex[idx]) / sigma[idx]) ** 2)
+        intensities = (profile[:, None] * compounds["envelope"][idx]).ravel()
+        mzs = isotope_mz[idx].ravel()
+        keep = intensities > config["noise_intensity"]
+        mzs, intensities = mzs[keep], intensities[keep]
+        mzs = mzs * (1 + rng.normal(0.0, config["mz_noise_ppm"] * 1e-6, len(mzs)))
+        intensities = intensities * (1 + rng.normal(0.0, config["intensity_noise"], len(intensities)))
+
+        n_noise = config["peaks_per_spectrum"]
+        noise_mz = rng.uniform(config["mz_min"], config["mz_max"] + n_isotopes, n_noise)
+        noise_intensity = rng.exponential(config["noise_intensity"], n_noise)
+
+        mzs = np.concatenate([mzs, noise_mz])
+        intensities = np.clip(np.concatenate([intensities, noise_intensity]), 1.0, None)
+        sort = np.argsort(mzs)
+
+        spectrum = oms.MSSpectrum()
+        spectrum.setRT(rt)
+        spectrum.setMSLevel(1)
+        spectrum.setNativeID(f"controllerType=0 controllerNumber=1 scan={scan + 1}")
+        spectrum.setInstrumentSettings(settings)
+        spectrum.set_peaks((mzs[sort], intensities[sort].astype(np.float32)))
+        consumer.consumeSpectrum(spectrum)
+        n_peaks += len(mzs)
+    # the file is finalized when the consumer is released
+    del consumer
+    return {"spectra": config["n_spectra"], "peaks": n_peaks}
+
+
+def generate_dataset(output_dir, config):
+    """
+    Generates all the samples of a configuration plus the ground truth of the compounds.
+
+    Returns:
+        dict: mzml_files, truth_file (CSV of the compounds) and config_file.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    compounds = generate_compounds(config)
+    mzml_files = []
+    for i in range(config["n_samples"]):
+        output_file = os.path.join(output_dir, f"synthetic_{i + 1:02d}.mzML")
+        generate_sample(output_file, compounds, config, i)
+        mzml_files.append(output_file)
+
+    truth_file = os.path.join(output_dir, "compounds.csv")
+    neutral_sign = 1 if config["polarity"] == "negative" else -1
+    with open(truth_file, "w") as f:
+        f.write("compound_id,mz,neutral_mass,rt,abundance,n_carbons\n")
+        for i in range(len(compounds["mz"])):
+            f.write(
+                f"C{i:05d},{compounds['mz'][i]:.6f},{compounds['mz'][i] + neutral_sign * PROTON_MASS:.6f},"
+                f"{compounds['rt'][i]:.3f},{compounds['abundance'][i]:.1f},{compounds['n_carbons'][i]}\n"
+            )
+    config_file = os.path.join(output_dir, "config.json")
+    with open(config_file, "w") as f:
+        json.dump(config, f, indent=2)
+    return {"mzml_files": mzml_files, "truth_file": truth_file, "config_file": config_file}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate deterministic synthetic LC-MS mzML files")
+    parser.add_argument("output_dir")
+    parser.add_argument("--scale", choices=list(SCALES), default="small")
+    parser.add_argument("--samples", type=int, dest="n_samples")
+    parser.add_argument("--spectra", type=int, dest="n_spectra")
+    parser.add_argument("--peaks", type=int, dest="peaks_per_spectrum")
+    parser.add_argument("--compounds", type=int, dest="n_compounds")
+    parser.add_argument("--rt-drift", type=float, dest="rt_drift")
+    parser.add_argument("--isotopes", type=int, dest="n_isotopes")
+    parser.add_argument("--seed", type=int)
+    args = vars(parser.parse_args())
+    output_dir = args.pop("output_dir")
+    config = make_config(args.pop("scale"), **args)
+    dataset = generate_dataset(output_dir, config)
+    print(json.dumps(dataset, indent=2))
+
+
+if __name__ == "__main__":
+    main()